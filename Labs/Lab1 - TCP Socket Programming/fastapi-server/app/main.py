@@ -55,3 +55,11 @@ def really_big_header(response: Response):
 @app.get("/你好")
 def test_chinese():
     return "Today is very 风和日丽"
+
+
+@app.get("/short_lived")
+def short_lived(request: Request):
+    headers = {"ETag": '"short-lived-v1"', "Cache-Control": "max-age=1"}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(content="Fresh for one second only", media_type="text/plain", headers=headers)
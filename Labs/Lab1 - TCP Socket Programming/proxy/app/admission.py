@@ -0,0 +1,58 @@
+# what goes into the cache, and what just passes through
+
+"""
+Only requests the cache can answer later are looked up and stored:
+
+	- GET without a body, Authorization or Cache-Control: no-store.
+	  everything else (POST, HEAD, PUT, ...) is relayed to the origin and
+	  back without touching the cache. a Range is answered from the whole
+	  cached object, see ranges.py
+	- of their responses only the ones that are cacheable by default
+	  (RFC 9110 section 15.1) and not marked no-store/private are stored
+	- the cache key is only the URL, it cannot keep one copy per variant: a
+	  response that varies on anything but Accept-Encoding (compression.py
+	  makes the encodings from the one copy) is not stored. Vary: Cookie
+	  would otherwise serve one user's page to the next
+
+404 and 410 are not stored unless negative caching is on (--negative-ttl):
+then they are kept for at most negative_ttl seconds, so a burst of requests
+for something missing costs the origin one request per TTL instead of one
+per request. See freshness.freshness_lifetime.
+"""
+
+CACHEABLE_STATUSES = (200, 203, 204, 300, 301, 308)
+NEGATIVE_STATUSES = (404, 410)
+# seconds 404/410 responses are cached for, 0 turns negative caching off (proxy.py sets --negative-ttl)
+negative_ttl = 0.0
+
+
+def cache_control(headers):
+	return [part.strip().split("=", 1)[0].lower() for part in headers.get("cache-control", "").split(",")]
+
+
+def request_cacheable(request):
+	"""
+	True if the cache may answer this request (a httpparse.RequestParser)
+	"""
+	if request.method != "GET" or request.has_body:
+		return False
+	if "authorization" in request.headers:
+		return False
+	return "no-store" not in cache_control(request.headers)
+
+
+def response_cacheable(status, headers):
+	"""
+	True if a response with this status and these (lower-cased) headers may be stored
+	"""
+	if status in NEGATIVE_STATUSES:
+		if negative_ttl <= 0:
+			return False
+	elif status not in CACHEABLE_STATUSES:
+		return False
+	directives = cache_control(headers)
+	if "no-store" in directives or "private" in directives:
+		return False
+	# one copy per URL, see the top of the file
+	vary = headers.get("vary", "").lower().split(",")
+	return all(name.strip() in ("", "accept-encoding") for name in vary)
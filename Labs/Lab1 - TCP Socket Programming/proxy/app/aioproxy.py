@@ -0,0 +1,528 @@
+# asyncio engine for the lab 1 proxy (python proxy.py --engine asyncio)
+
+import asyncio
+import os
+import sys
+import time
+
+import admission
+import common
+import compression
+import eventlog
+import freshness
+import hotcache
+import httpparse
+import metrics
+import overload
+import prefetch
+import ranges
+import singleflight
+import teardown
+import tracing
+import upstream
+
+"""
+Same request handling as client_thread in proxy.py, but every client is a
+coroutine on a single event loop instead of an OS thread. An idle connection
+costs a few KB (a StreamReader/StreamWriter pair) instead of a thread stack,
+so one process can hold thousands of them.
+
+The cache directory layout is shared with the threaded engine (common.py).
+"""
+
+# cache misses currently being fetched, see singleflight.py
+flights = singleflight.FlightTable(singleflight.AsyncFlight)
+# memory tier, proxy.py swaps in the configured one
+hot = hotcache.HotObjectCache()
+# keep-alive connections to the origins
+pool = upstream.AsyncConnectionPool()
+
+# client keep-alive limits, proxy.py passes on the command line values
+client_idle_timeout = 5.0
+max_requests_per_connection = 100
+# disk hits with os.sendfile, see proxy.use_sendfile
+use_sendfile = True
+# --prefetch, see prefetch.py
+prefetcher = None
+# write-behind for misses, see proxy.cache_writer
+cache_writer = None
+# admission control, see overload.py. slots is made by main() from max_connections
+backlog = overload.DEFAULT_BACKLOG
+max_connections = overload.DEFAULT_MAX_CONNECTIONS
+accept_queue = overload.DEFAULT_ACCEPT_QUEUE
+slots = None
+waiting = 0
+rejected = 0
+# teardown tasks of closed connections, see close_later
+lingering = set()
+
+CHUNK_SIZE = 4096
+CLIENT_TIMEOUT = 5.0
+SENDFILE_SLICE = 1024 * 1024
+MAX_REQUEST_HEAD = httpparse.MAX_HEAD_BYTES
+
+
+async def drain_until_closed(reader):
+	while await reader.read(65536):
+		pass
+
+
+async def linger(reader, writer):
+	"""
+	drops what the client still sends until it closes too, at most
+	teardown.LINGER seconds, then closes
+	"""
+	try:
+		await asyncio.wait_for(drain_until_closed(reader), teardown.LINGER)
+	except Exception:
+		pass
+	writer.close()
+	try:
+		await writer.wait_closed()
+	except Exception:
+		pass
+
+
+def close_later(reader, writer):
+	"""
+	what the reaper (teardown.py) does for the threads engine: our FIN goes out
+	now and a background task waits for the client's. the caller, and the
+	connection's admission slot, are free right away
+	"""
+	if len(lingering) >= teardown.MAX_LINGERING or writer.is_closing():
+		writer.close()
+		return
+	try:
+		if writer.can_write_eof():
+			writer.write_eof()
+	except OSError:
+		writer.close()
+		return
+	task = asyncio.ensure_future(linger(reader, writer))
+	lingering.add(task)
+	task.add_done_callback(lingering.discard)
+
+
+async def send(writer, buff):
+	writer.write(buff)
+	await asyncio.wait_for(writer.drain(), CLIENT_TIMEOUT)
+
+
+async def send_response(writer, response, buff):
+	out = response.feed(buff)
+	if out:
+		await send(writer, out)
+
+
+async def handle_client(reader, writer):
+	"""
+	admission control in front of serve_client: a connection waits for one of
+	the max_connections slots, or gets a 503 when accept_queue others already do
+	"""
+	global waiting, rejected
+	accepted = time.monotonic()
+	if slots.locked():
+		if waiting >= accept_queue:
+			rejected += 1
+			writer.write(overload.REJECT_RESPONSE)
+			overload.count_rejection()
+			close_later(reader, writer)
+			return
+		waiting += 1
+		metrics.queued_connections.inc()
+		try:
+			await slots.acquire()
+		finally:
+			waiting -= 1
+			metrics.queued_connections.inc(-1)
+	else:
+		await slots.acquire()
+	try:
+		await serve_client(reader, writer, accepted, time.monotonic())
+	finally:
+		slots.release()
+
+
+async def serve_client(reader, writer, accepted=None, pickedUp=None):
+	"""
+	serves requests on one client connection until it closes, idles out or a
+	response cannot be framed. pipelined requests wait in the StreamReader buffer.
+	accepted and pickedUp (time.monotonic()) are for --trace-file, see tracing.py
+	"""
+	served = 0
+	request = exchange = trace = None
+	metrics.connection_opened()
+	try:
+		while served < max_requests_per_connection:
+			try:
+				head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"),
+					client_idle_timeout if served else CLIENT_TIMEOUT)
+			except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+				break # closed or idle
+			request = httpparse.RequestParser()
+			request.feed(head)
+			trace = tracing.begin(accepted if not served else None)
+			if trace is not None and not served:
+				trace.mark("queued", pickedUp)
+				trace.mark("head")
+			served += 1
+			if served >= max_requests_per_connection:
+				request.keep_alive = False
+			exchange = metrics.Exchange(trace)
+			keepAlive = await handle_request(reader, writer, request, exchange)
+			exchange.mark("transfer")
+			exchange.finish()
+			if not keepAlive:
+				break
+			tracing.finish(trace, request, exchange)
+			trace = None
+	except:
+		eventlog.exception("connection_failed", requests=served)
+
+	finally:
+		metrics.connection_closed()
+		close_later(reader, writer)
+		if trace is not None:
+			trace.mark("close")
+			tracing.finish(trace, request, exchange)
+		eventlog.debug("connection_closed", requests=served)
+
+
+async def handle_request(reader, writer, request, exchange):
+	"""
+	answers one request, returns True if the connection can take another one.
+	a request body is still waiting in reader. exchange: see proxy.handle_request
+	"""
+	try:
+		eventlog.sampled(eventlog.INFO, "request", method=request.method, target=request.target, version=request.version)
+
+		parsed = common.parse_request(request)
+		if parsed is None:
+			return False
+
+		webServer, resource = parsed
+		keepAlive = request.keep_alive and not request.has_body
+
+		eventlog.debug("parsed", host=webServer, resource=resource)
+
+		url = common.cache_key(webServer, resource)
+		file_to_use = common.cache_file_for(url)
+
+	except:
+		eventlog.exception("request_failed", target=request.target)
+		return False
+
+	cacheable = admission.request_cacheable(request)
+	# the cache answers Range requests itself, from the whole object
+	rangeRequest = ranges.RangeRequest.from_headers(request.headers) if cacheable else None
+	response = common.ResponseRewriter(keepAlive, request.method, exchange, rangeRequest)
+	if not cacheable:
+		eventlog.sampled(eventlog.INFO, "passthrough", method=request.method, url=url)
+		exchange.answer(metrics.UNCACHED)
+		try:
+			return await relay_uncached(reader, writer, response, webServer, request, exchange.trace)
+		except:
+			eventlog.exception("relay_failed", url=url)
+			exchange.outcome = metrics.ERROR
+			return False
+
+	try:
+		stale = common.stale_entry(flights.index, file_to_use, request)
+		encoding = compression.negotiate(flights.index.get(file_to_use), request.headers) if stale is None else None
+		if encoding is not None and await serve_variant(writer, response, file_to_use, encoding, exchange, url):
+			return response.keep_alive()
+		data = hot.get(file_to_use) if stale is None else None
+		if data is not None:
+			eventlog.sampled(eventlog.INFO, "cache_hit", tier="memory", url=url)
+			exchange.answer(metrics.HIT)
+			exchange.mark("lookup")
+			await send_response(writer, response, data)
+			return response.keep_alive()
+
+		kind, flight, f = flights.open(file_to_use, stale is not None, url)
+		exchange.mark("lookup")
+		with f:
+			if kind == singleflight.HIT:
+				eventlog.sampled(eventlog.INFO, "cache_hit", tier="disk", url=url)
+				exchange.answer(metrics.HIT)
+				await serve_from_disk(writer, response, file_to_use, f, flights.index.get(file_to_use))
+			elif kind == singleflight.FOLLOW:
+				hot.disk_miss()
+				exchange.answer(metrics.MISS)
+				eventlog.sampled(eventlog.INFO, "cache_miss", url=url, joined=True)
+				await follow_flight(writer, response, flight, f)
+			else:
+				hot.disk_miss()
+				exchange.answer(metrics.MISS)
+				eventlog.sampled(eventlog.INFO, "cache_miss" if stale is None else "cache_revalidate", url=url)
+				if not await fetch_and_cache(writer, response, webServer, request.head, flight, f, stale, exchange.trace):
+					exchange.outcome = metrics.ERROR
+					return False
+		if flight is not None and flight.revalidated:
+			eventlog.sampled(eventlog.INFO, "cache_hit", tier="revalidated", url=url)
+			exchange.answer(metrics.HIT)
+			with open(file_to_use, "rb") as f:
+				await serve_from_disk(writer, response, file_to_use, f, flights.index.get(file_to_use))
+		return response.keep_alive()
+	except:
+		eventlog.exception("request_failed", url=url)
+		exchange.outcome = metrics.ERROR
+		return False
+
+
+async def request_body(reader, request):
+	"""
+	the raw body of request, piece by piece, see proxy.request_body
+	"""
+	while not request.done:
+		buff = await asyncio.wait_for(reader.read(CHUNK_SIZE), CLIENT_TIMEOUT)
+		if not buff:
+			raise ConnectionError("client closed in the middle of the request body")
+		used = request.feed(buff)
+		yield buff[:used]
+
+
+async def relay_uncached(reader, writer, response, webServer, request, trace=None):
+	"""
+	requests the cache stays out of (POST, HEAD, Range, ...) go straight to the origin and back
+	"""
+	async def relay(buff):
+		await send_response(writer, response, buff)
+
+	body = request_body(reader, request) if request.has_body else None
+	host, port = upstream.split_host(webServer)
+	await pool.fetch(host, port, upstream.upstream_request(request.head), relay, request.method, body, trace)
+	return response.keep_alive()
+
+
+async def serve_from_disk(clientWriter, response, file_to_use, f, entry=None):
+	"""
+	disk tier hit, the object is copied into memory once it gets hot, otherwise
+	the body goes out with loop.sendfile (os.sendfile, or a read/send fallback
+	where the event loop cannot do it). entry: see proxy.serve_from_disk
+	"""
+	stored = common.StoredResponse(f, entry)
+	size = stored.size
+	if hot.disk_hit(file_to_use, size):
+		data = stored.read()
+		hot.put(file_to_use, data)
+		eventlog.debug("promoted", file=file_to_use, size=size)
+		await send_response(clientWriter, response, data)
+		return
+
+	if use_sendfile:
+		await send(clientWriter, response.feed_head(stored))
+		loop = asyncio.get_running_loop()
+		for piece in response.file_pieces(size):
+			if isinstance(piece, bytes):
+				await send(clientWriter, piece)
+				continue
+			offset, count = stored.file_offset(piece[0]), piece[1]
+			while count > 0:
+				# in slices, so a client that stops reading is noticed like with send()
+				n = min(count, SENDFILE_SLICE)
+				await asyncio.wait_for(loop.sendfile(clientWriter.transport, f, offset, n), CLIENT_TIMEOUT)
+				offset += n
+				count -= n
+		return
+
+	while True:
+		buff = stored.read(CHUNK_SIZE)
+		if not buff:
+			break
+		await send_response(clientWriter, response, buff)
+
+
+async def serve_variant(clientWriter, response, file_to_use, encoding, exchange, url):
+	"""
+	a hit answered with the compressed copy of the object, see proxy.serve_variant.
+	the copy is made on a thread, never on the loop
+	"""
+	variant = compression.variant_path(file_to_use, encoding)
+	data = hot.get(variant)
+	if data is not None:
+		eventlog.sampled(eventlog.INFO, "cache_hit", tier="memory", encoding=encoding, url=url)
+		exchange.answer(metrics.HIT)
+		await send_response(clientWriter, response, data)
+		return True
+	f = compression.open_variant(file_to_use, encoding, flights.index.get(file_to_use))
+	if f is None:
+		return False
+	with f:
+		eventlog.sampled(eventlog.INFO, "cache_hit", tier="disk", encoding=encoding, url=url)
+		exchange.answer(metrics.HIT)
+		await serve_from_disk(clientWriter, response, variant, f)
+	return True
+
+
+async def fetch_and_cache(clientWriter, response, webServer, requestHead, flight, cacheFile, stale=None, trace=None):
+	"""
+	cache miss leader: relay the origin's response to the client while writing it
+	to the flight's temp file, then publish it if admission.py lets it in. a
+	stale copy is revalidated instead, see proxy.fetch_and_cache. with
+	cache_writer the file is written on its threads, and what they report
+	back runs on the loop. without, every write is awaited in the loop's
+	executor. either way the loop never waits for the disk. trace: the
+	request's tracing.Trace, if it is traced. returns False if our client did
+	not get the whole response
+	"""
+	failed = True
+	clientAlive = True
+	validating = stale is not None and freshness.has_validators(stale)
+	request = freshness.conditional_request(upstream.upstream_request(requestHead), stale if validating else None)
+	status = httpparse.ResponseFramer()
+	held = b""
+	admit = True
+	loop = asyncio.get_running_loop()
+	stream = None
+	if cache_writer is not None:
+		stream = cache_writer.open(cacheFile, lambda n: loop.call_soon_threadsafe(flight.wrote, n))
+	dropped = False
+
+	async def store(buff):
+		nonlocal dropped
+		if stream is None:
+			await loop.run_in_executor(None, cacheFile.write, buff)
+			flight.wrote(len(buff))
+		elif not dropped and not stream.write(buff):
+			# see proxy.fetch_and_cache
+			if flights.abandon(flight):
+				dropped = True
+				cache_writer.count_drop()
+				eventlog.warning("not_stored", reason="write_behind_full", url=flight.url)
+			else:
+				stream.write(buff, force=True)
+
+	async def relay(buff):
+		nonlocal clientAlive, held, admit
+		if not status.head_complete:
+			status.feed(buff, stop_at_head=True)
+			held += buff
+			if not status.head_complete:
+				return
+			buff, held = held, b""
+			admit = admission.response_cacheable(status.status, status.headers)
+			if not admit and not (validating and status.status == 304):
+				eventlog.info("not_stored", status=status.status, url=flight.url)
+		if validating and status.status == 304:
+			return
+		await store(buff)
+		if clientAlive:
+			try:
+				await send_response(clientWriter, response, buff)
+			except (OSError, asyncio.TimeoutError):
+				# our own client left, keep going for the followers
+				clientAlive = False
+
+	try:
+		host, port = upstream.split_host(webServer)
+		eventlog.debug("fetch_start", url=flight.url)
+		framer = await pool.fetch(host, port, request, relay, trace=trace)
+		eventlog.debug("fetch_done", url=flight.url, size=framer.offset)
+		failed = False
+	except:
+		eventlog.exception("fetch_failed", url=flight.url)
+	finally:
+		refreshed = not failed and validating and status.status == 304
+		if stream is None or refreshed:
+			if stream is not None:
+				# a 304 wrote nothing, handle_request serves the refreshed copy right away, see proxy.fetch_and_cache
+				stream.close()
+			cacheFile.close()
+			if refreshed or failed or not admit:
+				publish_fetch(flight, status, validating, failed, admit)
+			else:
+				# digesting the body (blobstore.py) reads all of it, not on the loop either
+				loop.run_in_executor(None, flights.hash_body, flight).add_done_callback(
+					lambda _: publish_fetch(flight, status, validating, failed, admit))
+		else:
+			def closed(ok):
+				# on the writer thread: digesting the body (blobstore.py) is the slow part of publishing
+				if ok and not failed and not dropped and admit:
+					flights.hash_body(flight)
+				loop.call_soon_threadsafe(publish_fetch, flight, status, validating, failed or dropped or not ok, admit)
+
+			stream.close(closed)
+	return clientAlive and not failed
+
+
+def publish_fetch(flight, status, validating, failed, admit):
+	"""
+	see proxy.publish_fetch
+	"""
+	if not failed and validating and status.status == 304:
+		flights.refresh(flight, status.head)
+		return
+	flights.publish(flight, failed, admit)
+	for path in [flight.key] + compression.variant_paths(flight.key):
+		hot.invalidate(path)
+	if prefetcher is not None and not failed and admit:
+		prefetcher.response_cached(flight.url, flight.key, status.status, status.headers)
+
+
+async def follow_flight(clientWriter, response, flight, f):
+	"""
+	cache miss follower: stream the leader's temp file as it grows
+	"""
+	sent = 0
+	while True:
+		written = await flight.wait(sent, CLIENT_TIMEOUT)
+		if written > sent:
+			buff = f.read(min(written - sent, 65536))
+			if not buff:
+				break
+			await send_response(clientWriter, response, buff)
+			sent += len(buff)
+		elif flight.done:
+			break
+		else:
+			raise TimeoutError("in-flight fetch of " + flight.key + " stalled")
+
+
+def raise_fd_limit():
+	"""
+	every connection is a file descriptor, the default soft limit (1024) is the
+	first thing to run out with thousands of clients on one process
+	"""
+	try:
+		import resource
+	except ImportError: # not on windows
+		return
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	if hard == resource.RLIM_INFINITY or soft < hard:
+		try:
+			resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+		except (ValueError, OSError):
+			pass
+
+
+async def main(proxy_port, sock=None):
+	global slots
+	slots = asyncio.Semaphore(max_connections)
+	if sock is not None:
+		# --workers: already bound and listening, see workers.py
+		server = await asyncio.start_server(handle_client, sock=sock, limit=MAX_REQUEST_HEAD)
+	else:
+		server = await asyncio.start_server(handle_client, "", proxy_port, backlog=backlog, limit=MAX_REQUEST_HEAD)
+	print('Proxy ready to serve at port', proxy_port, '(asyncio)')
+	async with server:
+		await server.serve_forever()
+
+
+def serve(proxy_port, sock=None):
+	raise_fd_limit()
+	try:
+		asyncio.run(main(proxy_port, sock))
+	except KeyboardInterrupt:
+		eventlog.close()
+		tracing.close()
+		print('bye...')
+		print(hot.stats_line())
+		print(pool.stats_line())
+		print(pool.resolver.stats_line())
+		if prefetcher is not None:
+			print(prefetcher.stats_line())
+		if cache_writer is not None:
+			print(cache_writer.stats_line())
+		print(flights.index.blobs.stats_line())
+		print("client slots: %d max, %d waiting, %d rejected" % (max_connections, waiting, rejected))
@@ -0,0 +1,84 @@
+# a bounded record queue and the background thread that writes it out in batches
+
+import threading
+from collections import deque
+
+"""
+eventlog.py and tracing.py both keep the request path away from the output:
+a request only appends a record to a BatchWriter, and its thread formats and
+writes what has piled up once every interval, in one write():
+
+	log = BatchWriter("eventlog-writer", format_record, sys.stdout.write, dropped_line)
+	log.start()
+	log.put(record)     # from any thread, never blocks
+	log.close()         # writes out what is left
+
+	- put() is a deque.append, no lock. a full queue drops the record and
+	  counts it, dropped_line(count) is written with the next batch
+	- write gets all the lines of a batch in one string, "\\n" terminated
+	- errors of write (the disk is full, stdout is gone) lose the batch, the
+	  thread keeps going
+"""
+
+
+class BatchWriter:
+
+	def __init__(self, name, format, write, dropped_line, queue_size=10000, interval=0.05):
+		self.name = name
+		self.format = format
+		self.write = write
+		self.dropped_line = dropped_line
+		self.queue_size = queue_size
+		self.interval = interval
+		self.queue = deque()
+		self.dropped = 0
+		self.thread = None
+		self.stopping = threading.Event()
+
+	def put(self, record):
+		# the length check may let a few records too many through when threads
+		# race, that is fine for a bound
+		if len(self.queue) >= self.queue_size:
+			self.dropped += 1
+			return
+		self.queue.append(record)
+
+	def flush(self):
+		"""
+		writes out everything queued so far, returns how many lines that was
+		"""
+		lines = []
+		while self.queue:
+			lines.append(self.format(self.queue.popleft()))
+		if self.dropped:
+			dropped, self.dropped = self.dropped, 0
+			lines.append(self.dropped_line(dropped))
+		if lines:
+			self.write("\n".join(lines) + "\n")
+		return len(lines)
+
+	def _run(self):
+		while not self.stopping.wait(self.interval):
+			try:
+				self.flush()
+			except (OSError, ValueError):
+				pass # nowhere to tell anyone, the batch is lost
+		self.flush()
+
+	def start(self):
+		"""
+		starts the writer thread. in --workers mode every worker starts its own after the fork
+		"""
+		self.stopping.clear()
+		self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+		self.thread.start()
+
+	def close(self, timeout=1.0):
+		"""
+		writes out what is still queued and stops the thread
+		"""
+		if self.thread is not None:
+			self.stopping.set()
+			self.thread.join(timeout)
+		else:
+			self.flush()
@@ -0,0 +1,154 @@
+# content-addressed bodies: one file for every distinct body, however many URLs serve it
+
+import hashlib
+import os
+
+import metrics
+
+"""
+The cache is keyed by URL (common.cache_file_for), so the same jQuery or GIF
+served by several hosts, mirrors or query strings used to be stored once per
+URL. Every published object now has its body in a blob named after the
+SHA-256 of the body, and the object file is a hard link to it:
+
+	cache/3f/a2/3fa2...          \\  two URLs with the same body
+	cache/91/0c/910c...           > and the blob, named after its digest:
+	cache/blobs/5e/5e1b...       /  three names of one inode
+
+A file holds a whole response, head included, so the blob has the head of
+the response it was first stored with in front of the body. A URL that
+shares it brings its own head: its index record (cacheindex.py) gets
+
+	"blob"         the body's digest
+	"body_offset"  where the body starts in the file
+	"head"         its own response head, only if it differs from the file's
+
+and common.StoredResponse serves that head followed by the body, sendfile
+and the memory tier included. The reference count is the inode's link count:
+the object files linking the blob, plus the blob's own name. Removing or
+replacing an object drops its link, and the last object out takes the blob
+with it (release). Links are atomic and shared by --workers processes, so
+they see the same counts without talking to each other.
+
+Bodies under MIN_BODY are not worth the extra directory entry and stay plain
+files. --no-dedup publishes every object as a plain file.
+"""
+
+# proxy.py clears this with --no-dedup
+enabled = True
+
+BLOB_DIRECTORY = "blobs"
+# smaller bodies save at most a disk block
+MIN_BODY = 4096
+# the response head must end within this many bytes for the body to be found
+MAX_HEAD_BYTES = 256 * 1024
+
+
+class BlobStore:
+
+	def __init__(self, directory):
+		self.directory = os.path.join(directory, BLOB_DIRECTORY)
+		self.made = set() # fan-out directories created already
+		self.shared = 0
+		self.saved = 0
+
+	def path_for(self, digest):
+		return os.path.join(self.directory, digest[:2], digest)
+
+	def digest(self, path):
+		"""
+		(digest, body offset) of the complete response stored in path, None if
+		the body is too small to share or the head cannot be found
+		"""
+		with open(path, "rb") as f:
+			size = os.fstat(f.fileno()).st_size
+			start = f.read(MAX_HEAD_BYTES)
+			end = start.find(b"\r\n\r\n")
+			if end < 0 or size - (end + 4) < MIN_BODY:
+				return None
+			bodyOffset = end + 4
+			h = hashlib.sha256(start[bodyOffset:])
+			while True:
+				buff = f.read(1024 * 1024)
+				if not buff:
+					break
+				h.update(buff)
+		return h.hexdigest(), bodyOffset
+
+	def share(self, tmpPath, digest, bodyOffset):
+		"""
+		called with the flight table's lock held, before tmpPath is renamed
+		into the object's place: the first body with this digest becomes the
+		blob, for a later one the existing blob is linked instead. returns
+		(path to rename into place, fields for the index record)
+		"""
+		blob = self.path_for(digest)
+		directory = os.path.dirname(blob)
+		if directory not in self.made:
+			os.makedirs(directory, exist_ok=True)
+			self.made.add(directory)
+		for _ in range(2):
+			try:
+				os.link(tmpPath, blob)
+				return tmpPath, {"blob": digest, "body_offset": bodyOffset}
+			except FileExistsError:
+				pass
+			linkPath = tmpPath + ".link"
+			try:
+				os.link(blob, linkPath)
+			except FileNotFoundError:
+				continue # its last object was removed just now, ours becomes the blob
+			except OSError:
+				break # too many links to one inode, this one keeps its own copy
+			with open(tmpPath, "rb") as f:
+				head = f.read(bodyOffset)
+				bodySize = os.fstat(f.fileno()).st_size - bodyOffset
+			with open(linkPath, "rb") as f:
+				size = os.fstat(f.fileno()).st_size
+				blobHead = f.read(MAX_HEAD_BYTES).split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n"
+			if size - len(blobHead) != bodySize:
+				os.unlink(linkPath)
+				break # not the same body after all
+			fields = {"blob": digest, "body_offset": len(blobHead), "size": size}
+			if head != blobHead:
+				fields["head"] = head.decode("latin-1")
+			self.shared += 1
+			self.saved += bodySize
+			metrics.dedup_bytes.inc(bodySize)
+			return linkPath, fields
+		return tmpPath, {}
+
+	def release(self, digest):
+		"""
+		after an object linking the blob was removed or replaced: deletes the
+		blob if no object links it anymore
+		"""
+		if digest is None:
+			return
+		blob = self.path_for(digest)
+		try:
+			if os.stat(blob).st_nlink <= 1:
+				os.unlink(blob)
+		except FileNotFoundError:
+			pass
+
+	def collect(self, since):
+		"""
+		deletes the blobs no object links (a crash between removing an object
+		and releasing its blob), except ones written after since. returns how many
+		"""
+		collected = 0
+		for root, dirs, files in os.walk(self.directory):
+			for name in files:
+				path = os.path.join(root, name)
+				try:
+					stat = os.stat(path)
+					if stat.st_nlink <= 1 and stat.st_mtime < since:
+						os.unlink(path)
+						collected += 1
+				except FileNotFoundError:
+					pass
+		return collected
+
+	def stats_line(self):
+		return "blob store: %d bodies shared, %d bytes not stored again" % (self.shared, self.saved)
@@ -0,0 +1,338 @@
+# on-disk index of the cache, so a restart does not have to start cold
+
+import json
+import os
+import threading
+import time
+
+import blobstore
+from httpparse import parse_response_head
+
+"""
+cache/index.log is an append-only log with one JSON record per line:
+
+	{"key": "3f/a2/3fa2...", "url": "http://127.0.0.1/home_igloo.gif",
+	 "size": 40283, "status": 200, "stored": 1697...., "date": ...,
+	 "expires": ..., "cache_control": ..., "etag": ..., "last_modified": ...,
+	 "age": ..., "content_type": ..., "content_encoding": ...,
+	 "blob": "5e1b...", "body_offset": 312, "head": ...}
+	{"key": "...", "removed": true}
+
+key is the cache file path relative to the cache directory, the last record
+for a key wins. At boot the log is replayed into a dict (no stat() per object,
+so startup cost does not grow with the size of the objects) and rewritten
+without the dead records. A background thread then checks every object
+against the disk: missing or truncated objects are dropped from the index,
+and files nobody indexed (a crash between publish and the log append, or
+leftover .inflight temp files) are deleted.
+
+Every object also has a sidecar <object>.meta holding its current record, so
+an object on disk can be identified without the log, and a lost index.log
+is rebuilt from the sidecars. Compressed copies (<object>.gz, ...) belong to
+the object too, see compression.py. blob, body_offset and head tell where its
+body is when it is shared with other URLs, see blobstore.py.
+
+A cached file is only ever served if the index knows about it and its size
+matches what was recorded, see check().
+
+With --workers every process has its own copy of the index in memory, only
+the files are shared:
+
+	- a record is appended with a single write() on an O_APPEND descriptor,
+	  lines of different workers never interleave
+	- the publishing worker writes the sidecar first and renames the object
+	  into place after it, so the sidecar never describes a file that is not
+	  there yet: until the rename the old object (if any) has the wrong size
+	- an object another worker published is not in our dict, get() and
+	  check() then take its record from the sidecar. a stale record is reread
+	  from the sidecar too before revalidating, another worker may have done
+	  it already
+"""
+
+INDEX_FILE = "index.log"
+META_SUFFIX = ".meta"
+# the response head must fit in here for its metadata to be recorded
+MAX_HEAD_BYTES = 256 * 1024
+# index record field -> response header it is taken from
+FRESHNESS_HEADERS = [
+	("date", "date"),
+	("expires", "expires"),
+	("cache_control", "cache-control"),
+	("etag", "etag"),
+	("last_modified", "last-modified"),
+]
+# recorded at store time only, a 304 does not change them
+CONTENT_HEADERS = [
+	("content_type", "content-type"),
+	("content_encoding", "content-encoding"),
+]
+# compressed copies stored next to an object, see compression.py
+VARIANT_SUFFIXES = (".gz", ".br", ".zst")
+
+
+class CacheIndex:
+
+	def __init__(self, directory):
+		self.directory = directory
+		self.path = os.path.join(directory, INDEX_FILE)
+		self.entries = {}
+		self.lock = threading.Lock()
+		self.log = None
+		self.booted = time.time()
+		self.blobs = blobstore.BlobStore(directory)
+
+	def key_for(self, file_to_use):
+		return os.path.relpath(file_to_use, self.directory)
+
+	def load(self):
+		"""
+		replays the log into memory and compacts it, returns the number of objects
+		"""
+		try:
+			with open(self.path, "r", encoding="utf-8") as f:
+				for line in f:
+					try:
+						record = json.loads(line)
+						key = record["key"]
+					except (ValueError, KeyError, TypeError):
+						continue # a torn last line after a crash
+					if record.get("removed"):
+						self.entries.pop(key, None)
+					else:
+						self.entries[key] = record
+		except FileNotFoundError:
+			self.rebuild()
+
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, "w", encoding="utf-8") as f:
+			for record in self.entries.values():
+				f.write(json.dumps(record) + "\n")
+		os.replace(tmp_path, self.path)
+		return len(self.entries)
+
+	def rebuild(self):
+		"""
+		no log to replay: collect the records from the sidecar files instead
+		"""
+		for root, dirs, files in os.walk(self.directory):
+			for name in files:
+				if not name.endswith(META_SUFFIX):
+					continue
+				try:
+					with open(os.path.join(root, name), "r", encoding="utf-8") as f:
+						record = json.load(f)
+					self.entries[record["key"]] = record
+				except (OSError, ValueError, KeyError, TypeError):
+					continue
+
+	def open_log(self):
+		# unbuffered, every record is one write() (see the workers note above)
+		self.log = open(self.path, "ab", buffering=0)
+
+	def _append(self, record):
+		# called with the lock held
+		if self.log is not None:
+			self.log.write((json.dumps(record) + "\n").encode("utf-8"))
+
+	def get(self, file_to_use):
+		"""
+		the record of an object, None if nothing is cached. one we have never
+		seen may have been published by another worker, its sidecar would say
+		"""
+		entry = self.entries.get(self.key_for(file_to_use))
+		return entry if entry is not None else self.reload(file_to_use)
+
+	def check(self, file_to_use, size):
+		"""
+		True if the file is indexed and still has the size it was stored with.
+		if not, the sidecar may know it: published by another worker
+		"""
+		key = self.key_for(file_to_use)
+		entry = self.entries.get(key)
+		if entry is not None and entry["size"] == size:
+			return True
+		record = self.read_sidecar(file_to_use)
+		if record is None or record.get("size") != size:
+			return False
+		with self.lock:
+			self.entries[key] = record
+		return True
+
+	def reload(self, file_to_use):
+		"""
+		the current record of an object, taken from the sidecar if that one is
+		newer than ours (another worker revalidated or replaced the object)
+		"""
+		key = self.key_for(file_to_use)
+		record = self.read_sidecar(file_to_use)
+		with self.lock:
+			current = self.entries.get(key)
+			if record is not None and (current is None or record["stored"] > current["stored"]):
+				self.entries[key] = record
+				return record
+			return current
+
+	def read_sidecar(self, file_to_use):
+		try:
+			with open(file_to_use + META_SUFFIX, "r", encoding="utf-8") as f:
+				record = json.load(f)
+		except (OSError, ValueError):
+			return None
+		if not isinstance(record, dict) or record.get("key") != self.key_for(file_to_use) or "stored" not in record:
+			return None
+		return record
+
+	def _write_sidecar(self, file_to_use, record):
+		tmp_path = file_to_use + META_SUFFIX + ".tmp"
+		with open(tmp_path, "w", encoding="utf-8") as f:
+			json.dump(record, f)
+		os.replace(tmp_path, file_to_use + META_SUFFIX)
+
+	def add(self, file_to_use, url=None, data_path=None, fields=None):
+		"""
+		records a cache file, reading its metadata from the stored response head.
+		data_path is the temp file that is about to be renamed to file_to_use,
+		fields go into the record as they are (BlobStore.share)
+		"""
+		with open(data_path or file_to_use, "rb") as f:
+			size = os.fstat(f.fileno()).st_size
+			head = f.read(MAX_HEAD_BYTES).split(b"\r\n\r\n", 1)[0]
+		status, headers = parse_response_head(head)
+		record = {
+			"key": self.key_for(file_to_use),
+			"url": url,
+			"size": size,
+			"status": status,
+			"stored": time.time(),
+			"age": headers.get("age"),
+		}
+		for field, name in FRESHNESS_HEADERS + CONTENT_HEADERS:
+			record[field] = headers.get(name)
+		if fields:
+			record.update(fields)
+		self._write_sidecar(file_to_use, record)
+		with self.lock:
+			self.entries[record["key"]] = record
+			self._append(record)
+		return record
+
+	def refresh(self, file_to_use, head):
+		"""
+		a 304 Not Modified revalidated the object: its freshness starts over and
+		the validators/expiry headers the 304 carries replace the stored ones
+		"""
+		status, headers = parse_response_head(head.split(b"\r\n\r\n", 1)[0])
+		key = self.key_for(file_to_use)
+		with self.lock:
+			current = self.entries.get(key)
+			if current is None:
+				return None
+			record = dict(current, stored=time.time(), age=headers.get("age"))
+			for field, name in FRESHNESS_HEADERS:
+				if name in headers:
+					record[field] = headers[name]
+			self.entries[key] = record
+			self._append(record)
+		self._write_sidecar(file_to_use, record)
+		return record
+
+	def remove(self, file_to_use, unlink=True, entry=None):
+		"""
+		forgets an object (and deletes its file). with entry given, only if that
+		record is still the current one, so a newer copy is never thrown away
+		"""
+		key = self.key_for(file_to_use)
+		with self.lock:
+			current = self.entries.get(key)
+			if current is None or (entry is not None and current is not entry):
+				return
+			del self.entries[key]
+			self._append({"key": key, "removed": True})
+		if unlink:
+			for path in [file_to_use, file_to_use + META_SUFFIX] + [file_to_use + suffix for suffix in VARIANT_SUFFIXES]:
+				try:
+					os.unlink(path)
+				except FileNotFoundError:
+					pass
+			self.blobs.release(current.get("blob"))
+
+	def validate(self):
+		"""
+		drops truncated/missing objects and deletes orphaned files and blobs, returns (dropped, orphans).
+		with --workers the others are serving while it runs, an object they
+		replaced since the index was loaded is told apart by its sidecar
+		"""
+		dropped = 0
+		for key, entry in list(self.entries.items()):
+			if entry["stored"] >= self.booted:
+				continue # published by this run
+			file_to_use = os.path.join(self.directory, key)
+			try:
+				size = os.stat(file_to_use).st_size
+			except FileNotFoundError:
+				size = None
+			if size == entry["size"]:
+				continue
+			record = self.read_sidecar(file_to_use)
+			if record is not None and record["stored"] >= self.booted:
+				continue # another worker published it, maybe it is being renamed into place right now
+			if size is not None and record is not None and record.get("size") == size:
+				# the file and its current metadata agree, only our record was old
+				with self.lock:
+					if self.entries.get(key) is entry:
+						self.entries[key] = record
+				continue
+			self.remove(file_to_use, entry=entry)
+			dropped += 1
+
+		orphans = 0
+		for root, dirs, files in os.walk(self.directory):
+			if os.path.normpath(root) == os.path.normpath(self.directory) and blobstore.BLOB_DIRECTORY in dirs:
+				dirs.remove(blobstore.BLOB_DIRECTORY) # after the objects, their links count
+			for name in files:
+				file_to_use = os.path.join(root, name)
+				key = os.path.relpath(file_to_use, self.directory)
+				if os.path.normpath(root) == os.path.normpath(self.directory) and name.startswith(INDEX_FILE):
+					continue
+				for suffix in (META_SUFFIX,) + VARIANT_SUFFIXES:
+					if name.endswith(suffix):
+						key = key[:-len(suffix)]
+						break
+				if key not in self.entries and not self._written_since_boot(file_to_use) and not self._published_since_boot(key):
+					try:
+						os.unlink(file_to_use)
+						orphans += 1
+					except FileNotFoundError:
+						pass
+		orphans += self.blobs.collect(self.booted)
+		return dropped, orphans
+
+	def _written_since_boot(self, file_to_use):
+		"""
+		temp files of live leaders and objects that are being published right
+		now are not indexed (yet) either, leave them alone
+		"""
+		try:
+			return os.stat(file_to_use).st_mtime >= self.booted
+		except FileNotFoundError:
+			return True
+
+	def _published_since_boot(self, key):
+		"""
+		an object another worker published links an older blob, its own mtime
+		can be from before the boot (blobstore.py). its sidecar is not
+		"""
+		record = self.read_sidecar(os.path.join(self.directory, key))
+		return record is not None and record["stored"] >= self.booted
+
+	def validate_in_background(self):
+
+		def run():
+			start = time.monotonic()
+			dropped, orphans = self.validate()
+			print("cache index validated in %.2fs: %d truncated/missing objects dropped, %d orphaned files and blobs deleted" % (
+				time.monotonic() - start, dropped, orphans))
+
+		t = threading.Thread(target=run, name="cache-index-validate", daemon=True)
+		t.start()
+		return t
@@ -0,0 +1,282 @@
+# helpers shared by the threaded (proxy.py) and asyncio (aioproxy.py) engines
+
+import hashlib
+import os
+import shutil
+
+import cacheindex
+import freshness
+import httpparse
+import ranges
+
+cache_directory = "./cache/"
+# fan-out directories already created by cache_file_for
+_made_directories = set()
+
+
+def reset_cache_directory():
+	"""
+	creates the cache directory, wiping whatever a previous run left behind
+	"""
+	if not os.path.exists(cache_directory):
+		os.makedirs(cache_directory)
+	else: # Clear cache
+		print("wiping cache.....")
+		shutil.rmtree(cache_directory)
+		os.makedirs(cache_directory)
+		print("Done.")
+
+
+def open_cache(keep, validate=True):
+	"""
+	prepares the cache directory and returns its index. keep=False wipes it like
+	the lab requires, keep=True warm-restarts from the index of the previous run.
+	validate=False leaves starting index.validate_in_background() to the caller
+	"""
+	index = cacheindex.CacheIndex(cache_directory)
+	if keep and os.path.exists(cache_directory):
+		print("loading cache index.....")
+		print("Done,", index.load(), "cached objects.")
+		if validate:
+			index.validate_in_background()
+	else:
+		reset_cache_directory()
+	index.open_log()
+	return index
+
+
+def parse_size(text):
+	"""
+	"4096", "64K", "32M", "1G" -> number of bytes, for the command line
+	"""
+	text = str(text).strip().upper()
+	units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+	if text and text[-1] in units:
+		return int(float(text[:-1]) * units[text[-1]])
+	return int(text)
+
+
+def parse_request(request):
+	"""
+	returns (webServer, resource) for a supported request, None otherwise
+	(CONNECT tunnels and requests without a Host). request is a
+	httpparse.RequestParser that has read the whole head, whether the cache
+	gets involved is up to admission.request_cacheable
+
+	Assume the HTTP request is in the format of:
+	   GET http://www.mit.edu/ HTTP/1.1\r\n
+	   Host: www.mit.edu\r\n
+	   User-Agent: .....
+	   Accept:  ......
+	"""
+	if request.method == 'CONNECT' or 'host' not in request.headers:
+		return None
+
+	#   webServer: the web server's host name
+	#   resource: the web resource requested
+	resource = request.target.replace("http://","", 1)
+	webServer = request.headers['host']
+	return webServer, resource
+
+
+def stale_entry(index, file_to_use, request):
+	"""
+	the index record of a cached object that has to be revalidated before it is
+	served again, None if nothing is cached or the cached copy is still fresh
+	"""
+	entry = index.get(file_to_use) if index is not None else None
+	if entry is None:
+		return None
+	if freshness.client_wants_revalidation(request.headers):
+		return entry
+	if freshness.is_fresh(entry):
+		return None
+	# with --workers another process may have revalidated it already
+	entry = index.reload(file_to_use)
+	if entry is None or freshness.is_fresh(entry):
+		return None
+	return entry
+
+
+def client_response_head(head, keepAlive):
+	"""
+	the stored response head with the origin's connection headers replaced by ours
+	"""
+	lines = head.rstrip(b"\r\n").split(b"\r\n")
+	keep = [lines[0]]
+	for line in lines[1:]:
+		if line.split(b":", 1)[0].strip().lower() not in (b"connection", b"keep-alive", b"proxy-connection"):
+			keep.append(line)
+	keep.append(b"Connection: keep-alive" if keepAlive else b"Connection: close")
+	return b"\r\n".join(keep) + b"\r\n\r\n"
+
+
+class ResponseRewriter:
+	"""
+	sits between a raw stored/relayed response and the client: rewrites the
+	connection headers once the head is complete and stops at the end of the
+	response. keep_alive() tells whether the client connection can serve
+	another request afterwards. every byte for the client is counted in
+	exchange (a metrics.Exchange), if there is one. with rangeRequest (a
+	ranges.RangeRequest) only the requested byte ranges of the body are sent
+	"""
+	def __init__(self, keepAlive, method="GET", exchange=None, rangeRequest=None):
+		self.keepAlive = keepAlive
+		self.framer = httpparse.ResponseFramer(method)
+		self.pending = b""
+		self.exchange = exchange
+		self.range_request = rangeRequest
+		self.plan = None # a ranges.RangePlan once the head is in, None sends the whole response
+
+	def feed(self, data):
+		"""
+		returns the bytes to send to the client for this piece of the response
+		"""
+		out = self._rewrite(data)
+		if self.exchange is not None:
+			self.exchange.wrote(len(out))
+		return out
+
+	def _rewrite(self, data):
+		offset = self.framer.offset
+		used = self.framer.feed(data)
+		if self.pending is None:
+			if self.plan is not None:
+				return self.plan.take(data[:used], offset - self.framer.head_end)
+			return data[:used]
+		self.pending += data[:used]
+		if self.framer.status is None:
+			return b""
+		# the client can only find the end of the body if the origin framed it
+		self.keepAlive = self.keepAlive and not self.framer.until_close
+		headStart = self.framer.head_end - len(self.framer.head)
+		head = self.framer.head
+		body = self.pending[self.framer.head_end:]
+		if self.range_request is not None:
+			self.plan = self.range_request.plan(self.framer.status, self.framer.headers)
+		if self.plan is not None:
+			head = self.plan.head(head)
+			body = self.plan.take(body, 0)
+		out = self.pending[:headStart] + client_response_head(head, self.keepAlive) + body
+		self.pending = None
+		return out
+
+	def feed_head(self, f):
+		"""
+		feeds a stored response from f until its head is complete, returns the
+		bytes to send for it (possibly with the start of the body). the rest of
+		the file from self.framer.offset on is body, see file_pieces()
+		"""
+		out = b""
+		while not self.framer.head_complete:
+			buff = f.read(4096)
+			if not buff:
+				break
+			out += self.feed(buff)
+		return out
+
+	def file_pieces(self, size):
+		"""
+		after feed_head(), what is left to send of a stored, complete response
+		of size bytes without passing it through feed() (sendfile): bytes to
+		send as they are, or (offset, count) of the file. the response is over
+		after the last one
+		"""
+		offset = self.framer.offset
+		if self.plan is not None:
+			bodyStart = self.framer.head_end
+			pieces = [piece if isinstance(piece, bytes) else (bodyStart + piece[0], piece[1])
+				for piece in self.plan.rest(offset - bodyStart)]
+		else:
+			pieces = [(offset, size - offset)] if offset < size and not self.framer.done else []
+		for piece in pieces:
+			yield piece
+			if self.exchange is not None:
+				self.exchange.wrote(len(piece) if isinstance(piece, bytes) else piece[1])
+		self.framer.offset = size
+		self.framer.done = True
+
+	def skipped(self, n):
+		"""
+		n bytes of the body reached the client without passing through feed()
+		(zerocopy.relay), only for a whole response without a range plan
+		"""
+		self.framer.skipped(n)
+		if self.exchange is not None:
+			self.exchange.wrote(n)
+
+	def keep_alive(self):
+		return self.keepAlive and self.framer.done
+
+
+class StoredResponse:
+	"""
+	the response cached in the open file f for the object with the index
+	record entry. a body shared with other URLs (blobstore.py) may sit behind
+	another response's head: this one's own head is then read first, from the
+	record, and the body from body_offset on. read() and size are those of
+	the response, file_offset() maps an offset in it to one in f (sendfile)
+	"""
+	def __init__(self, f, entry=None):
+		self.f = f
+		head = entry.get("head") if entry is not None else None
+		self.head = head.encode("latin-1") if head is not None else b""
+		self.shift = entry["body_offset"] - len(self.head) if head is not None else 0
+		self.size = os.fstat(f.fileno()).st_size - self.shift
+		if head is not None:
+			f.seek(entry["body_offset"])
+
+	def read(self, n=-1):
+		if not self.head:
+			return self.f.read(n)
+		out = self.head if n < 0 else self.head[:n]
+		self.head = self.head[len(out):]
+		return out + self.f.read() if n < 0 else out
+
+	def file_offset(self, offset):
+		return offset + self.shift
+
+
+def read_stored(f):
+	"""
+	the response stored in the open cache file f, as (framer, body) with the
+	body's chunked framing removed. framer.done is False if the file ends
+	before the response does
+	"""
+	body = []
+	stored = httpparse.ResponseFramer(on_body=body.append)
+	while not stored.done:
+		buff = f.read(65536)
+		if not buff:
+			stored.eof()
+			break
+		stored.feed(buff)
+	return stored, b"".join(body)
+
+
+def cache_key(webServer, resource):
+	"""
+	the normalized URL an object is cached under: lower-case host, no default
+	port, no fragment. ("Example.com:80", "Example.com:80/a/b.c#top") -> "http://example.com/a/b.c"
+	"""
+	host = webServer.strip().lower()
+	if host.endswith(":80"):
+		host = host[:-3]
+	slash = resource.find("/")
+	path = resource[slash:] if slash >= 0 else "/"
+	return "http://" + host + path.split("#", 1)[0]
+
+
+def cache_file_for(url):
+	"""
+	where the object for a normalized URL (cache_key) is cached:
+	cache/<h[0:2]>/<h[2:4]>/<h> with h the sha256 of the URL. any URL, however
+	long or odd, gets a valid and distinct file name, and the two levels of
+	256 directories keep each directory small with millions of objects
+	"""
+	digest = hashlib.sha256(url.encode("latin-1", "replace")).hexdigest()
+	directory = os.path.join(cache_directory, digest[:2], digest[2:4])
+	if directory not in _made_directories:
+		os.makedirs(directory, exist_ok=True)
+		_made_directories.add(directory)
+	return os.path.join(directory, digest)
@@ -0,0 +1,272 @@
+# compressed copies of cached text objects for clients that accept them
+
+import gzip
+import os
+import threading
+from collections import OrderedDict
+
+import common
+import eventlog
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+"""
+Origins often send text uncompressed. The cache stores the identity response
+as it came (misses are fetched with Accept-Encoding: identity, see
+freshness.conditional_request) and, the first time a client that accepts an
+encoding hits an eligible object, a background thread compresses the body
+once into a copy next to it:
+
+	cache/3f/a2/3fa2...        the identity response
+	cache/3f/a2/3fa2....gz     gzip
+	cache/3f/a2/3fa2....br     brotli, if the brotli module is installed
+	cache/3f/a2/3fa2....zst    zstd, if the zstandard module is installed
+
+A copy is a whole stored response like the object itself (Content-Encoding,
+its own Content-Length, Vary: Accept-Encoding, the ETag with -<encoding>
+appended), so it is served by the normal disk/memory tier code, sendfile and
+Range requests included. The request that triggers the build gets the
+identity copy, later ones get the compressed one.
+
+Eligible: a 200 of a text-like Content-Type (COMPRESSIBLE_TYPES) between
+MIN_SIZE and MAX_SIZE bytes, without Content-Encoding or Cache-Control:
+no-transform. A copy carries the modification time of the object it was
+made from and is only served while the object still has it, so an object
+replaced by a new fetch gets new copies.
+"""
+
+# proxy.py clears this with --no-compression
+enabled = True
+
+# below this a compressed body barely gets smaller than its headers
+MIN_SIZE = 1024
+# the body is compressed in memory
+MAX_SIZE = 16 * 1024 * 1024
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+ZSTD_LEVEL = 19
+# compressions running at a time, a hit that would start one more just gets the identity copy
+MAX_BUILDS = 2
+# objects remembered as not getting smaller, least recently checked ones are forgotten first
+MAX_INCOMPRESSIBLE = 10000
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/x-javascript", "application/json",
+	"application/xml", "application/xhtml+xml", "application/rss+xml", "application/atom+xml", "image/svg+xml")
+
+
+def _gzip(data):
+	# mtime=0: the same body always gives the same bytes
+	return gzip.compress(data, GZIP_LEVEL, mtime=0)
+
+
+# encoding -> (file suffix, compress function), most preferred first
+ENCODINGS = {}
+if brotli is not None:
+	ENCODINGS["br"] = (".br", lambda data: brotli.compress(data, quality=BROTLI_QUALITY))
+if zstandard is not None:
+	ENCODINGS["zstd"] = (".zst", lambda data: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data))
+ENCODINGS["gzip"] = (".gz", _gzip)
+
+_lock = threading.Lock()
+_building = set() # (file_to_use, encoding) being compressed right now
+_slots = threading.BoundedSemaphore(MAX_BUILDS)
+_incompressible = OrderedDict() # (file_to_use, encoding) -> mtime of the version that did not get smaller
+
+
+def accepted(value):
+	"""
+	"gzip, br;q=0.8, *;q=0" -> {"gzip": 1.0, "br": 0.8, "*": 0.0}
+	"""
+	codings = {}
+	for item in value.split(","):
+		name, _, params = item.partition(";")
+		name = name.strip().lower()
+		if not name:
+			continue
+		q = 1.0
+		for param in params.split(";"):
+			key, _, number = param.partition("=")
+			if key.strip().lower() == "q":
+				try:
+					q = float(number)
+				except ValueError:
+					q = 0.0
+		codings[name] = q
+	return codings
+
+
+def eligible(entry):
+	"""
+	whether an object (its index record) is worth keeping compressed copies of
+	"""
+	if entry.get("status") != 200 or (entry.get("content_encoding") or "identity").lower() != "identity":
+		return False
+	if not MIN_SIZE <= entry.get("size", 0) <= MAX_SIZE:
+		return False
+	contentType = (entry.get("content_type") or "").split(";", 1)[0].strip().lower()
+	if not contentType.startswith(COMPRESSIBLE_TYPES):
+		return False
+	return "no-transform" not in (entry.get("cache_control") or "").lower()
+
+
+def negotiate(entry, headers):
+	"""
+	the encoding to send a cached object in for a request with these (lower-cased)
+	headers, None for the stored identity copy
+	"""
+	value = headers.get("accept-encoding")
+	if not enabled or not value or entry is None or not eligible(entry):
+		return None
+	codings = accepted(value)
+	best, bestQ = None, 0.0
+	for name in ENCODINGS:
+		q = codings.get(name, codings.get("*", 0.0))
+		if q > bestQ:
+			best, bestQ = name, q
+	# identity is acceptable unless the client says otherwise, and wins if it prefers it
+	if best is not None and codings.get("identity", 0.0) > bestQ:
+		return None
+	return best
+
+
+def variant_path(file_to_use, encoding):
+	return file_to_use + ENCODINGS[encoding][0]
+
+
+def variant_paths(file_to_use):
+	return [file_to_use + suffix for suffix, _ in ENCODINGS.values()]
+
+
+def open_variant(file_to_use, encoding, entry=None):
+	"""
+	the compressed copy of an object opened for reading, None if there is none
+	(yet) or it was made from an older version of the object. a build is then
+	started in the background. entry: the object's index record
+	"""
+	try:
+		f = open(variant_path(file_to_use, encoding), "rb")
+	except FileNotFoundError:
+		schedule(file_to_use, encoding, entry)
+		return None
+	try:
+		current = os.fstat(f.fileno()).st_mtime_ns == os.stat(file_to_use).st_mtime_ns
+	except FileNotFoundError:
+		current = False
+	if not current:
+		f.close()
+		schedule(file_to_use, encoding, entry)
+		return None
+	return f
+
+
+def schedule(file_to_use, encoding, entry=None):
+	with _lock:
+		if (file_to_use, encoding) in _building or not _slots.acquire(blocking=False):
+			return
+		_building.add((file_to_use, encoding))
+	t = threading.Thread(target=_build_and_release, args=(file_to_use, encoding, entry), name="compress", daemon=True)
+	t.start()
+
+
+def _build_and_release(file_to_use, encoding, entry):
+	try:
+		build(file_to_use, encoding, entry)
+	except:
+		eventlog.exception("compress_failed", file=file_to_use, encoding=encoding)
+	finally:
+		with _lock:
+			_building.discard((file_to_use, encoding))
+		_slots.release()
+
+
+def _known_incompressible(file_to_use, encoding, mtime):
+	"""
+	True if this version of the object was compressed before and did not get
+	smaller. a replaced object (another mtime) is tried again
+	"""
+	with _lock:
+		if _incompressible.get((file_to_use, encoding)) != mtime:
+			return False
+		_incompressible.move_to_end((file_to_use, encoding))
+		return True
+
+
+def build(file_to_use, encoding, entry=None):
+	"""
+	compresses the body of a stored response into its variant file, returns its
+	path or None if the object is gone, not a whole 200 or does not get smaller.
+	entry: the object's index record, needed if its body is shared (blobstore.py)
+	"""
+	suffix, compress = ENCODINGS[encoding]
+	try:
+		f = open(file_to_use, "rb")
+	except FileNotFoundError:
+		return None
+	with f:
+		stat = os.fstat(f.fileno())
+		if _known_incompressible(file_to_use, encoding, stat.st_mtime_ns):
+			return None
+		if entry is not None and entry.get("size") != stat.st_size:
+			return None # replaced since the record was read, a later hit tries again
+		stored, data = common.read_stored(common.StoredResponse(f, entry))
+	if not stored.done or stored.status != 200:
+		return None
+	packed = compress(data)
+	if len(packed) >= len(data):
+		with _lock:
+			_incompressible[(file_to_use, encoding)] = stat.st_mtime_ns
+			_incompressible.move_to_end((file_to_use, encoding))
+			if len(_incompressible) > MAX_INCOMPRESSIBLE:
+				_incompressible.popitem(last=False)
+		return None
+
+	path = file_to_use + suffix
+	# per process, workers may compress the same object at the same time
+	tmp_path = "%s.%d.tmp" % (path, os.getpid())
+	with open(tmp_path, "wb") as out:
+		out.write(variant_head(stored.head, encoding, len(packed)))
+		out.write(packed)
+	# ties the copy to this version of the object, see open_variant
+	os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+	os.replace(tmp_path, path)
+	eventlog.debug("compressed", file=file_to_use, encoding=encoding, size=len(data), compressed=len(packed))
+	return path
+
+
+def variant_etag(etag, encoding):
+	"""
+	a different body needs a different entity tag: "abc" -> "abc-gzip"
+	"""
+	if not etag.endswith(b'"'):
+		return etag
+	return etag[:-1] + b"-" + encoding.encode("latin-1") + b'"'
+
+
+def variant_head(head, encoding, length):
+	"""
+	the stored identity head rewritten for a body compressed with encoding
+	"""
+	lines = head.rstrip(b"\r\n").split(b"\r\n")
+	keep = [lines[0]]
+	vary = []
+	for line in lines[1:]:
+		name, _, value = line.partition(b":")
+		name = name.strip().lower()
+		if name in (b"content-length", b"transfer-encoding", b"content-encoding", b"trailer"):
+			continue
+		if name == b"vary":
+			vary.append(value.strip())
+			continue
+		if name == b"etag":
+			line = b"ETag: " + variant_etag(value.strip(), encoding)
+		keep.append(line)
+	keep.append(b"Vary: " + b", ".join(vary + [b"Accept-Encoding"]))
+	keep.append(b"Content-Encoding: " + encoding.encode("latin-1"))
+	keep.append(b"Content-Length: %d" % length)
+	return b"\r\n".join(keep) + b"\r\n\r\n"
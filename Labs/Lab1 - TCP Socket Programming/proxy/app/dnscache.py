@@ -0,0 +1,199 @@
+# resolver cache for origin host names, shared by both engines
+
+import asyncio
+import ipaddress
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import eventlog
+
+"""
+Every new upstream connection used to resolve the origin's name with a
+blocking getaddrinfo() (socket.create_connection does it internally), in
+the client's thread or, for asyncio, on the loop's default executor. Here
+the answers are kept per host name:
+
+	- a name resolves to its addresses for ttl seconds (--dns-ttl). the
+	  system resolver does not tell us the record TTLs, so it is a setting
+	- a failure is remembered for negative_ttl seconds (--dns-negative-ttl),
+	  a typo'd host does not cost a lookup per request
+	- a name that is used at least POPULAR_HITS times and is in the last
+	  REFRESH_AHEAD of its ttl is looked up again on a background thread, its
+	  users never wait for it to expire
+	- concurrent misses for the same name wait for one lookup
+	- IP literals (127.0.0.1, ::1) are never looked up
+
+resolve() is for the threaded engine. resolve_async() runs the lookup on an
+executor thread, never on the event loop, and answers from the cache without
+leaving the loop at all.
+"""
+
+DEFAULT_TTL = 60.0
+DEFAULT_NEGATIVE_TTL = 5.0
+MAX_ENTRIES = 1024
+# fraction of the ttl at the end of which a popular name is refreshed ahead of time
+REFRESH_AHEAD = 0.2
+POPULAR_HITS = 2
+# a lookup that another thread is already doing is waited for at most this long
+LOOKUP_TIMEOUT = 10.0
+
+
+class DnsEntry:
+	"""
+	the answer for one host name: addresses (family, type, proto, (ip, port, ...))
+	with port 0, or the error of a failed lookup
+	"""
+	def __init__(self, addresses, error, ttl):
+		self.addresses = addresses
+		self.error = error
+		self.expires = time.monotonic() + ttl
+		self.ttl = ttl
+		self.hits = 0
+		self.refreshing = False
+
+
+def ip_literal(host):
+	try:
+		ipaddress.ip_address(host)
+		return True
+	except ValueError:
+		return False
+
+
+def with_port(addresses, port):
+	return [(family, socktype, proto, (sockaddr[0], port) + tuple(sockaddr[2:]))
+		for family, socktype, proto, sockaddr in addresses]
+
+
+class Resolver:
+
+	def __init__(self, ttl=DEFAULT_TTL, negativeTtl=DEFAULT_NEGATIVE_TTL, maxEntries=MAX_ENTRIES):
+		self.ttl = ttl
+		self.negative_ttl = negativeTtl
+		self.max_entries = maxEntries
+		self.entries = OrderedDict() # host -> DnsEntry, least recently used first
+		self.pending = {} # host -> threading.Event of the lookup in progress
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.lookups = 0
+		self.refreshes = 0
+		self.failures = 0
+
+	def resolve(self, host, port):
+		"""
+		[(family, type, proto, sockaddr)] to connect to, raises socket.gaierror
+		if the name does not resolve. may block for a lookup
+		"""
+		if ip_literal(host):
+			return self._numeric(host, port)
+		entry = self._cached(host)
+		if entry is None:
+			entry = self._lookup(host)
+		return self._answer(entry, port)
+
+	async def resolve_async(self, host, port):
+		"""
+		resolve() for a coroutine, a lookup happens on the loop's default executor
+		"""
+		if ip_literal(host):
+			return self._numeric(host, port)
+		entry = self._cached(host)
+		if entry is None:
+			entry = await asyncio.get_running_loop().run_in_executor(None, self._lookup, host)
+		return self._answer(entry, port)
+
+	def _numeric(self, host, port):
+		return [(family, socktype, proto, sockaddr) for family, socktype, proto, _, sockaddr in
+			socket.getaddrinfo(host, port, type=socket.SOCK_STREAM, flags=socket.AI_NUMERICHOST)]
+
+	def _cached(self, host):
+		"""
+		the unexpired entry for host, None if it has to be looked up. starts the
+		refresh of a popular name that is about to expire
+		"""
+		now = time.monotonic()
+		with self.lock:
+			entry = self.entries.get(host)
+			if entry is None or now >= entry.expires:
+				return None
+			self.entries.move_to_end(host)
+			self.hits += 1
+			entry.hits += 1
+			refresh = (entry.error is None and not entry.refreshing and entry.hits >= POPULAR_HITS
+				and now >= entry.expires - entry.ttl * REFRESH_AHEAD)
+			if refresh:
+				entry.refreshing = True
+		if refresh:
+			threading.Thread(target=self._refresh, args=(host, entry), name="dns-refresh", daemon=True).start()
+		return entry
+
+	def _answer(self, entry, port):
+		if entry.error is not None:
+			raise socket.gaierror(*entry.error.args)
+		return with_port(entry.addresses, port)
+
+	def _query(self, host):
+		start = time.monotonic()
+		try:
+			infos = socket.getaddrinfo(host, 0, type=socket.SOCK_STREAM)
+		except (OSError, UnicodeError) as e:
+			# UnicodeError: a name the idna codec refuses, as good as unknown
+			self.failures += 1
+			eventlog.warning("dns_failed", host=host, error=str(e))
+			error = e if isinstance(e, socket.gaierror) else socket.gaierror(socket.EAI_NONAME, str(e))
+			return DnsEntry(None, error, self.negative_ttl)
+		addresses = [(family, socktype, proto, sockaddr) for family, socktype, proto, _, sockaddr in infos]
+		eventlog.debug("dns_lookup", host=host, addresses=len(addresses), seconds=round(time.monotonic() - start, 4))
+		return DnsEntry(addresses, None, self.ttl)
+
+	def _store(self, host, entry):
+		# called with the lock held
+		self.entries[host] = entry
+		self.entries.move_to_end(host)
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+
+	def _lookup(self, host):
+		"""
+		looks host up, or waits for the lookup another thread is doing already
+		"""
+		with self.lock:
+			done = self.pending.get(host)
+			leader = done is None
+			if leader:
+				done = self.pending[host] = threading.Event()
+		if not leader:
+			done.wait(LOOKUP_TIMEOUT)
+			with self.lock:
+				entry = self.entries.get(host)
+			if entry is not None:
+				return entry
+		self.lookups += 1
+		entry = self._query(host)
+		with self.lock:
+			self._store(host, entry)
+			if leader:
+				del self.pending[host]
+		if leader:
+			done.set()
+		return entry
+
+	def _refresh(self, host, old):
+		"""
+		background lookup of a popular name. a failure keeps the old addresses
+		until they expire, the next request then tries in the foreground
+		"""
+		self.refreshes += 1
+		entry = self._query(host)
+		with self.lock:
+			if entry.error is None:
+				self._store(host, entry)
+			old.refreshing = False
+
+	def stats_line(self):
+		with self.lock:
+			names = len(self.entries)
+		return "dns cache: %d hits, %d lookups, %d refreshes, %d failures, %d names" % (
+			self.hits, self.lookups, self.refreshes, self.failures, names)
@@ -0,0 +1,147 @@
+# leveled, structured logging that stays off the request path
+
+import json
+import sys
+import time
+
+import batchwriter
+
+"""
+The proxy used to print() a handful of lines per request. Under `python -u`
+every print is a write() to the pipe into `ts`, made while holding the stdout
+lock that every client thread shares. Here a request thread only appends a
+tuple to a bounded queue and a background thread formats and writes what has
+piled up, once every FLUSH_INTERVAL, in a single write() (batchwriter.py):
+
+	eventlog.info("cache_hit", tier="disk", url=url)
+	-> 2026-10-18T13:14:06.123 info cache_hit tier=disk url=http://127.0.0.1/a.gif
+
+	- debug/info/warning/error drop records below the configured level with
+	  one comparison, nothing is formatted or queued for them
+	- sampled() is for events that happen on every request: with a rate of
+	  0.01 only every 100th of each event is queued (and says sampled=100)
+	- a full queue drops records instead of blocking, the number of dropped
+	  records is written with the next batch
+	- --log-format json writes one JSON object per line instead
+
+Startup and shutdown messages still use print(), they are not on any hot path.
+"""
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
+# proxy.py sets these from --log-level, --log-sample and --log-format
+level = INFO
+sample_every = 1
+json_format = False
+
+QUEUE_SIZE = 10000
+FLUSH_INTERVAL = 0.05
+
+_counts = {} # event -> how many times sampled() saw it
+
+
+def _emit(lvl, event, fields):
+	_writer.put((time.time(), lvl, event, fields))
+
+
+def debug(event, **fields):
+	if level <= DEBUG:
+		_emit(DEBUG, event, fields)
+
+
+def info(event, **fields):
+	if level <= INFO:
+		_emit(INFO, event, fields)
+
+
+def warning(event, **fields):
+	if level <= WARNING:
+		_emit(WARNING, event, fields)
+
+
+def error(event, **fields):
+	if level <= ERROR:
+		_emit(ERROR, event, fields)
+
+
+def exception(event, **fields):
+	"""
+	error() with the exception being handled, in place of print(sys.exc_info()[0])
+	"""
+	if level <= ERROR:
+		kind, value = sys.exc_info()[:2]
+		fields["error"] = kind.__name__ if kind is not None else None
+		if value is not None and str(value):
+			fields["detail"] = str(value)
+		_emit(ERROR, event, fields)
+
+
+def sampled(lvl, event, **fields):
+	"""
+	a high-rate event, only every sample_every-th one per event name is kept
+	"""
+	if level > lvl:
+		return
+	if sample_every > 1:
+		# unlocked, a lost increment only shifts which record gets picked
+		n = _counts.get(event, 0) + 1
+		_counts[event] = n
+		if n % sample_every:
+			return
+		fields["sampled"] = sample_every
+	_emit(lvl, event, fields)
+
+
+def _text_value(value):
+	value = str(value)
+	if not value or any(c in value for c in ' "=\n'):
+		return json.dumps(value)
+	return value
+
+
+def format_record(record):
+	when, lvl, event, fields = record
+	stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(when)) + ".%03d" % (when % 1 * 1000)
+	if json_format:
+		return json.dumps(dict(time=stamp, level=LEVEL_NAMES[lvl], event=event, **fields), default=str)
+	parts = [stamp, LEVEL_NAMES[lvl], event]
+	parts.extend("%s=%s" % (name, _text_value(value)) for name, value in fields.items())
+	return " ".join(parts)
+
+
+def _dropped_line(count):
+	return format_record((time.time(), WARNING, "log_records_dropped", {"count": count}))
+
+
+def _write(text):
+	sys.stdout.write(text)
+	sys.stdout.flush()
+
+
+_writer = batchwriter.BatchWriter("eventlog-writer", format_record, _write, _dropped_line, QUEUE_SIZE, FLUSH_INTERVAL)
+
+
+def flush():
+	"""
+	writes out everything queued so far, returns how many records that was
+	"""
+	return _writer.flush()
+
+
+def start():
+	"""
+	starts the writer thread. in --workers mode every worker starts its own after the fork
+	"""
+	_writer.start()
+
+
+def close(timeout=1.0):
+	"""
+	writes out what is still queued and stops the writer
+	"""
+	_writer.close(timeout)
@@ -0,0 +1,137 @@
+# HTTP freshness and revalidation of cached objects (RFC 9111 section 4)
+
+import time
+from email.utils import parsedate_to_datetime
+
+import admission
+
+"""
+The index (cacheindex.py) keeps the headers of every cached response that
+decide how long it may be served without asking the origin again:
+
+	- lifetime: s-maxage or max-age of Cache-Control, else Expires - Date,
+	  else a heuristic (a tenth of the time since Last-Modified, capped at a
+	  day, and never less than default_ttl). no-cache means lifetime 0
+	- age: the Age header when it was stored plus the time since then
+
+A stale object with an ETag or Last-Modified is revalidated with
+If-None-Match / If-Modified-Since. A 304 only refreshes the index record and
+the cached body is served, anything else replaces the object like a miss.
+Stale objects without validators are simply fetched again. A client asking
+for Cache-Control: no-cache (a browser reload) gets a revalidated copy.
+"""
+
+HEURISTIC_FRACTION = 0.1
+MAX_HEURISTIC_LIFETIME = 24 * 3600
+# seconds a response is fresh when it says nothing about freshness, proxy.py sets --default-ttl
+default_ttl = 300.0
+
+
+def parse_http_date(value):
+	"""
+	"Sun, 06 Nov 1994 08:49:37 GMT" -> unix time, None if missing or invalid
+	"""
+	if not value:
+		return None
+	try:
+		return parsedate_to_datetime(value).timestamp()
+	except (TypeError, ValueError, IndexError, OverflowError):
+		return None
+
+
+def cache_directives(value):
+	"""
+	"max-age=60, no-cache" -> {"max-age": "60", "no-cache": None}
+	"""
+	directives = {}
+	for part in (value or "").split(","):
+		name, sep, arg = part.strip().partition("=")
+		if name:
+			directives[name.lower()] = arg.strip().strip('"') if sep else None
+	return directives
+
+
+def _seconds(value):
+	try:
+		return max(0, int(value))
+	except (TypeError, ValueError):
+		return None
+
+
+def freshness_lifetime(entry):
+	lifetime = _lifetime(entry)
+	if entry.get("status") in admission.NEGATIVE_STATUSES:
+		# negative caching, never longer than the configured TTL
+		return min(lifetime, admission.negative_ttl)
+	return lifetime
+
+
+def _lifetime(entry):
+	directives = cache_directives(entry.get("cache_control"))
+	if "no-cache" in directives:
+		return 0
+	for name in ("s-maxage", "max-age"):
+		if name in directives and _seconds(directives[name]) is not None:
+			return _seconds(directives[name])
+
+	date = parse_http_date(entry.get("date")) or entry["stored"]
+	if entry.get("expires") is not None:
+		expires = parse_http_date(entry["expires"])
+		# an invalid Expires (e.g. "0") means already expired
+		return max(0, expires - date) if expires is not None else 0
+
+	lastModified = parse_http_date(entry.get("last_modified"))
+	heuristic = 0
+	if lastModified is not None and lastModified < date:
+		heuristic = min((date - lastModified) * HEURISTIC_FRACTION, MAX_HEURISTIC_LIFETIME)
+	return max(heuristic, default_ttl)
+
+
+def current_age(entry, now=None):
+	now = time.time() if now is None else now
+	date = parse_http_date(entry.get("date"))
+	apparentAge = max(0, entry["stored"] - date) if date is not None else 0
+	initialAge = max(apparentAge, _seconds(entry.get("age")) or 0)
+	return initialAge + max(0, now - entry["stored"])
+
+
+def is_fresh(entry, now=None):
+	return current_age(entry, now) < freshness_lifetime(entry)
+
+
+def has_validators(entry):
+	return bool(entry.get("etag") or entry.get("last_modified"))
+
+
+def client_wants_revalidation(headers):
+	"""
+	Cache-Control: no-cache / max-age=0 or Pragma: no-cache on the request
+	"""
+	directives = cache_directives(headers.get("cache-control"))
+	if "no-cache" in directives or directives.get("max-age") == "0":
+		return True
+	return "cache-control" not in headers and "no-cache" in headers.get("pragma", "").lower()
+
+
+def conditional_request(head, entry=None):
+	"""
+	the upstream request head with our own validators (of entry, the index
+	record of the stale copy) instead of the client's. without entry the
+	client's are just dropped: we need the full response to cache it. for
+	the same reason a Range is not passed on (ranges.py cuts it out locally),
+	and the body is asked for uncompressed: it is stored once for every client,
+	compression.py makes the compressed copies
+	"""
+	lines = head.rstrip(b"\r\n").split(b"\r\n")
+	keep = [lines[0]]
+	for line in lines[1:]:
+		if line.split(b":", 1)[0].strip().lower() not in (b"if-none-match", b"if-modified-since", b"range", b"if-range",
+				b"accept-encoding"):
+			keep.append(line)
+	keep.append(b"Accept-Encoding: identity")
+	entry = entry or {}
+	if entry.get("etag"):
+		keep.append(b"If-None-Match: " + entry["etag"].encode("latin-1"))
+	if entry.get("last_modified"):
+		keep.append(b"If-Modified-Since: " + entry["last_modified"].encode("latin-1"))
+	return b"\r\n".join(keep) + b"\r\n\r\n"
@@ -0,0 +1,118 @@
+# in-memory hot object tier in front of the disk cache
+
+import threading
+from collections import OrderedDict
+
+"""
+Small, popular objects (the GIFs on the microscape page) are served straight
+from RAM instead of reopening and reading cache/<host>/<file> on every hit.
+
+	- an object is promoted from disk to memory on its promote_after-th disk hit
+	- the memory tier holds at most max_bytes, least recently used objects are
+	  dropped first (the disk copy stays, so a demoted object is just a disk hit)
+	- objects bigger than max_object_bytes never go to memory
+
+Counters for both tiers are kept so the hit ratio of each can be compared.
+"""
+
+# how many keys we remember disk hit counts for (so the table cannot grow forever)
+MAX_TRACKED_KEYS = 65536
+
+
+class HotObjectCache:
+
+	def __init__(self, max_bytes=32 * 1024 * 1024, max_object_bytes=256 * 1024, promote_after=2):
+		self.max_bytes = max_bytes
+		self.max_object_bytes = max_object_bytes
+		self.promote_after = promote_after
+		self.objects = OrderedDict() # key -> bytes, oldest first
+		self.used_bytes = 0
+		self.disk_hit_counts = OrderedDict() # key -> disk hits since it was last in memory
+		self.lock = threading.Lock()
+
+		self.memory_hits = 0
+		self.memory_misses = 0
+		self.disk_hits = 0
+		self.disk_misses = 0
+		self.promotions = 0
+		self.evictions = 0
+
+	def get(self, key):
+		"""
+		returns the object if it is in memory, None otherwise
+		"""
+		if self.max_bytes <= 0:
+			return None
+		with self.lock:
+			data = self.objects.get(key)
+			if data is None:
+				self.memory_misses += 1
+				return None
+			self.objects.move_to_end(key)
+			self.memory_hits += 1
+			return data
+
+	def disk_hit(self, key, size):
+		"""
+		records a hit on the disk tier, returns True if the object is now hot
+		enough to be read into memory (the caller then calls put)
+		"""
+		with self.lock:
+			self.disk_hits += 1
+			if self.max_bytes <= 0 or size > self.max_object_bytes or size > self.max_bytes:
+				return False
+			hits = self.disk_hit_counts.pop(key, 0) + 1
+			if hits >= self.promote_after:
+				return True
+			self.disk_hit_counts[key] = hits
+			while len(self.disk_hit_counts) > MAX_TRACKED_KEYS:
+				self.disk_hit_counts.popitem(last=False)
+			return False
+
+	def disk_miss(self):
+		with self.lock:
+			self.disk_misses += 1
+
+	def put(self, key, data):
+		with self.lock:
+			if key in self.objects:
+				self.used_bytes -= len(self.objects.pop(key))
+			self.objects[key] = data
+			self.used_bytes += len(data)
+			self.promotions += 1
+			while self.used_bytes > self.max_bytes:
+				_, old = self.objects.popitem(last=False)
+				self.used_bytes -= len(old)
+				self.evictions += 1
+
+	def invalidate(self, key):
+		with self.lock:
+			data = self.objects.pop(key, None)
+			if data is not None:
+				self.used_bytes -= len(data)
+			self.disk_hit_counts.pop(key, None)
+
+	def stats(self):
+		with self.lock:
+			return {
+				"memory_hits": self.memory_hits,
+				"memory_misses": self.memory_misses,
+				"disk_hits": self.disk_hits,
+				"disk_misses": self.disk_misses,
+				"promotions": self.promotions,
+				"evictions": self.evictions,
+				"memory_objects": len(self.objects),
+				"memory_bytes": self.used_bytes,
+			}
+
+	def stats_line(self):
+		s = self.stats()
+		lookups = s["memory_hits"] + s["memory_misses"]
+		memory_ratio = s["memory_hits"] / lookups if lookups else 0.0
+		disk_lookups = s["disk_hits"] + s["disk_misses"]
+		disk_ratio = s["disk_hits"] / disk_lookups if disk_lookups else 0.0
+		return ("cache stats: memory %d hits / %d misses (%.1f%%), disk %d hits / %d misses (%.1f%%), "
+			"%d objects / %d bytes in memory, %d promotions, %d evictions") % (
+			s["memory_hits"], s["memory_misses"], memory_ratio * 100,
+			s["disk_hits"], s["disk_misses"], disk_ratio * 100,
+			s["memory_objects"], s["memory_bytes"], s["promotions"], s["evictions"])
@@ -0,0 +1,301 @@
+# incremental HTTP/1.1 message parsing for requests and responses
+
+import re
+
+"""
+The first version of the proxy did recv(4096).decode().split() and hoped the
+whole request was in there, and relayed responses without knowing where they
+end. The parsers here are fed raw bytes in whatever pieces the socket hands
+out and never decode more than the header section:
+
+	- the head may arrive split across any number of reads, and may be much
+	  bigger than 4KB (up to MAX_HEAD_BYTES)
+	- the body is delimited by Transfer-Encoding: chunked, Content-Length, or
+	  (responses only) the connection closing
+	- feed() returns how many of the bytes belong to this message, so whatever
+	  follows (a pipelined request, bytes of the next response) stays with the caller
+	- on_body, if given, is called with the body with the chunked framing removed
+
+They do no I/O of their own, the same classes work for the threaded engine,
+the asyncio engine and the upstream pool.
+
+Response framing rules:
+
+	- no body: HEAD requests, 1xx, 204 and 304
+	- Transfer-Encoding: chunked, up to the last chunk and the trailers
+	- Content-Length: exactly that many bytes
+	- anything else is delimited by the origin closing, never reusable
+
+Requests have a body only with Content-Length or chunked, a request is never
+delimited by the client closing.
+
+Numbers in the framing are only ever digits: int() would also take a sign,
+underscores and surrounding whitespace, and a peer that reads "+5" or "-9"
+differently than we do could slip a second message past us.
+"""
+
+MAX_HEAD_BYTES = 256 * 1024
+
+CHUNK_SIZE = re.compile(rb"[0-9A-Fa-f]+")
+
+
+class FramingError(Exception):
+	pass
+
+
+def parse_headers(lines):
+	"""
+	raw header lines -> {lower-cased name: value}, repeated headers are joined with ", "
+	"""
+	headers = {}
+	for line in lines:
+		name, sep, value = line.partition(b":")
+		if not sep:
+			continue
+		name = name.strip().lower().decode("latin-1")
+		# only spaces and tabs around a value (RFC 9110 section 5.5)
+		value = value.strip(b" \t").decode("latin-1")
+		headers[name] = headers[name] + ", " + value if name in headers else value
+	return headers
+
+
+def parse_response_head(head):
+	"""
+	status code and lower-cased headers of a raw response head, (None, {}) if it is not one
+	"""
+	lines = head.split(b"\r\n")
+	statusLine = lines[0].split(None, 2)
+	if len(statusLine) < 2 or not statusLine[0].startswith(b"HTTP/") or not statusLine[1].isdigit():
+		return None, {}
+	return int(statusLine[1]), parse_headers(lines[1:])
+
+
+def connection_keep_alive(version, headers):
+	"""
+	HTTP/1.1 connections persist unless someone says close, HTTP/1.0 ones only if asked to
+	"""
+	connection = (headers.get("connection", "") + "," + headers.get("proxy-connection", "")).lower()
+	if version.upper() == "HTTP/1.1":
+		return "close" not in connection
+	return "keep-alive" in connection
+
+
+class MessageFramer:
+	"""
+	the common part of request and response parsing: collect the head, then
+	count off the body. subclasses parse the head in _start_body
+	"""
+	def __init__(self, on_body=None):
+		self.on_body = on_body
+		self.head = b""
+		self.headers = {}
+		self.head_complete = False
+		self.done = False
+		self.keep_alive = False
+		self.until_close = False
+		self.remaining = 0 # body bytes left (Content-Length) or in the current chunk
+		self.chunk_state = None # "size", "data", "data_crlf", "trailer", None when not chunked
+		self.line = b""
+		self.offset = 0 # bytes of the stream fed so far
+		self.head_end = None # stream offset where the final head ends and the body starts
+
+	def feed(self, data, stop_at_head=False):
+		"""
+		returns how many bytes of data belong to this message, done says whether
+		it is complete. with stop_at_head nothing past the end of the head is
+		consumed, the body can then be fed separately
+		"""
+		consumed = 0
+		while consumed < len(data) and not self.done:
+			if not self.head_complete:
+				used = self._feed_head(data, consumed)
+				if self.head_complete:
+					self.head_end = self.offset + consumed + used
+				consumed += used
+				if stop_at_head and self.head_complete:
+					break
+			elif self.until_close:
+				self._body(data[consumed:])
+				consumed = len(data)
+			elif self.chunk_state is None:
+				n = min(self.remaining, len(data) - consumed)
+				self._body(data[consumed:consumed + n])
+				self.remaining -= n
+				consumed += n
+				if self.remaining == 0:
+					self.done = True
+			else:
+				consumed += self._feed_chunked(data, consumed)
+		self.offset += consumed
+		return consumed
+
+	def skipped(self, n):
+		"""
+		n bytes of a Content-Length body went by without being fed (spliced,
+		see zerocopy.py)
+		"""
+		if not self.head_complete or self.until_close or self.chunk_state is not None or n > self.remaining:
+			raise FramingError("can only skip over a Content-Length body")
+		self.remaining -= n
+		self.offset += n
+		self.done = self.remaining == 0
+
+	def eof(self):
+		"""
+		the peer closed the connection, returns True if that ended the message cleanly
+		"""
+		if self.until_close and self.head_complete:
+			self.done = True
+		return self.done
+
+	def _body(self, piece):
+		if self.on_body is not None and piece:
+			self.on_body(piece)
+
+	def _feed_head(self, data, start):
+		searchFrom = max(0, len(self.head) - 3)
+		self.head += data[start:]
+		end = self.head.find(b"\r\n\r\n", searchFrom)
+		if end < 0:
+			if len(self.head) > MAX_HEAD_BYTES:
+				raise FramingError("head too large")
+			return len(data) - start
+		used = end + 4 - (len(self.head) - (len(data) - start))
+		self.head = self.head[:end + 4]
+		self._start_body()
+		return used
+
+	def _start_body(self):
+		raise NotImplementedError
+
+	def _frame_body(self, transferEncoding, contentLength):
+		"""
+		picks the body framing once the head is parsed, returns False if the
+		message is not framed by either header
+		"""
+		if transferEncoding:
+			if transferEncoding.lower().split(",")[-1].strip() != "chunked":
+				return False
+			self.chunk_state = "size"
+		elif contentLength is not None:
+			# repeated Content-Length headers arrive joined by parse_headers, they
+			# may only repeat the same value (RFC 9110 section 8.6). parse_headers
+			# took off the whitespace around each, any left is not ours to ignore
+			values = set(contentLength.split(", "))
+			if len(values) != 1:
+				raise FramingError("conflicting Content-Length")
+			value = values.pop()
+			if not (value.isascii() and value.isdigit()):
+				raise FramingError("bad Content-Length")
+			self.remaining = int(value)
+			self.done = self.remaining == 0
+		else:
+			return False
+		return True
+
+	def _feed_chunked(self, data, start):
+		i = start
+		while i < len(data) and not self.done:
+			if self.chunk_state == "data":
+				n = min(self.remaining, len(data) - i)
+				self._body(data[i:i + n])
+				self.remaining -= n
+				i += n
+				if self.remaining == 0:
+					self.chunk_state = "data_crlf"
+					self.line = b""
+				continue
+			# size line, the CRLF after chunk data and trailer lines are all read line by line
+			end = data.find(b"\n", i)
+			if end < 0:
+				self.line += data[i:]
+				if len(self.line) > MAX_HEAD_BYTES:
+					raise FramingError("chunk line too long")
+				return len(data) - start
+			line = (self.line + data[i:end]).rstrip(b"\r")
+			self.line = b""
+			i = end + 1
+			if self.chunk_state == "size":
+				size = line.split(b";", 1)[0].strip(b" \t")
+				if not CHUNK_SIZE.fullmatch(size):
+					raise FramingError("bad chunk size")
+				self.remaining = int(size, 16)
+				self.chunk_state = "data" if self.remaining else "trailer"
+			elif self.chunk_state == "data_crlf":
+				self.chunk_state = "size"
+			elif not line: # blank line after the trailers
+				self.done = True
+		return i - start
+
+
+class ResponseFramer(MessageFramer):
+	"""
+	finds the end of one response in a stream of raw bytes, without touching them.
+	interim 1xx responses are skipped, status and headers are the final response's
+	"""
+	def __init__(self, method="GET", on_body=None):
+		super().__init__(on_body)
+		self.method = method.upper()
+		self.status = None
+
+	def _start_body(self):
+		status, headers = parse_response_head(self.head[:-4])
+		if status is None:
+			raise FramingError("bad status line")
+		if 100 <= status < 200 and status != 101:
+			# interim response, the real one follows
+			self.head = b""
+			return
+		self.head_complete = True
+		self.status = status
+		self.headers = headers
+		version = self.head.split(b" ", 1)[0].decode("latin-1")
+		self.keep_alive = connection_keep_alive(version, headers)
+
+		if self.method == "HEAD" or status in (204, 304):
+			self.done = True
+		elif not self._frame_body(headers.get("transfer-encoding"), headers.get("content-length")):
+			self.until_close = True
+		if self.until_close:
+			self.keep_alive = False
+
+
+class RequestParser(MessageFramer):
+	"""
+	one request off a client connection. once head_complete is set the request
+	line and headers are available:
+
+		method   "GET"
+		target   "http://www.mit.edu/" (absolute form, as proxies receive it)
+		version  "HTTP/1.1"
+		headers  {"host": "www.mit.edu", ...}
+	"""
+	def __init__(self, on_body=None):
+		super().__init__(on_body)
+		self.method = None
+		self.target = None
+		self.version = None
+		self.has_body = False
+
+	def _start_body(self):
+		# empty lines before a request line are allowed (RFC 9112 section 2.2)
+		self.head = self.head.lstrip(b"\r\n")
+		if not self.head:
+			return
+		lines = self.head[:-4].split(b"\r\n")
+		requestLine = lines[0].split()
+		if len(requestLine) != 3 or not requestLine[2].upper().startswith(b"HTTP/"):
+			raise FramingError("bad request line")
+		self.head_complete = True
+		self.method, self.target, self.version = (part.decode("latin-1") for part in requestLine)
+		self.method = self.method.upper()
+		self.headers = parse_headers(lines[1:])
+		self.keep_alive = connection_keep_alive(self.version, self.headers)
+
+		transferEncoding = self.headers.get("transfer-encoding")
+		if not self._frame_body(transferEncoding, self.headers.get("content-length")):
+			if transferEncoding:
+				# a request body can only be delimited by chunked (RFC 9112 section 6.3)
+				raise FramingError("unsupported Transfer-Encoding")
+			self.done = True
+		self.has_body = not self.done
@@ -0,0 +1,226 @@
+# request counters and latency histograms, served in the Prometheus text format
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Every request the proxy answers is one Exchange: it is created once the
+request head is in, ResponseRewriter (common.py) tells it about every byte
+that goes to the client, and the engine records it when the response is over:
+
+	proxy_requests_total{outcome}                 hit, miss, uncached or error
+	proxy_response_bytes_total{source}            bytes sent from the cache / from the origin
+	proxy_time_to_first_byte_seconds{outcome}     histogram, request head in -> first byte out
+	proxy_request_duration_seconds{outcome}       histogram, request head in -> last byte out
+	proxy_active_connections                      client connections open right now
+	proxy_connections_total                       client connections accepted
+	proxy_queued_connections                      accepted connections waiting for a slot (overload.py)
+	proxy_rejected_connections_total              connections turned away with a 503
+	proxy_write_behind_bytes                      fetched bytes waiting for a cache writer (writebehind.py)
+	proxy_write_behind_drops_total                misses not cached because the writers were behind
+	proxy_cache_dedup_bytes_total                 body bytes not stored again, an identical body was (blobstore.py)
+
+hit covers the memory tier, disk hits and revalidated (304) copies. miss
+covers leaders and followers of a fetch (singleflight.py). uncached is
+everything admission.py relays without the cache.
+
+With --metrics-port the numbers are served at http://<host>:<port>/metrics by
+a small HTTP server on its own thread, so scraping works for both engines. In
+--workers mode worker n serves its own numbers on port + n.
+"""
+
+HIT = "hit"
+MISS = "miss"
+UNCACHED = "uncached"
+ERROR = "error"
+OUTCOMES = (HIT, MISS, UNCACHED, ERROR)
+CACHE = "cache"
+ORIGIN = "origin"
+
+# seconds, a bit finer than the Prometheus client default at the fast end: memory hits take well under 1ms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_text(labels):
+	if not labels:
+		return ""
+	return "{" + ",".join('%s="%s"' % (name, value) for name, value in labels) + "}"
+
+
+class Counter:
+	"""
+	a number that only goes up, one per combination of label values
+	"""
+	kind = "counter"
+
+	def __init__(self, name, help, labelname=None, labelvalues=()):
+		self.name = name
+		self.help = help
+		self.labelname = labelname
+		self.lock = threading.Lock()
+		self.values = {value: 0 for value in labelvalues} if labelname else {None: 0}
+
+	def inc(self, amount=1, label=None):
+		with self.lock:
+			self.values[label] = self.values.get(label, 0) + amount
+
+	def samples(self):
+		with self.lock:
+			values = sorted(self.values.items(), key=lambda item: str(item[0]))
+		for label, value in values:
+			labels = [(self.labelname, label)] if self.labelname else []
+			yield self.name, labels, value
+
+
+class Gauge(Counter):
+	"""
+	a number that goes up and down
+	"""
+	kind = "gauge"
+
+
+class Histogram:
+	"""
+	counts of observations per bucket (cumulative, like Prometheus wants them), their sum and count
+	"""
+	kind = "histogram"
+
+	def __init__(self, name, help, labelname, labelvalues=(), buckets=LATENCY_BUCKETS):
+		self.name = name
+		self.help = help
+		self.labelname = labelname
+		self.buckets = buckets
+		self.lock = threading.Lock()
+		self.series = {}
+		for value in labelvalues:
+			self._series(value)
+
+	def _series(self, label):
+		# [count per bucket (last one is +Inf), sum]
+		if label not in self.series:
+			self.series[label] = [[0] * (len(self.buckets) + 1), 0.0]
+		return self.series[label]
+
+	def observe(self, value, label=None):
+		with self.lock:
+			counts, total = self._series(label)
+			i = 0
+			while i < len(self.buckets) and value > self.buckets[i]:
+				i += 1
+			counts[i] += 1
+			self.series[label][1] = total + value
+
+	def samples(self):
+		with self.lock:
+			series = sorted((label, list(counts), total) for label, (counts, total) in self.series.items())
+		for label, counts, total in series:
+			cumulative = 0
+			for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+				cumulative += count
+				yield self.name + "_bucket", [(self.labelname, label), ("le", bound)], cumulative
+			yield self.name + "_sum", [(self.labelname, label)], total
+			yield self.name + "_count", [(self.labelname, label)], cumulative
+
+
+requests = Counter("proxy_requests_total", "Requests answered, by outcome", "outcome", OUTCOMES)
+response_bytes = Counter("proxy_response_bytes_total", "Response bytes sent to clients, by where they came from",
+	"source", (CACHE, ORIGIN))
+first_byte_seconds = Histogram("proxy_time_to_first_byte_seconds",
+	"Seconds from the request head to the first response byte", "outcome", OUTCOMES)
+request_seconds = Histogram("proxy_request_duration_seconds",
+	"Seconds from the request head to the last response byte", "outcome", OUTCOMES)
+active_connections = Gauge("proxy_active_connections", "Client connections open right now")
+connections = Counter("proxy_connections_total", "Client connections accepted")
+queued_connections = Gauge("proxy_queued_connections", "Accepted client connections waiting for a free slot")
+rejected_connections = Counter("proxy_rejected_connections_total", "Client connections answered with 503 because the proxy was saturated")
+write_behind_bytes = Gauge("proxy_write_behind_bytes", "Fetched bytes queued for the cache writer threads")
+write_behind_drops = Counter("proxy_write_behind_drops_total", "Cache misses relayed without being stored because the write-behind queue was full")
+dedup_bytes = Counter("proxy_cache_dedup_bytes_total", "Body bytes of cache misses linked to an identical cached body instead of stored again")
+REGISTRY = [requests, response_bytes, first_byte_seconds, request_seconds, active_connections, connections,
+	queued_connections, rejected_connections, write_behind_bytes, write_behind_drops, dedup_bytes]
+
+
+class Exchange:
+	"""
+	timing and byte count of one request, see the top of the file. trace is
+	its tracing.Trace if the request is traced
+	"""
+	def __init__(self, trace=None):
+		self.trace = trace
+		self.started = time.monotonic()
+		self.first_byte = None
+		self.sent = 0
+		self.outcome = ERROR # until the request gets as far as being answered
+		self.source = ORIGIN
+
+	def answer(self, outcome):
+		self.outcome = outcome
+		self.source = CACHE if outcome == HIT else ORIGIN
+
+	def mark(self, phase):
+		if self.trace is not None:
+			self.trace.mark(phase)
+
+	def wrote(self, n):
+		if n and self.first_byte is None:
+			self.first_byte = time.monotonic()
+		self.sent += n
+
+	def finish(self):
+		requests.inc(label=self.outcome)
+		response_bytes.inc(self.sent, self.source)
+		request_seconds.observe(time.monotonic() - self.started, self.outcome)
+		if self.first_byte is not None:
+			first_byte_seconds.observe(self.first_byte - self.started, self.outcome)
+
+
+def connection_opened():
+	connections.inc()
+	active_connections.inc()
+
+
+def connection_closed():
+	active_connections.inc(-1)
+
+
+def render():
+	"""
+	everything in the Prometheus text exposition format (version 0.0.4)
+	"""
+	lines = []
+	for metric in REGISTRY:
+		lines.append("# HELP %s %s" % (metric.name, metric.help))
+		lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+		for name, labels, value in metric.samples():
+			lines.append("%s%s %s" % (name, _label_text(labels), repr(float(value)) if isinstance(value, float) else value))
+	return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		if self.path.split("?", 1)[0] != "/metrics":
+			self.send_error(404)
+			return
+		body = render().encode("utf-8")
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass # scrapes every few seconds would drown the proxy's own output
+
+
+def serve(port):
+	"""
+	starts the admin HTTP server on a daemon thread, returns it
+	"""
+	server = ThreadingHTTPServer(("", port), MetricsHandler)
+	server.daemon_threads = True
+	t = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+	t.start()
+	print('Metrics at http://localhost:%d/metrics' % port)
+	return server
@@ -0,0 +1,137 @@
+# admission control for client connections: a bounded thread pool with a bounded queue
+
+import threading
+import time
+from collections import deque
+from socket import SHUT_WR
+
+import eventlog
+import metrics
+
+"""
+The lab skeleton listens with a backlog of 1 and starts a new thread for
+every accepted connection. A burst then either overflows the backlog (the
+kernel drops SYNs and clients retry after a second or more) or starts
+threads until the process runs out of memory. Instead:
+
+	--backlog N            connections the kernel queues before accept()
+	--max-connections N    threads serving connections (threads engine), or
+	                       connections served at once (asyncio engine)
+	--accept-queue N       accepted connections waiting for a free thread,
+	                       0 answers every connection that finds none with a 503
+
+A connection that finds every thread busy and the queue full is answered
+right away with a 503 and Retry-After and closed. The accept loop never
+waits for it. Waiting connections and rejections are counted in
+proxy_queued_connections and proxy_rejected_connections_total (metrics.py).
+"""
+
+DEFAULT_BACKLOG = 1024
+DEFAULT_MAX_CONNECTIONS = 256
+DEFAULT_ACCEPT_QUEUE = 512
+# seconds a rejected client is told to wait before trying again
+RETRY_AFTER = 1
+
+REJECT_RESPONSE = (b"HTTP/1.1 503 Service Unavailable\r\n"
+	b"Retry-After: %d\r\n"
+	b"Content-Type: text/plain\r\n"
+	b"Content-Length: 21\r\n"
+	b"Connection: close\r\n"
+	b"\r\n"
+	b"proxy is overloaded\r\n") % RETRY_AFTER
+
+
+class ClientPool:
+	"""
+	at most maxWorkers threads calling handler(sock, accepted, served) for
+	accepted connections (accepted: their time.monotonic() at submit, served:
+	see submit), started as they are needed, with up to queueSize connections
+	waiting for one. rejected connections are closed by reaper (teardown.py)
+	if there is one
+	"""
+	def __init__(self, handler, maxWorkers=DEFAULT_MAX_CONNECTIONS, queueSize=DEFAULT_ACCEPT_QUEUE, reaper=None):
+		self.handler = handler
+		self.reaper = reaper
+		self.max_workers = maxWorkers
+		self.queue_size = queueSize
+		self.queue = deque() # (sock, accepted, served) waiting for a thread
+		self.lock = threading.Lock()
+		self.ready = threading.Condition(self.lock)
+		self.workers = 0
+		self.idle = 0
+		self.rejected = 0
+
+	def submit(self, sock, served=0):
+		"""
+		hands an accepted connection to the pool, or rejects it if the pool is
+		saturated. served: requests it had answered before, for a parked
+		keep-alive connection that is back (teardown.py)
+		"""
+		with self.lock:
+			# threads that can take it right away: idle ones and ones not started yet
+			free = self.idle + self.max_workers - self.workers
+			full = len(self.queue) >= free + self.queue_size
+			if not full:
+				self.queue.append((sock, time.monotonic(), served))
+				self.ready.notify()
+				start = self.workers < self.max_workers and len(self.queue) > self.idle
+				if start:
+					self.workers += 1
+		if full:
+			self.rejected += 1
+			reject(sock, self.reaper)
+			return False
+		metrics.queued_connections.inc()
+		if start:
+			threading.Thread(target=self._run, name="client-%d" % self.workers, daemon=True).start()
+		return True
+
+	def _run(self):
+		while True:
+			with self.lock:
+				# idle and the queue change together, submit() counts on it
+				self.idle += 1
+				self.ready.wait_for(lambda: self.queue)
+				self.idle -= 1
+				sock, accepted, served = self.queue.popleft()
+			metrics.queued_connections.inc(-1)
+			try:
+				self.handler(sock, accepted, served)
+			except:
+				eventlog.exception("client_worker_failed")
+
+	def stats_line(self):
+		return "client pool: %d threads, %d queued, %d rejected" % (self.workers, len(self.queue), self.rejected)
+
+
+def reject(sock, reaper=None):
+	"""
+	503 and close, without blocking: whatever the client sent so far is
+	read and thrown away first, unread data would turn the close into a reset
+	that can destroy the 503 before the client reads it. with a reaper it
+	also gets what the client sends after that
+	"""
+	try:
+		sock.setblocking(False)
+		try:
+			while sock.recv(65536):
+				pass
+		except BlockingIOError:
+			pass
+		sock.send(REJECT_RESPONSE)
+	except OSError:
+		pass
+	if reaper is not None:
+		reaper.close(sock)
+	else:
+		try:
+			sock.shutdown(SHUT_WR)
+		except OSError:
+			pass
+		sock.close()
+	count_rejection()
+
+
+def count_rejection():
+	metrics.rejected_connections.inc()
+	eventlog.sampled(eventlog.WARNING, "connection_rejected")
@@ -0,0 +1,215 @@
+# --prefetch: warm the cache with the images, scripts and stylesheets of cached HTML pages
+
+import http.client
+import os
+import queue
+import threading
+from html.parser import HTMLParser
+from urllib.parse import urldefrag, urljoin, urlsplit
+
+import common
+import eventlog
+
+"""
+A browser loading microscape.html through a cold proxy asks for its dozens
+of images only after it has parsed the page, and every one of them is a miss.
+With --prefetch, when a miss stores an HTML page, its embedded resources are
+requested in the background so that they are cached (or being fetched) by
+the time the browser asks:
+
+	- src= of any tag (img, script, iframe, input, ...), href= of <link>
+	  stylesheets/icons/preloads and background= of old-style body/td tags.
+	  <a href> is navigation, not part of the page, and is not followed
+	- only same-origin http URLs, at most MAX_LINKS per page, skipping what
+	  the index already has
+	- at most --prefetch-concurrency fetches at a time for the whole process,
+	  and --prefetch-budget bytes per page: once a page's resources add up to
+	  the budget no more of them are requested (the one that crossed it is
+	  still completed, the proxy finishes a fetch it started)
+
+The prefetcher is a client of the proxy itself: it sends plain proxy
+requests to 127.0.0.1:<port>, so single-flight, admission, freshness and
+every engine work the same for them. They show up in the log and metrics
+like other requests. Pages it fetched itself are not scanned again.
+"""
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_BUDGET = 8 * 1024 * 1024
+MAX_LINKS = 128
+# pages bigger than this are not parsed
+MAX_PAGE_BYTES = 2 * 1024 * 1024
+QUEUE_SIZE = 1024
+MAX_OWN = 10000
+TIMEOUT = 10.0
+HTML_TYPES = ("text/html", "application/xhtml+xml")
+# <link rel=...> values that are part of rendering the page
+LINK_RELS = {"stylesheet", "icon", "shortcut", "apple-touch-icon", "preload", "modulepreload", "prefetch"}
+
+
+class LinkParser(HTMLParser):
+	"""
+	collects the URLs of the resources a page embeds, in document order
+	"""
+	def __init__(self):
+		super().__init__(convert_charrefs=True)
+		self.base = None
+		self.links = []
+
+	def handle_starttag(self, tag, attrs):
+		attrs = dict(attrs)
+		if tag == "base" and attrs.get("href") and self.base is None:
+			self.base = attrs["href"]
+		if attrs.get("src"):
+			self.links.append(attrs["src"])
+		if tag == "link" and attrs.get("href") and LINK_RELS & set((attrs.get("rel") or "").lower().split()):
+			self.links.append(attrs["href"])
+		if tag in ("body", "table", "td", "th") and attrs.get("background"):
+			self.links.append(attrs["background"])
+
+	handle_startendtag = handle_starttag
+
+
+def page_links(url, html):
+	"""
+	the same-origin resources embedded in the page at url, absolute and without fragments
+	"""
+	parser = LinkParser()
+	try:
+		parser.feed(html)
+		parser.close()
+	except Exception:
+		pass # keep what was found before the markup got too broken
+	base = urljoin(url, parser.base) if parser.base else url
+	origin = urlsplit(url).netloc.lower()
+	links = []
+	for link in parser.links:
+		absolute = urldefrag(urljoin(base, link.strip())).url
+		parts = urlsplit(absolute)
+		if parts.scheme == "http" and parts.netloc.lower() == origin and absolute not in links:
+			links.append(absolute)
+	return links[:MAX_LINKS]
+
+
+class Page:
+	"""
+	what is left of one page's byte budget
+	"""
+	def __init__(self, url, budget):
+		self.url = url
+		self.remaining = budget
+		self.lock = threading.Lock()
+
+	def spend(self, n):
+		with self.lock:
+			self.remaining -= n
+
+
+class Prefetcher:
+
+	def __init__(self, port, index, concurrency=DEFAULT_CONCURRENCY, budget=DEFAULT_BUDGET):
+		self.port = port
+		self.index = index
+		self.concurrency = concurrency
+		self.budget = budget
+		self.queue = queue.Queue(QUEUE_SIZE)
+		self.own = set() # URLs requested by the prefetcher, their pages are not scanned
+		self.lock = threading.Lock()
+		self.fetched = 0
+		self.fetched_bytes = 0
+		self.skipped = 0
+
+	def start(self):
+		for i in range(self.concurrency):
+			threading.Thread(target=self._run, name="prefetch-%d" % i, daemon=True).start()
+
+	def response_cached(self, url, file_to_use, status, headers):
+		"""
+		called by the engines after a miss stored a response. never blocks, the
+		page is read and parsed on a prefetch thread
+		"""
+		contentType = headers.get("content-type", "").split(";", 1)[0].strip().lower()
+		if status != 200 or contentType not in HTML_TYPES:
+			return
+		with self.lock:
+			if url in self.own:
+				self.own.discard(url)
+				return
+		self._put((url, file_to_use, None))
+
+	def _put(self, task):
+		try:
+			self.queue.put_nowait(task)
+		except queue.Full:
+			self.skipped += 1
+
+	def _run(self):
+		conn = None
+		while True:
+			url, file_to_use, page = self.queue.get()
+			try:
+				if page is None:
+					self._scan(url, file_to_use)
+				else:
+					conn = self._fetch(conn, url, page)
+			except Exception:
+				eventlog.exception("prefetch_failed", url=url)
+				if conn is not None:
+					conn.close()
+					conn = None
+
+	def _scan(self, url, file_to_use):
+		with open(file_to_use, "rb") as f:
+			if os.fstat(f.fileno()).st_size > MAX_PAGE_BYTES:
+				return
+			stored, body = common.read_stored(common.StoredResponse(f, self.index.get(file_to_use)))
+		if not stored.done or "content-encoding" in stored.headers:
+			return
+		charset = stored.headers.get("content-type", "").lower().partition("charset=")[2].strip(' "') or "latin-1"
+		try:
+			html = body.decode(charset, "replace")
+		except LookupError:
+			html = body.decode("latin-1")
+		page = Page(url, self.budget)
+		queued = 0
+		for link in page_links(url, html):
+			if self.index.get(common.cache_file_for(link)) is not None:
+				continue
+			with self.lock:
+				if len(self.own) >= MAX_OWN:
+					self.own.clear() # resources that were hits by the time they were fetched
+				self.own.add(link)
+			self._put((link, None, page))
+			queued += 1
+		eventlog.debug("prefetch_page", url=url, links=queued)
+
+	def _fetch(self, conn, url, page):
+		"""
+		one resource through our own proxy, the body is read and dropped (the
+		proxy caches it on the way). returns the connection to reuse
+		"""
+		if page.remaining <= 0:
+			self.skipped += 1
+			return conn
+		if conn is None:
+			conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=TIMEOUT)
+		conn.request("GET", url, headers={"Host": urlsplit(url).netloc})
+		response = conn.getresponse()
+		size = 0
+		while True:
+			buff = response.read(65536)
+			if not buff:
+				break
+			size += len(buff)
+		page.spend(size)
+		with self.lock:
+			self.fetched += 1
+			self.fetched_bytes += size
+		eventlog.debug("prefetched", url=url, status=response.status, size=size, page=page.url)
+		# nothing else to fetch: do not hold a client slot of the proxy while idle
+		if response.will_close or self.queue.empty():
+			conn.close()
+			conn = None
+		return conn
+
+	def stats_line(self):
+		return "prefetch: %d resources, %d bytes, %d skipped" % (self.fetched, self.fetched_bytes, self.skipped)
@@ -2,11 +2,52 @@
 
 from socket import *
 import sys, os
-import _thread as thread
-import shutil
+import argparse
+import time
+
+import admission
+import blobstore
+import common
+import compression
+import dnscache
+import eventlog
+import freshness
+import hotcache
+import httpparse
+import metrics
+import overload
+import prefetch
+import ranges
+import singleflight
+import teardown
+import tracing
+import upstream
+import writebehind
+import zerocopy
 
 proxy_port=8080
-cache_directory = "./cache/"
+# cache misses currently being fetched, shared by every client thread
+flights = singleflight.FlightTable()
+# small popular objects kept in RAM, replaced in __main__ with the configured budget
+hot = hotcache.HotObjectCache()
+# keep-alive connections to the origins
+pool = upstream.ConnectionPool()
+# client connections are kept open between requests, up to these limits
+client_idle_timeout = 5.0
+max_requests_per_connection = 100
+# disk hits are sent with socket.sendfile (zero-copy), False falls back to read()/send()
+use_sendfile = True
+# big Content-Length bodies of misses are spliced origin -> cache file -> client, see zerocopy.py
+use_splice = zerocopy.AVAILABLE
+# --prefetch: fetches the resources of cached HTML pages, see prefetch.py
+prefetcher = None
+# threads writing misses to disk behind the leader, None writes in the leader's thread. see writebehind.py
+cache_writer = None
+# listen() backlog and the threads serving accepted connections, see overload.py
+backlog = overload.DEFAULT_BACKLOG
+clients = None
+# closes client connections and watches idle keep-alive ones off the client threads, see teardown.py
+reaper = None
 """
 Code out proxy server, which allows:
 1. client to connect to it
@@ -18,6 +59,10 @@ Both will send data in bytes to each other
 
 Note that it works only on the same resource
 i.e changing to another HTTP source will throw an error
+
+Two engines are available (--engine):
+	threads: a pool of OS threads, one per connection being served (client_thread below, overload.py)
+	asyncio: one event loop, one coroutine per connection (aioproxy.py)
 """
 
 def force_close(s:socket):
@@ -33,170 +78,627 @@ def force_close(s:socket):
 	s.close()
 
 
-def client_thread(clientFacingSocket):
-
+def client_thread(clientFacingSocket, accepted=None, served=0):
+	"""
+	serves requests on one client connection until the client closes it, goes
+	idle for longer than client_idle_timeout or a response cannot be framed.
+	pipelined requests are simply the next ones in the buffer, answered in order.
+	a connection that goes quiet between requests is parked with the reaper,
+	which gives it back to the client pool (with served, the requests it had
+	so far) once the next one arrives.
+	accepted: time.monotonic() of the accept, for --trace-file (tracing.py)
+	"""
+	pickedUp = time.monotonic()
 	clientFacingSocket.settimeout(5.0)
+	buffered = b""
+	resumedAt = served
+	parked = False
+	request = exchange = trace = None
+	if not served:
+		metrics.connection_opened()
 
 	try:
-		message = clientFacingSocket.recv(4096).decode()
-		"""
-		If the string received is less than 4096 bytes (or char since char = 1 byte), 
-		it will loop again and re-check for more data using socket.recv() 
-		"""
-		msgElements = message.split()
-		print(msgElements)
-		
-		if len(msgElements) < 5 or msgElements[0].upper() != 'GET' or 'Range:' in msgElements:
-			# print("non-supported request: " , msgElements)
-			#clientFacingSocket.close()
-			force_close(clientFacingSocket)
-			return
+		while served < max_requests_per_connection:
+			request, buffered = read_request(clientFacingSocket, buffered, client_idle_timeout if served else 5.0)
+			if request is None:
+				break
+			first = served == resumedAt
+			trace = tracing.begin(accepted if first else None)
+			if trace is not None and first:
+				trace.mark("queued", pickedUp)
+				trace.mark("head")
+			served += 1
+			if served >= max_requests_per_connection:
+				# the last one, its response has to say Connection: close
+				request.keep_alive = False
+			exchange = metrics.Exchange(trace)
+			keepAlive = handle_request(clientFacingSocket, request, buffered, exchange)
+			exchange.mark("transfer")
+			exchange.finish()
+			if not keepAlive:
+				break
+			tracing.finish(trace, request, exchange)
+			trace = None
+			if reaper is not None and not buffered and not teardown.readable(clientFacingSocket, teardown.IDLE_GRACE):
+				# nothing to do until the client sends another request, this thread can serve someone else
+				reaper.park(clientFacingSocket, client_idle_timeout,
+					lambda s, served=served: resume_client(s, served), metrics.connection_closed)
+				parked = True
+				break
+	except:
+		eventlog.exception("connection_failed", requests=served)
+
+	finally:
+		# Fill in start
+		#clientFacingSocket.close()
+		# a parked socket is not ours any more, it may be another thread's already
+		if not parked:
+			metrics.connection_closed()
+			if reaper is not None:
+				reaper.close(clientFacingSocket)
+			else:
+				force_close(clientFacingSocket)
+			if trace is not None:
+				# the last request's record includes the teardown
+				trace.mark("close")
+				tracing.finish(trace, request, exchange)
+			eventlog.debug("connection_closed", requests=served)
+		#print("Sockets force closed.")     
+		# Fill in end
 
-		# Extract the following info from the received message
-		#   webServer: the web server's host name
-		#   resource: the web resource requested
-		#   file_to_use: a valid file name to cache the requested resource
-		#   Assume the HTTP request is in the format of:
-		#      GET http://www.mit.edu/ HTTP/1.1\r\n
-		#      Host: www.mit.edu\r\n
-		#      User-Agent: .....
-		#      Accept:  ......
-		
-		resource = msgElements[1].replace("http://","", 1)
-	
-		hostHeaderIndex = msgElements.index('Host:')
-		webServer = msgElements[hostHeaderIndex+1]
 
-		port = 80 # HTTP
+def resume_client(clientFacingSocket, served):
+	"""
+	called by the reaper when a parked connection has something to read
+	"""
+	if not clients.submit(clientFacingSocket, served):
+		metrics.connection_closed()
 
-		print("webServer:", webServer)
-		print("resource:", resource)
 
-		message=message.replace("Connection: keep-alive","Connection: close")
-		
-		website_directory = cache_directory + webServer.replace("/",".") + "/"
+def read_request(clientFacingSocket, buffered, idleTimeout):
+	"""
+	returns (request, bytes after its head) once a whole request head is in,
+	(None, b"") if the client closed or sent nothing within idleTimeout.
+	the head may take any number of recv() calls
+	"""
+	request = httpparse.RequestParser()
+	clientFacingSocket.settimeout(idleTimeout)
+	try:
+		used = request.feed(buffered, stop_at_head=True)
+		while not request.head_complete:
+			buff = clientFacingSocket.recv(4096)
+			if not buff:
+				return None, b""
+			buffered = buff
+			used = request.feed(buff, stop_at_head=True)
+			# the request has started, from here on the usual timeout applies
+			clientFacingSocket.settimeout(5.0)
+	except TimeoutError:
+		if request.offset == 0:
+			return None, b""
+		raise
+	return request, buffered[used:]
+
 
-		if not os.path.exists(website_directory):
-			os.makedirs(website_directory)
+def handle_request(clientFacingSocket, request, buffered, exchange):
+	"""
+	answers one request, returns True if the connection can take another one.
+	buffered holds what the client sent after the head (the start of a body).
+	exchange (metrics.Exchange) is told how it went
+	"""
+	try:
+		eventlog.sampled(eventlog.INFO, "request", method=request.method, target=request.target, version=request.version)
 		
-		file_to_use = website_directory + resource.replace("/",".")
+		parsed = common.parse_request(request)
+		if parsed is None:
+			# print("non-supported request: " , request.method, request.target)
+			return False
+
+		webServer, resource = parsed
+		# after a request body the connection is closed, no need to find the next request
+		keepAlive = request.keep_alive and not request.has_body
+
+		eventlog.debug("parsed", host=webServer, resource=resource)
+
+		url = common.cache_key(webServer, resource)
+		file_to_use = common.cache_file_for(url)
 
 
 	except:
-		print(str(sys.exc_info()[0]))                                                
-		#clientFacingSocket.close()
-		force_close(clientFacingSocket)
-		return
+		eventlog.exception("request_failed", target=request.target)
+		return False
 
-	# Check wether the file exists in the cache
-	try:
-		with open(file_to_use, "rb") as f:
-			# ProxyServer finds a cache hit and generates a response message
-			print("*****Cache HIT*****")
-			print("served from the cache")
-			while True:
-				buff = f.read(4096)
-				if buff:
-					#Fill in start    
-					clientFacingSocket.send(buff)       
-					# Fill in end
-				else:
-					break
-
-	except FileNotFoundError as e:
-		print("!!!!! Cache miss !!!!!")          
+	cacheable = admission.request_cacheable(request)
+	# the cache answers Range requests itself, from the whole object
+	rangeRequest = ranges.RangeRequest.from_headers(request.headers) if cacheable else None
+	response = common.ResponseRewriter(keepAlive, request.method, exchange, rangeRequest)
+	if not cacheable:
+		eventlog.sampled(eventlog.INFO, "passthrough", method=request.method, url=url)
+		exchange.answer(metrics.UNCACHED)
 		try:
-			# USING TCP
+			return relay_uncached(clientFacingSocket, response, webServer, request, buffered, exchange.trace)
+		except:
+			eventlog.exception("relay_failed", url=url)
+			exchange.outcome = metrics.ERROR
+			return False
 
-			# Fill in start         
-			# Create a socket on the proxyserver
-			# Connect to the socket to port = 80
+	# Check the memory tier first, then wether the file exists in the cache,
+	# or whether another thread is already fetching it. a stale copy is
+	# revalidated with the origin first. fresh text objects go out compressed
+	# if the client accepts it and the compressed copy is made already
+	try:
+		stale = common.stale_entry(flights.index, file_to_use, request)
+		encoding = compression.negotiate(flights.index.get(file_to_use), request.headers) if stale is None else None
+		if encoding is not None and serve_variant(clientFacingSocket, response, file_to_use, encoding, exchange, url):
+			return response.keep_alive()
+		data = hot.get(file_to_use) if stale is None else None
+		if data is not None:
+			eventlog.sampled(eventlog.INFO, "cache_hit", tier="memory", url=url)
+			exchange.answer(metrics.HIT)
+			exchange.mark("lookup")
+			clientFacingSocket.sendall(response.feed(data))
+			return response.keep_alive()
 
-			serverFacingSocket = socket(AF_INET,SOCK_STREAM)
-			serverFacingSocket.connect((webServer,port))
-			serverFacingSocket.send(message.encode())
-			# Fill in end
-			with open(file_to_use, "wb") as cacheFile:
-				print("Created cache file.\nWriting to cache....")
-				while True:
-					# Fill in start   
-					buff = serverFacingSocket.recv(4096)
-					# Fill in end
-					if buff:
-						cacheFile.write(buff)
-						# Fill in start
-						clientFacingSocket.send(buff)
-						# Fill in end
-					else:
-						print("Done.")
-						break
-		except:
-			print(str(sys.exc_info()[0]))
-
-		finally:
-			# Fill in start
-			force_close(serverFacingSocket) 
-			print("serverFacingSocket force closed.")
-			#serverFacingSocket.close()
-			#print("serverFacingSocket closed.")
+		kind, flight, f = flights.open(file_to_use, stale is not None, url)
+		exchange.mark("lookup")
+		with f:
+			if kind == singleflight.HIT:
+				# ProxyServer finds a cache hit and generates a response message
+				eventlog.sampled(eventlog.INFO, "cache_hit", tier="disk", url=url)
+				exchange.answer(metrics.HIT)
+				serve_from_disk(clientFacingSocket, response, file_to_use, f, flights.index.get(file_to_use))
+			elif kind == singleflight.FOLLOW:
+				hot.disk_miss()
+				exchange.answer(metrics.MISS)
+				eventlog.sampled(eventlog.INFO, "cache_miss", url=url, joined=True)
+				follow_flight(clientFacingSocket, response, flight, f)
+			else:
+				hot.disk_miss()
+				exchange.answer(metrics.MISS)
+				eventlog.sampled(eventlog.INFO, "cache_miss" if stale is None else "cache_revalidate", url=url)
+				if not fetch_and_cache(clientFacingSocket, response, webServer, request.head, flight, f, stale, exchange.trace):
+					exchange.outcome = metrics.ERROR
+					return False
+		if flight is not None and flight.revalidated:
+			eventlog.sampled(eventlog.INFO, "cache_hit", tier="revalidated", url=url)
+			exchange.answer(metrics.HIT)
+			with open(file_to_use, "rb") as f:
+				serve_from_disk(clientFacingSocket, response, file_to_use, f, flights.index.get(file_to_use))
+		return response.keep_alive()
+	except:
+		eventlog.exception("request_failed", url=url)
+		exchange.outcome = metrics.ERROR
+		return False
+
+
+def send_response(clientFacingSocket, response, buff):
+	out = response.feed(buff)
+	if out:
+		clientFacingSocket.sendall(out)
+
+
+def request_body(clientFacingSocket, request, buffered):
+	"""
+	the raw body of request (chunked framing and all, the origin gets it as
+	it is), piece by piece: first what was already buffered, then the socket
+	"""
+	while not request.done:
+		if not buffered:
+			buffered = clientFacingSocket.recv(4096)
+			if not buffered:
+				raise ConnectionError("client closed in the middle of the request body")
+		used = request.feed(buffered)
+		yield buffered[:used]
+		buffered = buffered[used:]
+
+
+def relay_uncached(clientFacingSocket, response, webServer, request, buffered, trace=None):
+	"""
+	requests the cache stays out of (POST, HEAD, Range, ...): the request, body
+	and all, goes to the origin and the response straight back to the client.
+	trace: the request's tracing.Trace, if it is traced
+	"""
+	body = request_body(clientFacingSocket, request, buffered) if request.has_body else None
+	host, port = upstream.split_host(webServer)
+	pool.fetch(host, port, upstream.upstream_request(request.head),
+		lambda buff: send_response(clientFacingSocket, response, buff), request.method, body, trace=trace)
+	return response.keep_alive()
+
+
+def serve_from_disk(clientFacingSocket, response, file_to_use, f, entry=None):
+	"""
+	disk tier hit, the object is copied into memory once it gets hot. large
+	(or not yet hot) objects are sent with sendfile unless --no-sendfile.
+	entry: the object's index record, says where a shared body is (blobstore.py)
+	"""
+	stored = common.StoredResponse(f, entry)
+	size = stored.size
+	if hot.disk_hit(file_to_use, size):
+		data = stored.read()
+		hot.put(file_to_use, data)
+		eventlog.debug("promoted", file=file_to_use, size=size)
+		send_response(clientFacingSocket, response, data)
+		return
+
+	if use_sendfile:
+		# only the head goes through python, the body is copied by the kernel
+		# straight from the page cache into the socket (only the requested
+		# byte ranges of it for a Range request, see ranges.py)
+		clientFacingSocket.sendall(response.feed_head(stored))
+		for piece in response.file_pieces(size):
+			if isinstance(piece, bytes):
+				clientFacingSocket.sendall(piece)
+			else:
+				clientFacingSocket.sendfile(f, stored.file_offset(piece[0]), piece[1])
+		return
+
+	while True:
+		buff = stored.read(4096)
+		if buff:
+			#Fill in start    
+			send_response(clientFacingSocket, response, buff)
 			# Fill in end
+		else:
+			break
+
+
+def serve_variant(clientFacingSocket, response, file_to_use, encoding, exchange, url):
+	"""
+	a hit answered with the compressed copy of the object (compression.py),
+	False if that copy is not there (yet) and the identity one has to do
+	"""
+	variant = compression.variant_path(file_to_use, encoding)
+	data = hot.get(variant)
+	if data is not None:
+		eventlog.sampled(eventlog.INFO, "cache_hit", tier="memory", encoding=encoding, url=url)
+		exchange.answer(metrics.HIT)
+		clientFacingSocket.sendall(response.feed(data))
+		return True
+	f = compression.open_variant(file_to_use, encoding, flights.index.get(file_to_use))
+	if f is None:
+		return False
+	with f:
+		eventlog.sampled(eventlog.INFO, "cache_hit", tier="disk", encoding=encoding, url=url)
+		exchange.answer(metrics.HIT)
+		serve_from_disk(clientFacingSocket, response, variant, f)
+	return True
+
+
+def fetch_and_cache(clientFacingSocket, response, webServer, requestHead, flight, cacheFile, stale=None, trace=None):
+	"""
+	leader of a cache miss: relay the origin's response to the client while
+	writing it to the flight's temp file, then publish it into the cache.
+	with cache_writer the writing and publishing happen on a writer thread,
+	and if it is too far behind the object is not cached.
+	with the index record of a stale copy the request is made conditional, a
+	304 then only refreshes that copy (flight.revalidated) and nothing is relayed.
+	responses admission.py does not want are relayed (to followers too) but not
+	published. trace: the request's tracing.Trace, if it is traced.
+	returns False if our client did not get the whole response
+	"""
+	failed = True
+	clientAlive = True
+	validating = stale is not None and freshness.has_validators(stale)
+	request = freshness.conditional_request(upstream.upstream_request(requestHead), stale if validating else None)
+	status = httpparse.ResponseFramer()
+	held = b""
+	admit = True
+	stream = cache_writer.open(cacheFile, flight.wrote) if cache_writer is not None else None
+	dropped = False
+
+	def store(buff):
+		nonlocal dropped
+		if stream is None:
+			cacheFile.write(buff)
+			flight.wrote(len(buff))
+		elif not dropped and not stream.write(buff):
+			# the disk is behind: no copy in the cache rather than a slower client
+			if flights.abandon(flight):
+				dropped = True
+				cache_writer.count_drop()
+				eventlog.warning("not_stored", reason="write_behind_full", url=flight.url)
+			else:
+				# others are reading the temp file, they need the whole response
+				stream.write(buff, force=True)
+
+	def relay(buff):
+		nonlocal clientAlive, held, admit
+		if not status.head_complete:
+			# hold on to the bytes until we know the status
+			status.feed(buff, stop_at_head=True)
+			held += buff
+			if not status.head_complete:
+				return
+			buff, held = held, b""
+			admit = admission.response_cacheable(status.status, status.headers)
+			if not admit and not (validating and status.status == 304):
+				eventlog.info("not_stored", status=status.status, url=flight.url)
+		if validating and status.status == 304:
+			return
+		store(buff)
+		if clientAlive:
+			try:
+				send_response(clientFacingSocket, response, buff)
+			except OSError:
+				# our own client left, keep going for the followers
+				clientAlive = False
+
+	def splice(upstreamSocket, count):
+		# the rest of the body in the kernel, if it is big and the client wants all of it
+		nonlocal clientAlive
+		if not use_splice or dropped or count < zerocopy.MIN_BODY or response.plan is not None:
+			return 0
+		if stream is not None:
+			# the head is still queued, it has to be in the file first
+			stream.sync()
+		sending = clientAlive
+		with open(flight.tmp_path, "rb") as readFile:
+			clientAlive = zerocopy.relay(upstreamSocket, count, cacheFile, readFile,
+				clientFacingSocket if sending else None, flight.wrote)
+		if sending:
+			response.skipped(count)
+		return count
+
+	try:
+		# USING TCP, over a pooled keep-alive connection to the origin
+		host, port = upstream.split_host(webServer)
+		eventlog.debug("fetch_start", url=flight.url)
+		framer = pool.fetch(host, port, request, relay, splice=splice, trace=trace)
+		eventlog.debug("fetch_done", url=flight.url, size=framer.offset)
+		failed = False
 	except:
-		print(str(sys.exc_info()[0]))
+		eventlog.exception("fetch_failed", url=flight.url)
 
 	finally:
-		# Fill in start
-		#clientFacingSocket.close()
-		force_close(clientFacingSocket)
-		print("clientFacingSocket force closed.")
-		#print("Sockets force closed.")     
-		# Fill in end
+		refreshed = not failed and validating and status.status == 304
+		if stream is None or refreshed:
+			if stream is not None:
+				# a 304 wrote nothing, and handle_request serves the refreshed copy as soon as we return
+				stream.close()
+			cacheFile.close()
+			publish_fetch(flight, status, validating, failed, admit)
+		else:
+			stream.close(lambda ok: publish_fetch(flight, status, validating, failed or dropped or not ok, admit))
+	return clientAlive and not failed
 
 
-if len(sys.argv) > 2:
-	print('Usage : "python proxy.py port_number"\n')
-	sys.exit(2)
-if len(sys.argv) == 2:
-	proxy_port = int(sys.argv[1])
-
-if not os.path.exists(cache_directory):
-	os.makedirs(cache_directory)
-else: # Clear cache
-	print("wiping cache.....")
-	shutil.rmtree(cache_directory)
-	os.makedirs(cache_directory)
-	print("Done.")
-	
-# Create a server socket, bind it to a port and start listening
-"""
-WelcomeSocket creates a new TCP connection and manages it
-"""
-# Fill in start          
-welcomeSocket = socket(AF_INET,SOCK_STREAM)
-welcomeSocket.bind(("",proxy_port)) 
-# set bind address to empty to get a wildcard address, for docker testing
-welcomeSocket.listen(1)
-# Fill in end
+def publish_fetch(flight, status, validating, failed, admit):
+	"""
+	the end of fetch_and_cache, once the temp file is complete and closed
+	"""
+	if not failed and validating and status.status == 304:
+		flights.refresh(flight, status.head)
+		return
+	flights.publish(flight, failed, admit)
+	# a new copy replaced the stale one, and made its compressed copies outdated
+	for path in [flight.key] + compression.variant_paths(flight.key):
+		hot.invalidate(path)
+	if prefetcher is not None and not failed and admit:
+		prefetcher.response_cached(flight.url, flight.key, status.status, status.headers)
 
-print('Proxy ready to serve at port', proxy_port)
 
-try: 
+def follow_flight(clientFacingSocket, response, flight, f):
+	"""
+	follower of a cache miss: stream the leader's temp file as it grows
+	"""
+	sent = 0
 	while True:
-		# Start receiving data from the client
+		written = flight.wait(sent, 5.0)
+		if written > sent:
+			buff = f.read(min(written - sent, 65536))
+			if not buff:
+				break
+			send_response(clientFacingSocket, response, buff)
+			sent += len(buff)
+		elif flight.done:
+			break
+		else:
+			raise TimeoutError("in-flight fetch of " + flight.key + " stalled")
+
+
+def serve_threads(proxy_port, welcomeSocket=None):
+	# Create a server socket, bind it to a port and start listening
+	"""
+	WelcomeSocket creates a new TCP connection and manages it.
+	in --workers mode it is already listening (see workers.py)
+	"""
+	# Fill in start
+	if welcomeSocket is None:
+		welcomeSocket = socket(AF_INET,SOCK_STREAM)
+		welcomeSocket.bind(("",proxy_port))
+		# set bind address to empty to get a wildcard address, for docker testing
+		welcomeSocket.listen(backlog)
+	# Fill in end
+
+	print('Proxy ready to serve at port', proxy_port)
+
+	try: 
+		while True:
+			# Start receiving data from the client
+
+			# Fill in start   
+			clientFacingSocket, addr = welcomeSocket.accept()
+			# Fill in end
+
+			# print('Received a connection from:', addr)
+		
+			# a pooled thread takes it from here (client_thread), or it gets a 503 if they are all busy
+			clients.submit(clientFacingSocket)
 
-		# Fill in start   
-		clientFacingSocket, addr = welcomeSocket.accept()
+	except KeyboardInterrupt:
+		eventlog.close()
+		tracing.close()
+		print('bye...')
+		print(hot.stats_line())
+		print(pool.stats_line())
+		print(pool.resolver.stats_line())
+		print(clients.stats_line())
+		print(reaper.stats_line())
+		if cache_writer is not None:
+			print(cache_writer.stats_line())
+		print(flights.index.blobs.stats_line())
+		if prefetcher is not None:
+			print(prefetcher.stats_line())
+
+	finally:
+		# Fill in start         
+		#welcomeSocket.close()
+		force_close(welcomeSocket)   
 		# Fill in end
+		pool.close()
+
+
+def start_worker(args, index, welcomeSocket=None, number=0):
+	"""
+	sets up the flight table, memory tier and upstream pool of this process
+	from the command line and serves until SIGINT, with the chosen engine.
+	number is the worker's in --workers mode
+	"""
+	global flights, hot, pool, client_idle_timeout, max_requests_per_connection, use_sendfile, use_splice, backlog, clients, reaper, prefetcher
+	global cache_writer
+	eventlog.level = eventlog.LEVELS[args.log_level]
+	eventlog.sample_every = max(1, round(1 / args.log_sample))
+	eventlog.json_format = args.log_format == "json"
+	eventlog.start()
+	if args.trace_file:
+		tracing.start(args.trace_file, round(1 / args.trace_sample), args.engine)
+	flights = singleflight.FlightTable(index=index)
+	hot = hotcache.HotObjectCache(args.mem_cache_size, args.mem_cache_max_object)
+	# one name cache for the process, whichever pool uses it
+	resolver = dnscache.Resolver(args.dns_ttl, args.dns_negative_ttl)
+	pool = upstream.ConnectionPool(args.upstream_max_per_host, args.upstream_idle_timeout, resolver=resolver)
+	client_idle_timeout = args.client_idle_timeout
+	max_requests_per_connection = args.max_requests_per_connection
+	use_sendfile = not args.no_sendfile
+	use_splice = zerocopy.AVAILABLE and not args.no_splice
+	backlog = args.backlog
+	compression.enabled = not args.no_compression
+	blobstore.enabled = not args.no_dedup
+	freshness.default_ttl = args.default_ttl
+	admission.negative_ttl = args.negative_ttl
+	if args.metrics_port:
+		metrics.serve(args.metrics_port + number)
+	if args.cache_writers:
+		cache_writer = writebehind.CacheWriter(args.cache_writers, args.write_behind_queue)
+		cache_writer.start()
+	if args.prefetch:
+		prefetcher = prefetch.Prefetcher(args.port, index, args.prefetch_concurrency, args.prefetch_budget)
+		prefetcher.start()
+
+	if args.engine == "asyncio":
+		import aioproxy
+		aioproxy.flights = singleflight.FlightTable(singleflight.AsyncFlight, index)
+		aioproxy.hot = hot
+		aioproxy.pool = upstream.AsyncConnectionPool(args.upstream_max_per_host, args.upstream_idle_timeout, resolver=resolver)
+		aioproxy.client_idle_timeout = args.client_idle_timeout
+		aioproxy.max_requests_per_connection = args.max_requests_per_connection
+		aioproxy.use_sendfile = use_sendfile
+		aioproxy.prefetcher = prefetcher
+		aioproxy.cache_writer = cache_writer
+		aioproxy.backlog = args.backlog
+		aioproxy.max_connections = args.max_connections
+		aioproxy.accept_queue = args.accept_queue
+		aioproxy.serve(args.port, welcomeSocket)
+	else:
+		reaper = teardown.Reaper()
+		reaper.start()
+		clients = overload.ClientPool(client_thread, args.max_connections, args.accept_queue, reaper)
+		serve_threads(args.port, welcomeSocket)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="50.012 lab 1 caching proxy")
+	parser.add_argument("port", nargs="?", type=int, default=proxy_port, help="port to serve on (default 8080)")
+	parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+		help="threads: one thread per connection, asyncio: one event loop for every connection")
+	parser.add_argument("--mem-cache-size", type=common.parse_size, default="32M",
+		help="byte budget of the in-memory hot object tier, 0 disables it (default 32M)")
+	parser.add_argument("--mem-cache-max-object", type=common.parse_size, default="256K",
+		help="objects bigger than this are only ever served from disk (default 256K)")
+	parser.add_argument("--backlog", type=int, default=overload.DEFAULT_BACKLOG,
+		help="connections the kernel queues for accept() (default %d)" % overload.DEFAULT_BACKLOG)
+	parser.add_argument("--max-connections", type=int, default=overload.DEFAULT_MAX_CONNECTIONS,
+		help="client connections served at once, by as many threads with --engine threads (default %d)" % overload.DEFAULT_MAX_CONNECTIONS)
+	parser.add_argument("--accept-queue", type=int, default=overload.DEFAULT_ACCEPT_QUEUE,
+		help="accepted connections waiting for a free slot, more get a 503, 0: none waits (default %d)" % overload.DEFAULT_ACCEPT_QUEUE)
+	parser.add_argument("--upstream-max-per-host", type=int, default=8,
+		help="most connections open to one origin at a time (default 8)")
+	parser.add_argument("--upstream-idle-timeout", type=float, default=30.0,
+		help="seconds an unused keep-alive connection to an origin is kept (default 30)")
+	parser.add_argument("--dns-ttl", type=float, default=dnscache.DEFAULT_TTL,
+		help="seconds an origin's resolved addresses are reused (default %g)" % dnscache.DEFAULT_TTL)
+	parser.add_argument("--dns-negative-ttl", type=float, default=dnscache.DEFAULT_NEGATIVE_TTL,
+		help="seconds a failed lookup is remembered (default %g)" % dnscache.DEFAULT_NEGATIVE_TTL)
+	parser.add_argument("--client-idle-timeout", type=float, default=client_idle_timeout,
+		help="seconds a client connection may sit idle between requests (default 5)")
+	parser.add_argument("--max-requests-per-connection", type=int, default=max_requests_per_connection,
+		help="requests served on one client connection before it is closed (default 100)")
+	parser.add_argument("--default-ttl", type=float, default=freshness.default_ttl,
+		help="seconds a response without Cache-Control/Expires stays fresh, at least (default 300)")
+	parser.add_argument("--negative-ttl", type=float, default=admission.negative_ttl,
+		help="cache 404/410 responses for this many seconds, 0 (default) never caches them")
+	parser.add_argument("--no-sendfile", action="store_true",
+		help="serve disk hits with a read()/send() loop instead of sendfile")
+	parser.add_argument("--cache-writers", type=int, default=writebehind.DEFAULT_THREADS,
+		help="threads writing cache misses to disk behind the client, 0 writes in the client's thread (default %d)" % writebehind.DEFAULT_THREADS)
+	parser.add_argument("--write-behind-queue", type=common.parse_size, default="64M",
+		help="bytes of misses waiting for the cache writers at most, a miss that does not fit is not cached (default 64M)")
+	parser.add_argument("--no-splice", action="store_true",
+		help="relay the bodies of misses through Python buffers even where splice is available (Linux)")
+	parser.add_argument("--no-dedup", action="store_true",
+		help="store every cached object in its own file, even if another URL has the same body")
+	parser.add_argument("--no-compression", action="store_true",
+		help="always serve cached text as stored, never make or send gzip/brotli/zstd copies of it")
+	parser.add_argument("--prefetch", action="store_true",
+		help="when a miss stores an HTML page, fetch its same-origin images, scripts and stylesheets into the cache")
+	parser.add_argument("--prefetch-concurrency", type=int, default=prefetch.DEFAULT_CONCURRENCY,
+		help="prefetches running at a time (default %d)" % prefetch.DEFAULT_CONCURRENCY)
+	parser.add_argument("--prefetch-budget", type=common.parse_size, default="8M",
+		help="bytes prefetched for one page at most (default 8M)")
+	parser.add_argument("--keep-cache", action="store_true",
+		help="warm restart: reuse ./cache and its index from the previous run instead of wiping it")
+	parser.add_argument("--workers", type=int, default=1,
+		help="processes serving the port, each with its own memory tier and upstream pool (default 1)")
+	parser.add_argument("--reuseport", action="store_true",
+		help="with --workers, every worker binds its own SO_REUSEPORT socket instead of sharing one")
+	parser.add_argument("--metrics-port", type=int, default=0,
+		help="serve Prometheus metrics at http://<host>:PORT/metrics, worker n of --workers on PORT + n (default off)")
+	parser.add_argument("--log-level", choices=list(eventlog.LEVELS), default="info",
+		help="debug also logs parsing, fetch progress and closed connections (default info)")
+	parser.add_argument("--log-sample", type=float, default=1.0,
+		help="fraction of the per-request events (request, cache_hit, cache_miss, ...) to log (default 1)")
+	parser.add_argument("--log-format", choices=["text", "json"], default="text",
+		help="text: timestamp, level, event and key=value fields, json: one object per line")
+	parser.add_argument("--trace-file", default=None,
+		help="append per-phase timings of sampled requests to this JSONL file, see tracing.py and bench/trace_report.py")
+	parser.add_argument("--trace-sample", type=float, default=1.0,
+		help="fraction of requests traced with --trace-file, 0.01 traces every 100th (default 1)")
+	args = parser.parse_args()
+	if not 0 < args.log_sample <= 1:
+		parser.error("--log-sample must be in (0, 1]")
+	if not 0 < args.trace_sample <= 1:
+		parser.error("--trace-sample must be in (0, 1]")
+	if args.cache_writers < 0:
+		parser.error("--cache-writers must be at least 0")
+	if args.max_connections < 1 or args.accept_queue < 0 or args.backlog < 1:
+		parser.error("--max-connections and --backlog must be at least 1, --accept-queue at least 0")
+	if args.workers > 1 and not hasattr(os, "fork"):
+		parser.error("--workers needs os.fork")
 
-		# print('Received a connection from:', addr)
-	
-		# the following function starts a new thread, taking the function name as the first argument, and a tuple of arguments to the function as its second argument
-		thread.start_new_thread(client_thread, (clientFacingSocket, ))
+	# prepared once, the workers inherit the loaded index
+	index = common.open_cache(args.keep_cache, validate=args.workers == 1)
+	if args.workers > 1:
+		import workers
+		welcomeSocket = None
+		if not args.reuseport:
+			welcomeSocket = workers.listening_socket(args.port, args.backlog)
+			print('Proxy ready to serve at port', args.port, 'with', args.workers, 'workers')
 
-except KeyboardInterrupt:
-	print('bye...')
+		def run_worker(number):
+			if number == 0 and args.keep_cache:
+				index.validate_in_background()
+			start_worker(args, index, welcomeSocket or workers.listening_socket(args.port, args.backlog, True), number)
 
-finally:
-	# Fill in start         
-	#welcomeSocket.close()
-	force_close(welcomeSocket)   
-	# Fill in end
\ No newline at end of file
+		workers.serve(args.workers, run_worker)
+	else:
+		start_worker(args, index)
@@ -0,0 +1,206 @@
+# byte range requests answered from cached objects (RFC 9110 section 14)
+
+import os
+
+"""
+A GET with a Range header goes through the cache like any other GET: on a
+miss the whole object is fetched (the Range is not passed on) and cached,
+and the client gets only the bytes it asked for, cut out of the full
+response as it streams past. Hits cut them out of the cached copy.
+
+	Range: bytes=0-99         206, Content-Range: bytes 0-99/<length>
+	Range: bytes=0-9, -10     206, multipart/byteranges with one part per range
+	Range: bytes=5000-        416 if the object is shorter than that
+
+Overlapping and adjacent ranges are merged and the parts are sent in
+ascending order, so the body is read front to back exactly once. The whole
+response (a normal 200) is sent instead if:
+
+	- the stored response is not a 200 with a Content-Length (a chunked body
+	  has no byte positions before it is decoded)
+	- the Range is not a valid bytes range set, or asks for more than
+	  MAX_RANGES ranges
+	- If-Range does not match the cached copy's strong ETag or Last-Modified
+"""
+
+MAX_RANGES = 16
+
+
+def parse_range(value):
+	"""
+	"bytes=0-99, 200-, -50" -> [(0, 99), (200, None), (None, 50)], None if it
+	is not a valid bytes range set
+	"""
+	unit, sep, specs = value.partition("=")
+	if not sep or unit.strip().lower() != "bytes":
+		return None
+	ranges = []
+	for spec in specs.split(","):
+		spec = spec.strip()
+		if not spec:
+			continue
+		first, dash, last = spec.partition("-")
+		first, last = first.strip(), last.strip()
+		if not dash or not (first or last):
+			return None
+		if (first and not first.isdigit()) or (last and not last.isdigit()):
+			return None
+		if first and last and int(last) < int(first):
+			return None
+		ranges.append((int(first) if first else None, int(last) if last else None))
+	return ranges or None
+
+
+def resolve(ranges, length):
+	"""
+	the satisfiable ranges of a body of length bytes as sorted, merged
+	(start, end) positions, end included. [] if none of them is satisfiable
+	"""
+	spans = []
+	for first, last in ranges:
+		if first is None:
+			if last == 0 or length == 0:
+				continue
+			spans.append((max(0, length - last), length - 1))
+		elif first < length:
+			spans.append((first, length - 1 if last is None else min(last, length - 1)))
+	spans.sort()
+	merged = []
+	for start, end in spans:
+		if merged and start <= merged[-1][1] + 1:
+			merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+		else:
+			merged.append((start, end))
+	return merged
+
+
+def if_range_matches(value, headers):
+	"""
+	If-Range holds either an entity tag (compared strongly) or a date (compared exactly)
+	"""
+	value = value.strip()
+	if value.startswith('"') or value.startswith("W/"):
+		etag = headers.get("etag", "").strip()
+		return not value.startswith("W/") and not etag.startswith("W/") and value == etag
+	return value == headers.get("last-modified", "").strip()
+
+
+class RangeRequest:
+	"""
+	the Range (and If-Range) of a request the cache answers
+	"""
+	def __init__(self, value, ifRange=None):
+		self.value = value
+		self.if_range = ifRange
+
+	@classmethod
+	def from_headers(cls, headers):
+		"""
+		None if the request has no Range
+		"""
+		if "range" not in headers:
+			return None
+		return cls(headers["range"], headers.get("if-range"))
+
+	def plan(self, status, headers):
+		"""
+		how to answer from a stored response with this status and (lower-cased)
+		headers: a RangePlan, or None to send the whole response
+		"""
+		if status != 200 or "transfer-encoding" in headers or "content-range" in headers:
+			return None
+		try:
+			length = int(headers["content-length"])
+		except (KeyError, ValueError):
+			return None
+		if self.if_range is not None and not if_range_matches(self.if_range, headers):
+			return None
+		ranges = parse_range(self.value)
+		if ranges is None or len(ranges) > MAX_RANGES:
+			return None
+		return RangePlan(resolve(ranges, length), length, headers.get("content-type"))
+
+
+class RangePlan:
+	"""
+	the 206 (or 416) answer for a body of length bytes. segments is what goes
+	out after the head, in order: bytes sent as they are (multipart
+	boundaries and part headers) and (start, end) spans of the body
+	"""
+	def __init__(self, spans, length, contentType=None):
+		self.spans = spans
+		self.length = length
+		self.boundary = None
+		self.segments = list(spans)
+		if len(spans) > 1:
+			self.boundary = os.urandom(12).hex()
+			self.segments = []
+			for i, (start, end) in enumerate(spans):
+				part = ("\r\n" if i else "") + "--" + self.boundary + "\r\n"
+				if contentType:
+					part += "Content-Type: " + contentType + "\r\n"
+				part += "Content-Range: bytes %d-%d/%d\r\n\r\n" % (start, end, length)
+				self.segments.append(part.encode("latin-1"))
+				self.segments.append((start, end))
+			self.segments.append(("\r\n--" + self.boundary + "--\r\n").encode("latin-1"))
+		self.content_length = sum(len(s) if isinstance(s, bytes) else s[1] - s[0] + 1 for s in self.segments)
+		self.position = 0 # index of the next segment in segments
+
+	def head(self, storedHead):
+		"""
+		the stored 200 head turned into the 206/416 one (connection headers are added later)
+		"""
+		lines = storedHead.rstrip(b"\r\n").split(b"\r\n")
+		version = lines[0].split(b" ", 1)[0]
+		if not self.spans:
+			return b"%s 416 Range Not Satisfiable\r\nContent-Range: bytes */%d\r\nContent-Length: 0\r\n\r\n" % (
+				version, self.length)
+		drop = (b"content-length", b"content-range", b"content-type" if self.boundary else b"")
+		keep = [version + b" 206 Partial Content"]
+		for line in lines[1:]:
+			if line.split(b":", 1)[0].strip().lower() not in drop:
+				keep.append(line)
+		if self.boundary:
+			keep.append(b"Content-Type: multipart/byteranges; boundary=" + self.boundary.encode("latin-1"))
+		else:
+			start, end = self.spans[0]
+			keep.append(b"Content-Range: bytes %d-%d/%d" % (start, end, self.length))
+		keep.append(b"Content-Length: %d" % self.content_length)
+		return b"\r\n".join(keep) + b"\r\n\r\n"
+
+	def take(self, data, offset):
+		"""
+		what to send for data, the piece of the body that starts at offset.
+		pieces have to come in order
+		"""
+		out = []
+		end = offset + len(data)
+		while self.position < len(self.segments):
+			segment = self.segments[self.position]
+			if isinstance(segment, bytes):
+				out.append(segment)
+				self.position += 1
+				continue
+			start, last = segment
+			if end <= start:
+				break
+			if offset <= last:
+				out.append(data[max(start, offset) - offset:min(last + 1, end) - offset])
+			if last >= end:
+				break
+			self.position += 1
+		return b"".join(out)
+
+	def rest(self, offset):
+		"""
+		the segments left once the body up to offset went through take(), with
+		spans as (start, count) for sendfile
+		"""
+		for segment in self.segments[self.position:]:
+			if isinstance(segment, bytes):
+				yield segment
+			else:
+				start = max(segment[0], offset)
+				if segment[1] >= start:
+					yield start, segment[1] + 1 - start
+		self.position = len(self.segments)
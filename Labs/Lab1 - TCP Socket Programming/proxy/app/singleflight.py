@@ -0,0 +1,234 @@
+# single-flight table for cache misses
+
+import asyncio
+import os
+import tempfile
+import threading
+
+import blobstore
+
+"""
+When many clients ask for the same cold resource at once (a cache stampede),
+only the first one (the leader) goes to the origin. It writes the response
+into a temp file next to the cache file. Everyone else who misses while the
+fetch is in flight (the followers) streams from that same temp file as the
+bytes land, and the leader publishes the file with an atomic rename when it
+is done. The origin sees exactly one request per stampede.
+
+	HIT:    cache file exists, read it
+	LEAD:   nobody is fetching it, fetch from the origin into the temp file
+	FOLLOW: someone else is fetching it, tail their temp file
+"""
+
+HIT = "hit"
+LEAD = "lead"
+FOLLOW = "follow"
+
+
+class Flight:
+	"""
+	one in-progress fetch. written only grows, done is set once by the leader
+	"""
+	def __init__(self, key, tmp_path, url=None):
+		self.key = key
+		self.tmp_path = tmp_path
+		self.url = url
+		self.written = 0
+		self.done = False
+		self.failed = False
+		self.revalidated = False # the origin said 304, serve the cached copy instead
+		self.followers = 0 # clients that joined it, counted under the table's lock
+		self.hashed = False
+		self.body = None # (digest, body offset) of the complete temp file, see FlightTable.hash_body
+		self.cond = threading.Condition()
+
+	def wrote(self, n):
+		with self.cond:
+			self.written += n
+			self.cond.notify_all()
+
+	def finish(self, failed=False):
+		with self.cond:
+			self.done = True
+			self.failed = failed
+			self.cond.notify_all()
+
+	def wait(self, offset, timeout):
+		"""
+		blocks until there are bytes past offset or the leader is done.
+		returns how many bytes have been written so far
+		"""
+		with self.cond:
+			self.cond.wait_for(lambda: self.written > offset or self.done, timeout)
+			return self.written
+
+
+class AsyncFlight(Flight):
+	"""
+	same thing for the asyncio engine, waiters are coroutines on the one loop
+	"""
+	def __init__(self, key, tmp_path, url=None):
+		super().__init__(key, tmp_path, url)
+		self.changed = asyncio.Event()
+
+	def _notify(self):
+		self.changed.set()
+		self.changed = asyncio.Event()
+
+	def wrote(self, n):
+		self.written += n
+		self._notify()
+
+	def finish(self, failed=False):
+		self.done = True
+		self.failed = failed
+		self._notify()
+
+	async def wait(self, offset, timeout):
+		if self.written <= offset and not self.done:
+			try:
+				await asyncio.wait_for(self.changed.wait(), timeout)
+			except asyncio.TimeoutError:
+				pass
+		return self.written
+
+
+class FlightTable:
+	"""
+	in-flight fetches keyed by cache file path. with an index (cacheindex.py)
+	a file on disk only counts as a hit if the index vouches for it
+	"""
+	def __init__(self, flight_class=Flight, index=None):
+		self.flight_class = flight_class
+		self.index = index
+		self.flights = {}
+		self.lock = threading.Lock()
+
+	def _open_cached(self, file_to_use):
+		f = open(file_to_use, "rb")
+		if self.index is not None and not self.index.check(file_to_use, os.fstat(f.fileno()).st_size):
+			# orphaned or truncated, fetch it again and let the rename replace it
+			f.close()
+			raise FileNotFoundError(file_to_use)
+		return f
+
+	def open(self, file_to_use, revalidate=False, url=None):
+		"""
+		returns (HIT, None, cached file), (FOLLOW, flight, temp file opened for reading)
+		or (LEAD, flight, temp file opened for writing). with revalidate the
+		cached copy is stale and never a HIT, the leader asks the origin about it.
+		url is what gets recorded in the index for a published object
+		"""
+		if not revalidate:
+			try:
+				return HIT, None, self._open_cached(file_to_use)
+			except FileNotFoundError:
+				pass
+
+		with self.lock:
+			flight = self.flights.get(file_to_use)
+			if flight is not None:
+				# the leader only renames the temp file while holding the lock, so it is still there
+				f = open(flight.tmp_path, "rb")
+				flight.followers += 1
+				return FOLLOW, flight, f
+
+			# the leader may have published between the first open and taking the lock
+			if not revalidate:
+				try:
+					return HIT, None, self._open_cached(file_to_use)
+				except FileNotFoundError:
+					pass
+
+			fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_to_use), prefix=".inflight-", suffix=".tmp")
+			flight = self.flight_class(file_to_use, tmp_path, url)
+			self.flights[file_to_use] = flight
+			# unbuffered, followers read the bytes from disk as soon as they are written
+			return LEAD, flight, os.fdopen(fd, "wb", buffering=0)
+
+	def abandon(self, flight):
+		"""
+		takes a flight nobody follows out of the table, the leader goes on
+		without caching (writebehind.py) and requests that come in meanwhile
+		fetch it themselves. returns False if it has followers
+		"""
+		with self.lock:
+			if flight.followers:
+				return False
+			self._remove(flight)
+			return True
+
+	def _remove(self, flight):
+		# called with the lock held. an abandoned flight's key may have a new leader already
+		if self.flights.get(flight.key) is flight:
+			del self.flights[flight.key]
+
+	def hash_body(self, flight):
+		"""
+		digests the body of the complete temp file for publish, to share it
+		with other URLs (blobstore.py). reads the whole file, so the asyncio
+		engine calls it off the event loop first: on the cache writer thread
+		that closed the file, or in the loop's executor without cache writers.
+		publish calls it itself if it was not
+		"""
+		if flight.hashed or self.index is None or not blobstore.enabled:
+			return
+		flight.hashed = True
+		try:
+			flight.body = self.index.blobs.digest(flight.tmp_path)
+		except OSError:
+			pass # publish finds out
+
+	def publish(self, flight, failed=False, admit=True):
+		"""
+		called by the leader once the temp file is closed: rename it into place
+		(or throw it away) and wake up the followers. admit=False means the
+		response was complete but must not be cached (see admission.py), any
+		older copy is dropped too
+		"""
+		if not failed and admit:
+			self.hash_body(flight)
+		with self.lock:
+			try:
+				if failed or not admit:
+					os.unlink(flight.tmp_path)
+					if not failed and self.index is not None:
+						self.index.remove(flight.key)
+				else:
+					path, previous = flight.tmp_path, None
+					# the record first, other workers check the object against it (see cacheindex.py)
+					if self.index is not None:
+						fields = None
+						if flight.body is not None:
+							path, fields = self.index.blobs.share(flight.tmp_path, *flight.body)
+						previous = self.index.get(flight.key)
+						self.index.add(flight.key, flight.url, flight.tmp_path, fields)
+					os.replace(path, flight.key)
+					if path != flight.tmp_path:
+						# the body is in the blob already, this copy of it goes
+						os.unlink(flight.tmp_path)
+					if previous is not None:
+						self.index.blobs.release(previous.get("blob"))
+			except OSError:
+				failed = True
+			finally:
+				self._remove(flight)
+		flight.finish(failed)
+
+	def refresh(self, flight, head):
+		"""
+		called by the leader instead of publish when the origin answered 304: the
+		cached copy stays (with renewed freshness), the empty temp file goes, and
+		the followers are told to serve the cached copy
+		"""
+		with self.lock:
+			try:
+				os.unlink(flight.tmp_path)
+				if self.index is not None:
+					self.index.refresh(flight.key, head)
+			except OSError:
+				pass
+			finally:
+				self._remove(flight)
+		flight.revalidated = True
+		flight.finish()
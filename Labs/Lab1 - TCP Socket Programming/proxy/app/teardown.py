@@ -0,0 +1,201 @@
+# one thread that closes client connections gracefully and watches idle keep-alive ones
+
+import select
+import selectors
+import threading
+import time
+from collections import deque
+from socket import SHUT_WR
+
+import eventlog
+
+"""
+force_close (proxy.py) gave the client half a second to finish before
+closing, by reading from the socket until then, in the thread that had just
+served it. Every closed connection kept its worker busy for up to 0.5s, and
+an idle keep-alive connection kept one busy for up to --client-idle-timeout
+waiting for the next request. With the workers capped (overload.py) that is
+capacity spent on nothing. The Reaper takes both kinds of waiting off the
+workers:
+
+	close(sock)    sends our FIN right away (shutdown(SHUT_WR)), reads what
+	               the client still sends and closes once it closes too, or
+	               LINGER seconds later. closing with unread data would reset
+	               the connection and could destroy the end of the response
+	park(sock, timeout, resume, expired)
+	               an idle keep-alive connection: resume(sock) is called as
+	               soon as it is readable (the next request, or the client's
+	               FIN), or after timeout it is close()d and expired() is called
+
+One selector watches every socket. Each kind has a fixed timeout, so its
+deadlines come in order and sit in a deque: every TICK the expired ones are
+taken off the front in one go, without a timer per connection.
+"""
+
+# seconds a closed connection waits for the client's FIN, like the old force_close
+LINGER = 0.5
+# how often deadlines are checked, a connection may outstay its timeout by this much
+TICK = 0.05
+# beyond this many lingering connections new ones are closed right away
+MAX_LINGERING = 10000
+# a worker waits this long for the next request itself before parking the connection
+IDLE_GRACE = 0.005
+
+LINGERING = "lingering"
+PARKED = "parked"
+
+
+class Watched:
+	"""
+	a socket the reaper holds on to. token tells a deadline entry for this
+	registration from an older one of the same descriptor number
+	"""
+	def __init__(self, sock, kind, token, resume=None, expired=None):
+		self.sock = sock
+		self.kind = kind
+		self.token = token
+		self.resume = resume
+		self.expired = expired
+
+
+class Reaper:
+
+	def __init__(self, linger=LINGER, maxLingering=MAX_LINGERING):
+		self.linger = linger
+		self.max_lingering = maxLingering
+		self.selector = selectors.DefaultSelector()
+		self.lock = threading.Lock()
+		self.watched = {} # fd -> Watched
+		self.deadlines = {LINGERING: deque(), PARKED: deque()} # (deadline, fd, token), oldest first
+		self.tokens = 0
+		self.lingering = 0
+		self.closed = 0
+		self.expired = 0
+		self.resumed = 0
+
+	def start(self):
+		threading.Thread(target=self._run, name="reaper", daemon=True).start()
+
+	def close(self, sock):
+		"""
+		half-closes sock and leaves the rest to the reaper thread, never blocks
+		"""
+		try:
+			sock.shutdown(SHUT_WR)
+			sock.setblocking(False)
+			if not _drain(sock):
+				sock.close() # the client is done already
+				return
+		except OSError:
+			sock.close()
+			return
+		if self.lingering >= self.max_lingering:
+			sock.close()
+			return
+		self._watch(sock, LINGERING, self.linger)
+
+	def park(self, sock, timeout, resume, expired=None):
+		"""
+		hands an idle keep-alive connection to the reaper thread, see the top of the file
+		"""
+		self._watch(sock, PARKED, timeout, resume, expired)
+
+	def _watch(self, sock, kind, timeout, resume=None, expired=None):
+		fd = sock.fileno()
+		with self.lock:
+			self.tokens += 1
+			self.watched[fd] = Watched(sock, kind, self.tokens, resume, expired)
+			self.deadlines[kind].append((time.monotonic() + timeout, fd, self.tokens))
+			if kind == LINGERING:
+				self.lingering += 1
+			self.selector.register(fd, selectors.EVENT_READ)
+
+	def _forget(self, fd):
+		# called with the lock held, before the socket is closed or handed back
+		watched = self.watched.pop(fd)
+		self.selector.unregister(fd)
+		if watched.kind == LINGERING:
+			self.lingering -= 1
+		return watched
+
+	def _run(self):
+		while True:
+			try:
+				self._step()
+			except Exception:
+				eventlog.exception("reaper_failed")
+
+	def _step(self):
+		events = self.selector.select(TICK)
+		done = []
+		for key, _ in events:
+			with self.lock:
+				watched = self.watched.get(key.fd)
+				if watched is None:
+					continue
+				if watched.kind == PARKED or not _drain(watched.sock):
+					done.append(self._forget(key.fd))
+		for watched in done:
+			if watched.kind == PARKED:
+				self.resumed += 1
+				watched.resume(watched.sock)
+			else:
+				self.closed += 1
+				watched.sock.close()
+		self._expire(time.monotonic())
+
+	def _expire(self, now):
+		expired = []
+		with self.lock:
+			for deadlines in self.deadlines.values():
+				while deadlines and deadlines[0][0] <= now:
+					_, fd, token = deadlines.popleft()
+					watched = self.watched.get(fd)
+					if watched is not None and watched.token == token:
+						expired.append(self._forget(fd))
+		for watched in expired:
+			self.expired += 1
+			if watched.kind == PARKED:
+				# idle for too long, it still gets the graceful close
+				self.close(watched.sock)
+			else:
+				watched.sock.close()
+			if watched.expired is not None:
+				watched.expired()
+
+	def stats_line(self):
+		with self.lock:
+			parked = len(self.watched) - self.lingering
+			return "reaper: %d closed by the client, %d expired, %d resumed, %d lingering, %d parked" % (
+				self.closed, self.expired, self.resumed, self.lingering, parked)
+
+
+def readable(sock, timeout):
+	"""
+	waits up to timeout seconds (None: for good) for sock to have something
+	to read. poll() where there is one, select() cannot watch descriptors
+	past 1024. zerocopy.py waits on origins with it too
+	"""
+	try:
+		if hasattr(select, "poll"):
+			poller = select.poll()
+			poller.register(sock, select.POLLIN)
+			return bool(poller.poll(None if timeout is None else timeout * 1000))
+		return bool(select.select([sock], [], [], timeout)[0])
+	except (OSError, ValueError):
+		return True # let the caller's recv() find out what is wrong
+
+
+def _drain(sock):
+	"""
+	reads and drops what a non-blocking socket has, returns False once the
+	client has closed its side (or the connection is broken)
+	"""
+	try:
+		while True:
+			if not sock.recv(65536):
+				return False
+	except BlockingIOError:
+		return True
+	except OSError:
+		return False
@@ -0,0 +1,147 @@
+# sampled per-request phase timings, written as JSON lines to --trace-file
+
+import json
+import os
+import time
+
+import batchwriter
+
+"""
+metrics.py says how long requests take, not where the time goes. With
+--trace-file, a sample of the requests (--trace-sample) carry a Trace, and
+every engine step marks the monotonic time the phase it just finished ended
+at. Each phase then lasted from the previous mark (or the start) to its own:
+
+	queued        the first request of a connection: accept() -> a worker
+	              (threads) or a connection slot (asyncio) took it, see overload.py
+	head          -> the request head was read and parsed. a later request on
+	              a keep-alive connection starts once its head is in instead,
+	              the client's think time between requests is not latency
+	lookup        -> memory tier / index / single-flight table consulted
+	pool          -> an idle upstream connection was taken from the pool
+	dns           -> the origin's name was resolved, dnscache.py
+	connect       -> a new upstream connection was established
+	first_byte    -> the first byte of the origin's response arrived
+	transfer      -> the last byte of the response was handed to the client
+	close         -> the connection was handed to the teardown (teardown.py).
+	              only for a request the proxy closes the connection after
+	              (Connection: close, the last one allowed, errors)
+
+A phase that did not happen (no origin on a hit, no dns on a reused
+connection) is just not in the record. One record per line:
+
+	{"time": 1760793246.123, "pid": 4242, "engine": "threads", "method": "GET",
+	 "target": "http://127.0.0.1/a.gif", "outcome": "miss", "bytes": 5512,
+	 "total": 0.0123, "phases": {"head": 0.0002, "lookup": 0.00003, ...}}
+
+Durations are in seconds. Like eventlog.py, a request thread only appends to
+a bounded queue and a background thread writes the batches (batchwriter.py),
+with one append-mode write() each, so --workers processes can share one file.
+bench/trace_report.py turns trace files into a per-phase latency breakdown.
+"""
+
+QUEUE_SIZE = 10000
+FLUSH_INTERVAL = 0.2
+
+# set by start() from --trace-file and --trace-sample, path None traces nothing
+path = None
+sample_every = 1
+engine = "threads"
+
+_count = 0
+
+
+class Trace:
+	"""
+	the phase marks of one request, see the top of the file
+	"""
+	def __init__(self, started=None):
+		self.started = started if started is not None else time.monotonic()
+		self.wall = time.time() - (time.monotonic() - self.started)
+		self.marks = []
+
+	def mark(self, phase, when=None):
+		self.marks.append((phase, when if when is not None else time.monotonic()))
+
+	def record(self, request, exchange):
+		phases = {}
+		last = self.started
+		for phase, when in self.marks:
+			# a retried fetch has two connects, they add up
+			phases[phase] = phases.get(phase, 0.0) + (when - last)
+			last = when
+		return {
+			"time": round(self.wall, 3),
+			"pid": os.getpid(),
+			"engine": engine,
+			"method": request.method if request is not None else None,
+			"target": request.target if request is not None else None,
+			"outcome": exchange.outcome if exchange is not None else None,
+			"bytes": exchange.sent if exchange is not None else 0,
+			"total": round(last - self.started, 6),
+			"phases": {phase: round(seconds, 6) for phase, seconds in phases.items()},
+		}
+
+
+def begin(started=None):
+	"""
+	a Trace for the next request if tracing is on and it is picked by the
+	sampling, else None. started: when it began, now if None
+	"""
+	global _count
+	if path is None:
+		return None
+	if sample_every > 1:
+		# unlocked, a lost increment only shifts which request gets picked
+		_count += 1
+		if _count % sample_every:
+			return None
+	return Trace(started)
+
+
+def finish(trace, request, exchange):
+	"""
+	queues the record of a traced request, trace None is fine
+	"""
+	if trace is None:
+		return
+	_writer.put(trace.record(request, exchange))
+
+
+def _format(record):
+	return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+
+def _dropped_line(count):
+	return json.dumps({"time": round(time.time(), 3), "pid": os.getpid(), "dropped": count})
+
+
+def _write(text):
+	# one O_APPEND write() per batch, the batches of several processes do not interleave
+	fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+	try:
+		os.write(fd, text.encode("utf-8"))
+	finally:
+		os.close(fd)
+
+
+_writer = batchwriter.BatchWriter("trace-writer", _format, _write, _dropped_line, QUEUE_SIZE, FLUSH_INTERVAL)
+
+
+def flush():
+	return _writer.flush()
+
+
+def start(tracePath, sampleEvery=1, engineName="threads"):
+	"""
+	turns tracing on and starts the writer thread (per worker in --workers mode)
+	"""
+	global path, sample_every, engine
+	path = tracePath
+	sample_every = max(1, sampleEvery)
+	engine = engineName
+	_writer.start()
+
+
+def close(timeout=1.0):
+	_writer.close(timeout)
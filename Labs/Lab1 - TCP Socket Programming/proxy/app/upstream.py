@@ -0,0 +1,352 @@
+# persistent (keep-alive) connections to origin servers
+
+import asyncio
+import select
+import socket
+import threading
+import time
+
+import dnscache
+from httpparse import FramingError, ResponseFramer
+
+"""
+Instead of one TCP connection (handshake + slow start) per cache miss, the
+proxy keeps a small pool of idle HTTP/1.1 connections per origin and reuses
+them for the next miss to the same host:port.
+
+A connection can only go back to the pool if we know exactly where the
+response ended: ResponseFramer (httpparse.py) follows the Content-Length or
+chunked framing of the raw response bytes as they are relayed, responses
+delimited by the origin closing are never reusable.
+
+New connections go to addresses from the pool's resolver (dnscache.py), the
+origin's name is not looked up again for every one of them.
+"""
+
+CHUNK_SIZE = 4096
+# a request of these methods can safely be sent a second time
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE")
+
+
+def split_host(webServer, default_port=80):
+	"""
+	Host header value -> (host, port), "example.com:8000" -> ("example.com", 8000)
+	"""
+	if webServer.startswith("["): # [::1]:8080
+		host, _, rest = webServer[1:].partition("]")
+		port = rest[1:] if rest.startswith(":") else ""
+	else:
+		host, _, port = webServer.partition(":")
+	return host, int(port) if port.isdigit() else default_port
+
+
+def open_socket(addresses, timeout):
+	"""
+	socket.create_connection for addresses that are resolved already: the first one that accepts
+	"""
+	error = None
+	for family, socktype, proto, sockaddr in addresses:
+		s = socket.socket(family, socktype, proto)
+		try:
+			s.settimeout(timeout)
+			s.connect(sockaddr)
+			return s
+		except OSError as e:
+			error = e
+			s.close()
+	raise error or OSError("no addresses to connect to")
+
+
+def upstream_request(head):
+	"""
+	the client's raw request head with its hop-by-hop connection headers
+	replaced by Connection: keep-alive, so the origin keeps the connection open for the pool
+	"""
+	lines = head.rstrip(b"\r\n").split(b"\r\n")
+	keep = [lines[0]]
+	for line in lines[1:]:
+		name = line.split(b":", 1)[0].strip().lower()
+		if name not in (b"connection", b"proxy-connection", b"keep-alive"):
+			keep.append(line)
+	keep.append(b"Connection: keep-alive")
+	return b"\r\n".join(keep) + b"\r\n\r\n"
+
+
+class ConnectionPool:
+	"""
+	idle keep-alive connections per (host, port), at most max_per_host open at once per origin
+	"""
+	def __init__(self, max_per_host=8, idle_timeout=30.0, timeout=5.0, resolver=None):
+		self.max_per_host = max_per_host
+		self.resolver = resolver or dnscache.Resolver()
+		self.idle_timeout = idle_timeout
+		self.timeout = timeout
+		self.idle = {} # (host, port) -> [(socket, time it went idle)], most recent last
+		self.slots = {} # (host, port) -> semaphore limiting open connections
+		self.lock = threading.Lock()
+		self.last_sweep = time.monotonic()
+		self.connects = 0
+		self.reuses = 0
+
+	def _slot(self, key):
+		with self.lock:
+			slot = self.slots.get(key)
+			if slot is None:
+				slot = self.slots[key] = threading.BoundedSemaphore(self.max_per_host)
+			return slot
+
+	def acquire(self, host, port, reuse=True, trace=None):
+		"""
+		returns (socket, reused). the caller must hand it back with release().
+		reuse=False always opens a new connection. trace (tracing.Trace) gets
+		the pool, or dns and connect, phases
+		"""
+		key = (host, port)
+		if not self._slot(key).acquire(timeout=self.timeout):
+			raise TimeoutError("too many connections to %s:%d" % key)
+		try:
+			self._sweep()
+			while reuse:
+				with self.lock:
+					idle = self.idle.get(key)
+					if not idle:
+						break
+					s, since = idle.pop()
+				if time.monotonic() - since < self.idle_timeout and self._usable(s):
+					with self.lock:
+						self.reuses += 1
+					if trace is not None:
+						trace.mark("pool")
+					return s, True
+				s.close()
+
+			addresses = self.resolver.resolve(host, port)
+			if trace is not None:
+				trace.mark("dns")
+			s = open_socket(addresses, self.timeout)
+			if trace is not None:
+				trace.mark("connect")
+			with self.lock:
+				self.connects += 1
+			return s, False
+		except:
+			self.slots[key].release()
+			raise
+
+	def release(self, host, port, s, reusable):
+		key = (host, port)
+		if reusable:
+			with self.lock:
+				self.idle.setdefault(key, []).append((s, time.monotonic()))
+		else:
+			s.close()
+		self.slots[key].release()
+
+	def _usable(self, s):
+		"""
+		an idle connection should have nothing to read: readable means the origin
+		closed it (or sent something we did not ask for)
+		"""
+		try:
+			readable, _, _ = select.select([s], [], [], 0)
+		except (OSError, ValueError):
+			return False
+		return not readable
+
+	def _sweep(self):
+		"""
+		closes connections that sat idle past the timeout, at most every idle_timeout / 2
+		"""
+		now = time.monotonic()
+		if now - self.last_sweep < self.idle_timeout / 2:
+			return
+		expired = []
+		with self.lock:
+			self.last_sweep = now
+			for key, idle in self.idle.items():
+				fresh = [(s, since) for s, since in idle if now - since < self.idle_timeout]
+				expired += [s for s, since in idle if now - since >= self.idle_timeout]
+				self.idle[key] = fresh
+		for s in expired:
+			self._discard(s)
+
+	def _discard(self, s):
+		s.close()
+
+	def fetch(self, host, port, request, sink, method="GET", body=None, splice=None, trace=None):
+		"""
+		sends request (the head) and the pieces of body to the origin and passes
+		every raw byte of the response to sink. a reused connection that turns
+		out to be dead before anything arrived is retried once on a fresh one.
+		requests that cannot be repeated (a body, POST) go on a fresh connection.
+		splice(sock, count) is offered the rest of a Content-Length body once
+		the head is through sink: it returns how many bytes it took off sock
+		itself (all of them, or 0 to leave them to sink). trace (tracing.Trace)
+		is told about the upstream phases
+		"""
+		retry = body is None and method in IDEMPOTENT_METHODS
+		for attempt in range(2):
+			s, reused = self.acquire(host, port, retry, trace)
+			framer = ResponseFramer(method)
+			received = 0
+			reusable = False
+			try:
+				s.sendall(request)
+				for piece in body or ():
+					s.sendall(piece)
+				while not framer.done:
+					buff = s.recv(CHUNK_SIZE)
+					if not buff:
+						if framer.eof():
+							break
+						raise ConnectionError("origin closed the connection mid-response")
+					if not received and trace is not None:
+						trace.mark("first_byte")
+					used = framer.feed(buff)
+					received += len(buff)
+					sink(buff[:used])
+					if used < len(buff):
+						# bytes past the end of the response, the connection is out of sync
+						framer.keep_alive = False
+					if splice is not None and framer.head_complete:
+						if not framer.done and not framer.until_close and framer.chunk_state is None:
+							moved = splice(s, framer.remaining)
+							framer.skipped(moved)
+							received += moved
+						splice = None
+				reusable = framer.keep_alive
+				return framer
+			except (ConnectionError, TimeoutError):
+				if reused and received == 0 and attempt == 0:
+					continue
+				raise
+			finally:
+				self.release(host, port, s, reusable)
+
+	def close(self):
+		with self.lock:
+			idle, self.idle = self.idle, {}
+		for conns in idle.values():
+			for s, since in conns:
+				s.close()
+
+	def stats_line(self):
+		with self.lock:
+			idle = sum(len(conns) for conns in self.idle.values())
+			return "upstream pool: %d connects, %d reuses, %d idle connections" % (self.connects, self.reuses, idle)
+
+
+class AsyncConnectionPool(ConnectionPool):
+	"""
+	the same pool for the asyncio engine, connections are (reader, writer) pairs
+	"""
+	def _slot(self, key):
+		slot = self.slots.get(key)
+		if slot is None:
+			slot = self.slots[key] = asyncio.BoundedSemaphore(self.max_per_host)
+		return slot
+
+	async def acquire(self, host, port, reuse=True, trace=None):
+		key = (host, port)
+		try:
+			await asyncio.wait_for(self._slot(key).acquire(), self.timeout)
+		except asyncio.TimeoutError:
+			raise TimeoutError("too many connections to %s:%d" % key)
+		try:
+			self._sweep()
+			now = time.monotonic()
+			idle = self.idle.get(key) if reuse else None
+			while idle:
+				conn, since = idle.pop()
+				reader, writer = conn
+				if now - since < self.idle_timeout and not reader.at_eof() and not writer.is_closing():
+					self.reuses += 1
+					if trace is not None:
+						trace.mark("pool")
+					return conn, True
+				writer.close()
+			conn = await asyncio.wait_for(self._open(host, port, trace), self.timeout)
+			self.connects += 1
+			return conn, False
+		except:
+			self.slots[key].release()
+			raise
+
+	async def _open(self, host, port, trace=None):
+		error = None
+		addresses = await self.resolver.resolve_async(host, port)
+		if trace is not None:
+			trace.mark("dns")
+		for family, socktype, proto, sockaddr in addresses:
+			try:
+				# an IP address, asyncio does not look it up again
+				conn = await asyncio.open_connection(sockaddr[0], sockaddr[1], family=family)
+				if trace is not None:
+					trace.mark("connect")
+				return conn
+			except OSError as e:
+				error = e
+		raise error or OSError("no addresses to connect to")
+
+	def release(self, host, port, conn, reusable):
+		key = (host, port)
+		if reusable:
+			self.idle.setdefault(key, []).append((conn, time.monotonic()))
+		else:
+			conn[1].close()
+		self.slots[key].release()
+		# origins that are never asked again would keep their connections forever otherwise
+		self._sweep()
+
+	def _discard(self, conn):
+		conn[1].close()
+
+	async def fetch(self, host, port, request, sink, method="GET", body=None, trace=None):
+		"""
+		sink is a coroutine function here and body an async iterator
+		"""
+		retry = body is None and method in IDEMPOTENT_METHODS
+		for attempt in range(2):
+			conn, reused = await self.acquire(host, port, retry, trace)
+			reader, writer = conn
+			framer = ResponseFramer(method)
+			received = 0
+			reusable = False
+			try:
+				writer.write(request)
+				await writer.drain()
+				if body is not None:
+					async for piece in body:
+						writer.write(piece)
+						await writer.drain()
+				while not framer.done:
+					buff = await asyncio.wait_for(reader.read(CHUNK_SIZE), self.timeout)
+					if not buff:
+						if framer.eof():
+							break
+						raise ConnectionError("origin closed the connection mid-response")
+					if not received and trace is not None:
+						trace.mark("first_byte")
+					used = framer.feed(buff)
+					received += len(buff)
+					await sink(buff[:used])
+					if used < len(buff):
+						framer.keep_alive = False
+				reusable = framer.keep_alive
+				return framer
+			except (ConnectionError, asyncio.TimeoutError):
+				if reused and received == 0 and attempt == 0:
+					continue
+				raise
+			finally:
+				self.release(host, port, conn, reusable)
+
+	def close(self):
+		idle, self.idle = self.idle, {}
+		for conns in idle.values():
+			for conn, since in conns:
+				self._discard(conn)
+
+	def stats_line(self):
+		idle = sum(len(conns) for conns in self.idle.values())
+		return "upstream pool: %d connects, %d reuses, %d idle connections" % (self.connects, self.reuses, idle)
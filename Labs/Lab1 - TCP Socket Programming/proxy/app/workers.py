@@ -0,0 +1,112 @@
+# --workers N: several proxy processes serving one port
+
+import os
+import signal
+import sys
+import time
+import traceback
+from socket import *
+
+"""
+One Python process serves at most one core's worth of cache hits, whichever
+engine it runs. With --workers N the proxy forks N copies of itself after the
+cache directory is prepared:
+
+	- by default the parent binds the listening socket and every worker
+	  accepts on the inherited copy, the kernel hands each connection to one
+	  of them
+	- with --reuseport every worker binds its own socket with SO_REUSEPORT
+	  and the kernel spreads connections over the sockets, no worker wakes up
+	  for a connection another one gets
+
+Each worker has its own memory tier, upstream pool and single-flight table,
+they only share the disk cache (see cacheindex.py for how objects published
+by one worker become hits in the others). The parent does not serve, it
+restarts workers that crash and on SIGINT stops them all.
+"""
+
+# seconds the workers get to finish after SIGINT before they are killed
+SHUTDOWN_TIMEOUT = 3.0
+# a worker that dies sooner than this after starting is not restarted, it would just die again
+MIN_UPTIME = 1.0
+
+
+def listening_socket(proxy_port, backlog, reuseport=False):
+	welcomeSocket = socket(AF_INET, SOCK_STREAM)
+	if reuseport:
+		welcomeSocket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+	welcomeSocket.bind(("", proxy_port))
+	welcomeSocket.listen(backlog)
+	return welcomeSocket
+
+
+def _stop_once(signum, frame):
+	# a terminal ^C reaches the whole process group and the parent forwards it too, stop only once
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_IGN)
+	raise KeyboardInterrupt
+
+
+def _spawn(run, number):
+	# whatever the parent has buffered would be printed again by every child
+	sys.stdout.flush()
+	pid = os.fork()
+	if pid:
+		return pid
+	code = 0
+	try:
+		signal.signal(signal.SIGINT, _stop_once)
+		signal.signal(signal.SIGTERM, _stop_once)
+		run(number)
+	except KeyboardInterrupt:
+		pass
+	except BaseException:
+		traceback.print_exc()
+		code = 1
+	finally:
+		sys.stdout.flush()
+		sys.stderr.flush()
+		os._exit(code)
+
+
+def serve(count, run):
+	"""
+	forks count workers that each call run(number) and supervises them until
+	SIGINT. run serves until it gets KeyboardInterrupt
+	"""
+	workers = {} # pid -> (number, started)
+	for number in range(count):
+		workers[_spawn(run, number)] = (number, time.monotonic())
+
+	try:
+		while workers:
+			pid, status = os.wait()
+			number, started = workers.pop(pid)
+			if status == 0:
+				continue
+			if time.monotonic() - started < MIN_UPTIME:
+				print('worker', number, 'failed right after starting, not restarting it')
+				continue
+			print('worker', number, 'died (status %d), restarting it' % status)
+			workers[_spawn(run, number)] = (number, time.monotonic())
+	except KeyboardInterrupt:
+		print('stopping', len(workers), 'workers...')
+		stop(workers)
+
+
+def stop(workers):
+	for pid in workers:
+		try:
+			os.kill(pid, signal.SIGINT)
+		except ProcessLookupError:
+			pass
+	deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+	while workers and time.monotonic() < deadline:
+		pid, status = os.waitpid(-1, os.WNOHANG)
+		if pid:
+			workers.pop(pid, None)
+		else:
+			time.sleep(0.05)
+	for pid in workers:
+		os.kill(pid, signal.SIGKILL)
+		os.waitpid(pid, 0)
@@ -0,0 +1,183 @@
+# write-behind for cache misses: writer threads put the fetched bytes on disk
+
+import os
+import queue
+import threading
+
+import eventlog
+import metrics
+
+"""
+A miss used to write every chunk from the origin to the flight's temp file
+before sending it to the client, so a slow disk slowed the client down. With
+a CacheWriter the leader only queues the chunk and sends it on:
+
+	leader    stream.write(chunk) ----> writer thread: one write() for all the
+	          send chunk to client      chunks of the stream queued so far,
+	          ...                       then on_written(n), the followers of
+	          stream.close(on_closed)   the flight can read them
+	                                    ... on_closed(ok) once it is all on disk:
+	                                    the leader's callback publishes the temp
+	                                    file with its atomic rename (singleflight.py)
+
+Every stream is written by one writer thread, in order. The chunks waiting
+in all streams are bounded by max_bytes: write() returns False when a chunk
+does not fit and the caller drops the object from the cache instead of
+waiting for the disk (proxy.fetch_and_cache), or forces it in if other
+clients are reading the temp file (a flight with followers), so the bound is
+soft for those.
+"""
+
+DEFAULT_THREADS = 2
+DEFAULT_QUEUE_BYTES = 64 * 1024 * 1024
+
+
+class Stream:
+	"""
+	the queued writes of one open temp file, see CacheWriter.open
+	"""
+	def __init__(self, writer, queue, f, on_written):
+		self.writer = writer
+		self.queue = queue # of the thread that writes this stream
+		self.f = f
+		self.on_written = on_written
+		self.on_closed = None
+		self.chunks = []
+		self.queued = 0 # bytes in chunks
+		self.scheduled = False # on its thread's queue, or being written
+		self.closing = False
+		self.ok = True
+		self.cond = threading.Condition()
+
+	def write(self, data, force=False):
+		"""
+		queues data behind the earlier writes, False if that would go over the
+		writer's bound (nothing is queued then) unless force
+		"""
+		if not data:
+			return True
+		if not self.writer._reserve(len(data), force):
+			return False
+		with self.cond:
+			self.chunks.append(data)
+			self.queued += len(data)
+			self._schedule()
+		return True
+
+	def close(self, on_closed=None):
+		"""
+		no more writes. the file is closed after the last one and on_closed(ok)
+		is called on the writer thread, ok False if a write failed
+		"""
+		with self.cond:
+			self.on_closed = on_closed
+			self.closing = True
+			self._schedule()
+
+	def sync(self):
+		"""
+		blocks until everything queued so far is on disk
+		"""
+		with self.cond:
+			self.cond.wait_for(lambda: not self.scheduled)
+
+	def _schedule(self):
+		# called with cond held
+		if not self.scheduled:
+			self.scheduled = True
+			self.queue.put(self)
+
+
+class CacheWriter:
+
+	def __init__(self, threads=DEFAULT_THREADS, maxBytes=DEFAULT_QUEUE_BYTES):
+		self.max_bytes = maxBytes
+		self.queues = [queue.SimpleQueue() for _ in range(threads)]
+		self.lock = threading.Lock()
+		self.pending = 0 # bytes queued in all streams
+		self.next = 0
+		self.written = 0
+		self.batches = 0
+		self.dropped = 0
+		self.failed = 0
+
+	def start(self):
+		for i, q in enumerate(self.queues):
+			threading.Thread(target=self._run, args=(q,), name="cache-writer-%d" % i, daemon=True).start()
+
+	def open(self, f, on_written):
+		"""
+		a Stream writing behind into the file f is open on, on_written(n) is
+		called on the writer thread after every n bytes that hit the file. the
+		stream has a descriptor of its own, the caller may close f as usual
+		"""
+		with self.lock:
+			q = self.queues[self.next % len(self.queues)]
+			self.next += 1
+		return Stream(self, q, os.fdopen(os.dup(f.fileno()), "wb", buffering=0), on_written)
+
+	def _reserve(self, n, force):
+		with self.lock:
+			if self.pending + n > self.max_bytes and not force:
+				return False
+			self.pending += n
+		metrics.write_behind_bytes.inc(n)
+		return True
+
+	def _release(self, n):
+		with self.lock:
+			self.pending -= n
+		metrics.write_behind_bytes.inc(-n)
+
+	def count_drop(self):
+		self.dropped += 1
+		metrics.write_behind_drops.inc()
+
+	def _run(self, q):
+		while True:
+			stream = q.get()
+			try:
+				self._write(stream)
+			except:
+				eventlog.exception("cache_writer_failed")
+
+	def _write(self, stream):
+		with stream.cond:
+			chunks, stream.chunks = stream.chunks, []
+			size, stream.queued = stream.queued, 0
+			closing = stream.closing
+		if chunks:
+			data = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+			if stream.ok:
+				try:
+					view = memoryview(data)
+					while view:
+						view = view[stream.f.write(view):]
+					self.written += size
+					self.batches += 1
+				except OSError:
+					# the disk is full or gone, the object will not be published
+					stream.ok = False
+					self.failed += 1
+					eventlog.exception("cache_write_failed")
+			self._release(size)
+			if stream.ok:
+				stream.on_written(size)
+		with stream.cond:
+			if stream.chunks or (stream.closing and not closing):
+				# more came in meanwhile, write it on the next round
+				stream.queue.put(stream)
+				return
+			stream.scheduled = False
+			stream.cond.notify_all()
+		if closing:
+			try:
+				stream.f.close()
+			except OSError:
+				stream.ok = False
+			if stream.on_closed is not None:
+				stream.on_closed(stream.ok)
+
+	def stats_line(self):
+		return "cache writer: %d bytes in %d writes, %d bytes queued, %d objects dropped, %d failed" % (
+			self.written, self.batches, self.pending, self.dropped, self.failed)
@@ -0,0 +1,94 @@
+# splice(2) relay of a cache miss body: origin -> cache file -> client without Python buffers
+
+import os
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+import teardown
+
+"""
+On a miss the threaded engine reads every body chunk from the origin into a
+Python bytes object, writes it to the flight's temp file and sends it to the
+client: two copies into and out of user space per byte, plus the objects.
+On Linux, for a body framed by Content-Length, relay() instead moves it in
+the kernel:
+
+	origin socket --splice--> pipe --splice--> temp file
+	                                  temp file --sendfile--> client
+
+Each piece lands in the file first (so followers of the flight see it, as
+before) and is then sent to the client from the page cache. Linux has no
+tee() wrapper in Python and tee() only duplicates pipes, so the client gets
+its copy from the file instead of from a second pipe.
+
+Used by proxy.fetch_and_cache for bodies of at least MIN_BODY bytes that go
+to the client whole (no Range). chunked and read-until-close bodies, Range
+requests, --no-splice and the asyncio engine keep the portable loop in
+upstream.ConnectionPool.fetch. proxy/bench/bench_splice.py compares the two.
+"""
+
+AVAILABLE = hasattr(os, "splice")
+# smaller bodies are not worth a pipe and the extra system calls
+MIN_BODY = 64 * 1024
+# the pipe is grown to this if the kernel lets us (fs.pipe-max-size), bytes moved per round
+PIPE_SIZE = 1024 * 1024
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+
+
+def _pipe():
+	r, w = os.pipe()
+	size = 65536
+	if fcntl is not None:
+		try:
+			size = fcntl.fcntl(w, F_SETPIPE_SZ, PIPE_SIZE)
+		except OSError:
+			pass
+	return r, w, size
+
+
+def _wait_readable(sock):
+	# the socket has a timeout, which makes its descriptor non-blocking
+	timeout = sock.gettimeout()
+	if not teardown.readable(sock, timeout):
+		raise TimeoutError("origin sent nothing for %s seconds" % timeout)
+
+
+def relay(sock, count, cacheFile, readFile, clientSocket, progress):
+	"""
+	moves the next count bytes of sock into the unbuffered cacheFile at its
+	current position, and from there to clientSocket (None: nobody to send
+	to) reading through readFile, another handle on the same file.
+	progress(n) is called as soon as n more bytes are in the file.
+	returns whether clientSocket got all of them
+	"""
+	fd = cacheFile.fileno()
+	offset = os.lseek(fd, 0, os.SEEK_CUR)
+	r, w, pipeSize = _pipe()
+	try:
+		while count > 0:
+			try:
+				n = os.splice(sock.fileno(), w, min(count, pipeSize), flags=os.SPLICE_F_MOVE)
+			except BlockingIOError:
+				_wait_readable(sock)
+				continue
+			if n == 0:
+				raise ConnectionError("origin closed the connection mid-response")
+			left = n
+			while left > 0:
+				left -= os.splice(r, fd, left, flags=os.SPLICE_F_MOVE)
+			progress(n)
+			if clientSocket is not None:
+				try:
+					clientSocket.sendfile(readFile, offset, n)
+				except OSError:
+					# our own client left, keep going for the followers
+					clientSocket = None
+			offset += n
+			count -= n
+	finally:
+		os.close(r)
+		os.close(w)
+	return clientSocket is not None
@@ -0,0 +1,106 @@
+"""
+Cache hit benchmark: read()/send() loop vs sendfile.
+
+Stores one large response the way the proxy caches it (raw origin head + body),
+then serves it with proxy.serve_from_disk to a client on a loopback TCP
+connection, once per mode. The client only drains and counts bytes.
+
+Reported per mode (best of --rounds):
+    throughput     MB/s of response bytes delivered to the client
+    cpu/GB         CPU seconds the serving thread spent per GB sent
+
+    python bench/bench_sendfile.py --size 512M --rounds 3
+"""
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import common  # noqa: E402
+import hotcache  # noqa: E402
+import proxy  # noqa: E402
+
+
+def make_cached_response(directory: str, size: int) -> tuple:
+    path = os.path.join(directory, "big.bin")
+    head = (f"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+            f"Content-Length: {size}\r\n\r\n").encode()
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        f.write(head)
+        left = size
+        while left > 0:
+            f.write(block[:min(left, len(block))])
+            left -= len(block)
+    return path, head
+
+
+def drain(sock: socket.socket, result: dict):
+    buff = bytearray(1024 * 1024)
+    received = 0
+    while True:
+        n = sock.recv_into(buff)
+        if not n:
+            break
+        received += n
+    result["received"] = received
+
+
+def serve_once(path: str, sendfile: bool) -> dict:
+    listener = socket.create_server(("127.0.0.1", 0))
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    server.settimeout(30.0)
+
+    result = {}
+    drainer = threading.Thread(target=drain, args=(client, result))
+    drainer.start()
+
+    proxy.use_sendfile = sendfile
+    response = common.ResponseRewriter(False)
+    with open(path, "rb") as f:
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        proxy.serve_from_disk(server, response, path, f)
+        cpu = time.thread_time() - start_cpu
+    server.shutdown(socket.SHUT_WR)
+    drainer.join()
+    wall = time.perf_counter() - start_wall
+    server.close()
+    client.close()
+    return {"wall": wall, "cpu": cpu, "bytes": result["received"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cache hit serving: read()/send() vs sendfile")
+    parser.add_argument("--size", type=common.parse_size, default="256M", help="body size of the cached object")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    # memory tier off, every hit is a disk hit
+    proxy.hot = hotcache.HotObjectCache(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path, head = make_cached_response(directory, args.size)
+        # what the client should get: the head with our Connection header, then the body
+        expected = len(common.client_response_head(head, False)) + args.size
+        print(f"cached object: {os.path.getsize(path) / 2 ** 20:.0f} MiB, best of {args.rounds} rounds")
+        print(f"{'mode':<10}{'throughput':>16}{'cpu/GB':>12}")
+        for name, sendfile in (("read/send", False), ("sendfile", True)):
+            runs = [serve_once(path, sendfile) for _ in range(args.rounds)]
+            for run in runs:
+                assert run["bytes"] == expected, "short response"
+            best = min(runs, key=lambda run: run["wall"])
+            gigabytes = best["bytes"] / 1e9
+            print(f"{name:<10}{best['bytes'] / 1e6 / best['wall']:>11.0f} MB/s"
+                  f"{min(run['cpu'] for run in runs) / gigabytes:>10.3f} s")
+
+
+if __name__ == "__main__":
+    main()
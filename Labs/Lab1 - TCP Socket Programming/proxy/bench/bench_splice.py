@@ -0,0 +1,152 @@
+"""
+Cache miss benchmark: recv()/write()/send() loop vs splice.
+
+Runs a loopback origin that answers every request with one large
+Content-Length response (sent with sendfile, so the origin is not the
+bottleneck), then has proxy.fetch_and_cache fetch it as the leader of a miss:
+the body goes to the flight's temp file and to a client on a loopback TCP
+connection, once per mode. The client only drains and counts bytes.
+
+Reported per mode (best of --rounds):
+    throughput     MB/s of response bytes delivered to the client
+    cpu/GB         CPU seconds the fetching thread spent per GB relayed
+
+    python bench/bench_splice.py --size 512M --rounds 3
+"""
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import common  # noqa: E402
+import proxy  # noqa: E402
+import singleflight  # noqa: E402
+import upstream  # noqa: E402
+import zerocopy  # noqa: E402
+
+
+def make_body(directory: str, size: int) -> str:
+    path = os.path.join(directory, "origin.bin")
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        left = size
+        while left > 0:
+            f.write(block[:min(left, len(block))])
+            left -= len(block)
+    return path
+
+
+def origin_connection(conn: socket.socket, body_path: str, head: bytes):
+    # keep-alive, like the origins the pool talks to
+    with conn, open(body_path, "rb") as f:
+        pending = b""
+        while True:
+            while b"\r\n\r\n" not in pending:
+                buff = conn.recv(65536)
+                if not buff:
+                    return
+                pending += buff
+            pending = pending.split(b"\r\n\r\n", 1)[1]
+            conn.sendall(head)
+            conn.sendfile(f, 0)
+
+
+def run_origin(listener: socket.socket, body_path: str, size: int):
+    head = (f"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+            f"Content-Length: {size}\r\n\r\n").encode()
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            return
+        threading.Thread(target=origin_connection, args=(conn, body_path, head), daemon=True).start()
+
+
+def drain(sock: socket.socket, result: dict):
+    buff = bytearray(1024 * 1024)
+    received = 0
+    while True:
+        n = sock.recv_into(buff)
+        if not n:
+            break
+        received += n
+    result["received"] = received
+
+
+def fetch_once(origin: str, directory: str, n: int, splice: bool) -> dict:
+    listener = socket.create_server(("127.0.0.1", 0))
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    server.settimeout(30.0)
+
+    result = {}
+    drainer = threading.Thread(target=drain, args=(client, result))
+    drainer.start()
+
+    proxy.use_splice = splice
+    url = f"http://{origin}/big.bin?round={n}"
+    kind, flight, f = proxy.flights.open(os.path.join(directory, f"cached-{n}"), url=url)
+    assert kind == singleflight.LEAD
+    request = f"GET /big.bin?round={n} HTTP/1.1\r\nHost: {origin}\r\n\r\n".encode()
+    response = common.ResponseRewriter(False)
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    ok = proxy.fetch_and_cache(server, response, origin, request, flight, f)
+    cpu = time.thread_time() - start_cpu
+    server.shutdown(socket.SHUT_WR)
+    drainer.join()
+    wall = time.perf_counter() - start_wall
+    server.close()
+    client.close()
+    assert ok, "fetch failed"
+    size = os.path.getsize(flight.key)
+    os.unlink(flight.key)
+    return {"wall": wall, "cpu": cpu, "bytes": result["received"], "stored": size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cache miss relaying: recv()/send() loop vs splice")
+    parser.add_argument("--size", type=common.parse_size, default="256M", help="body size of the origin's response")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    modes = [("loop", False)]
+    if zerocopy.AVAILABLE:
+        modes.append(("splice", True))
+    else:
+        print("os.splice is not available here (Linux only), measuring the loop alone")
+
+    with tempfile.TemporaryDirectory() as directory:
+        body_path = make_body(directory, args.size)
+        origin_listener = socket.create_server(("127.0.0.1", 0))
+        threading.Thread(target=run_origin, args=(origin_listener, body_path, args.size), daemon=True).start()
+        origin = "127.0.0.1:%d" % origin_listener.getsockname()[1]
+
+        proxy.flights = singleflight.FlightTable()
+        proxy.pool = upstream.ConnectionPool()
+        print(f"origin response: {args.size / 2 ** 20:.0f} MiB body, best of {args.rounds} rounds")
+        print(f"{'mode':<10}{'throughput':>16}{'cpu/GB':>12}")
+        n = 0
+        for name, splice in modes:
+            runs = []
+            for _ in range(args.rounds):
+                n += 1
+                runs.append(fetch_once(origin, directory, n, splice))
+            for run in runs:
+                assert run["bytes"] > args.size and run["stored"] > args.size, "short response"
+            best = min(runs, key=lambda run: run["wall"])
+            gigabytes = best["bytes"] / 1e9
+            print(f"{name:<10}{best['bytes'] / 1e6 / best['wall']:>11.0f} MB/s"
+                  f"{min(run['cpu'] for run in runs) / gigabytes:>10.3f} s")
+        proxy.pool.close()
+        origin_listener.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Per-phase latency breakdown of proxy trace files (--trace-file, see app/tracing.py).
+
+Reads one or more JSONL trace files (every --workers process appends to the
+same one, or give several), groups the requests by outcome and prints, per
+phase: how many requests went through it, its share of their total time and
+nearest-rank p50/p95/p99/mean/max in milliseconds. The total row is the
+whole request, accept (or request head) to the last phase.
+
+    python bench/trace_report.py /tmp/trace.jsonl
+    python bench/trace_report.py /tmp/trace.jsonl --outcome miss --json
+"""
+import argparse
+import json
+import sys
+from typing import Any, Dict, Iterable, List
+
+# the order phases happen in, anything else is printed after them
+PHASES = ["queued", "head", "lookup", "pool", "dns", "connect", "first_byte", "transfer", "close"]
+
+
+def read_records(paths: List[str]) -> Iterable[Dict[str, Any]]:
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print(f"{path}:{number}: not JSON, skipped", file=sys.stderr)
+                    continue
+                if "dropped" in record:
+                    print(f"{path}:{number}: the proxy dropped {record['dropped']} records", file=sys.stderr)
+                    continue
+                yield record
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+
+    def rank(p: float) -> float:
+        return ordered[max(0, min(len(ordered) - 1, int(p / 100 * len(ordered) + 0.5) - 1))] * 1000
+
+    return {
+        "count": len(ordered),
+        "sum_ms": sum(ordered) * 1000,
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "mean": sum(ordered) / len(ordered) * 1000,
+        "max": ordered[-1] * 1000,
+    }
+
+
+def breakdown(records: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    by_phase: Dict[str, List[float]] = {}
+    for record in records:
+        for phase, seconds in record["phases"].items():
+            by_phase.setdefault(phase, []).append(seconds)
+    order = [p for p in PHASES if p in by_phase] + sorted(p for p in by_phase if p not in PHASES)
+    rows = {phase: percentiles(by_phase[phase]) for phase in order}
+    rows["total"] = percentiles([record["total"] for record in records])
+    return rows
+
+
+def print_table(title: str, rows: Dict[str, Dict[str, float]]):
+    total = rows["total"]["sum_ms"] or 1.0
+    print(f"{title}: {rows['total']['count']} requests")
+    print(f"  {'phase':<12}{'count':>8}{'share':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'mean':>10}{'max':>10}")
+    for phase, row in rows.items():
+        share = "" if phase == "total" else f"{row['sum_ms'] / total * 100:.1f}%"
+        print(f"  {phase:<12}{row['count']:>8}{share:>8}" + "".join(
+            f"{row[key]:>10.3f}" for key in ("p50", "p95", "p99", "mean", "max")))
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="per-phase latency breakdown of proxy trace files (milliseconds)")
+    parser.add_argument("files", nargs="+", help="JSONL files written with --trace-file")
+    parser.add_argument("--outcome", default=None, help="only requests with this outcome (hit, miss, uncached, error)")
+    parser.add_argument("--json", action="store_true", help="print the breakdown as JSON instead of tables")
+    args = parser.parse_args()
+
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for record in read_records(args.files):
+        outcome = record.get("outcome") or "none"
+        if args.outcome is None or outcome == args.outcome:
+            groups.setdefault(outcome, []).append(record)
+    if not groups:
+        sys.exit("no trace records")
+
+    everything = [record for records in groups.values() for record in records]
+    report = {"all": breakdown(everything)}
+    if len(groups) > 1:
+        report.update((outcome, breakdown(records)) for outcome, records in sorted(groups.items()))
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for title, rows in report.items():
+        print_table(title, rows)
+
+
+if __name__ == "__main__":
+    main()
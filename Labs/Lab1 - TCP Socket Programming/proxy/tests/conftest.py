@@ -0,0 +1,10 @@
+"""
+Unit tests of the proxy modules, no origin or Docker needed:
+
+    python -m pytest proxy/tests
+"""
+import os
+import sys
+
+# the app modules import each other by their bare names, like proxy.py does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
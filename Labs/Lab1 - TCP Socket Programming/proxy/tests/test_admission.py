@@ -0,0 +1,14 @@
+import pytest
+
+import admission
+
+
+@pytest.mark.parametrize("vary", ["Cookie", "*", "Accept-Encoding, Cookie", "User-Agent", "accept-language"])
+def test_responses_varying_per_client_are_not_stored(vary):
+    assert not admission.response_cacheable(200, {"vary": vary})
+
+
+@pytest.mark.parametrize("vary", ["", "Accept-Encoding", "accept-encoding", "Accept-Encoding, Accept-Encoding"])
+def test_responses_varying_only_on_the_encoding_are_stored(vary):
+    assert admission.response_cacheable(200, {"vary": vary})
+    assert admission.response_cacheable(200, {})
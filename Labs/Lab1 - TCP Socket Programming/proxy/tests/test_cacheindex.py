@@ -0,0 +1,68 @@
+import os
+import time
+
+import cacheindex
+
+
+def response(body):
+    return b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+
+
+def store(index, path, body):
+    # the way singleflight.py publishes: temp file, sidecar, then the rename
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".inflight", "wb") as f:
+        f.write(response(body))
+    index.add(path, url="http://example.com/", data_path=path + ".inflight")
+    os.replace(path + ".inflight", path)
+
+
+def previous_run(directory, body):
+    index = cacheindex.CacheIndex(str(directory))
+    index.open_log()
+    path = os.path.join(str(directory), "3f", "a2", "3fa2")
+    store(index, path, body)
+    time.sleep(0.01)
+    return path
+
+
+def boot(directory):
+    index = cacheindex.CacheIndex(str(directory))
+    index.load()
+    index.open_log()
+    return index
+
+
+def test_validate_keeps_objects_another_worker_replaced(tmp_path):
+    path = previous_run(tmp_path, b"old")
+    index = boot(tmp_path)
+    other = boot(tmp_path)
+    store(other, path, b"a longer body from the other worker")
+
+    assert index.validate() == (0, 0)
+    assert os.path.exists(path)
+    assert os.path.exists(path + cacheindex.META_SUFFIX)
+
+
+def test_validate_adopts_the_sidecar_when_it_matches_the_file(tmp_path):
+    path = previous_run(tmp_path, b"old")
+    # a record newer than the log's, from before this boot
+    second = cacheindex.CacheIndex(str(tmp_path))
+    store(second, path, b"rewritten")
+    time.sleep(0.01)
+    index = boot(tmp_path)
+    index.entries[index.key_for(path)]["size"] = 1
+
+    assert index.validate() == (0, 0)
+    assert index.get(path)["size"] == os.path.getsize(path)
+
+
+def test_validate_drops_truncated_objects(tmp_path):
+    path = previous_run(tmp_path, b"a body that gets cut short")
+    index = boot(tmp_path)
+    with open(path, "r+b") as f:
+        f.truncate(10)
+
+    assert index.validate() == (1, 0)
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + cacheindex.META_SUFFIX)
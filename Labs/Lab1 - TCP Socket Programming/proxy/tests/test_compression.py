@@ -0,0 +1,35 @@
+import os
+
+import compression
+
+
+def stored_response(path, body):
+    with open(path, "wb") as f:
+        f.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+
+
+def test_incompressible_objects_are_remembered_within_a_bound(tmp_path, monkeypatch):
+    monkeypatch.setattr(compression, "MAX_INCOMPRESSIBLE", 3)
+    monkeypatch.setattr(compression, "_incompressible", compression.OrderedDict())
+    paths = []
+    for i in range(5):
+        path = str(tmp_path / ("object%d" % i))
+        stored_response(path, os.urandom(2048))
+        assert compression.build(path, "gzip") is None
+        paths.append(path)
+
+    assert len(compression._incompressible) == 3
+    assert (paths[0], "gzip") not in compression._incompressible
+    assert (paths[4], "gzip") in compression._incompressible
+
+
+def test_a_replaced_object_takes_the_place_of_its_old_version(tmp_path, monkeypatch):
+    monkeypatch.setattr(compression, "_incompressible", compression.OrderedDict())
+    path = str(tmp_path / "object")
+    stored_response(path, os.urandom(2048))
+    assert compression.build(path, "gzip") is None
+    stored_response(path, os.urandom(4096))
+    os.utime(path, ns=(0, 10 ** 18))
+    assert compression.build(path, "gzip") is None
+
+    assert list(compression._incompressible.items()) == [((path, "gzip"), 10 ** 18)]
@@ -0,0 +1,128 @@
+import pytest
+
+import httpparse
+
+
+def feed_bytewise(framer, data):
+    used = 0
+    for i in range(len(data)):
+        if framer.done:
+            break
+        used += framer.feed(data[i:i + 1])
+    return used
+
+
+def test_head_split_across_reads():
+    request = b"GET http://example.com/ HTTP/1.1\r\nHost: example.com\r\n\r\n"
+    parser = httpparse.RequestParser()
+    assert feed_bytewise(parser, request) == len(request)
+    assert parser.done and not parser.has_body
+    assert (parser.method, parser.target, parser.version) == ("GET", "http://example.com/", "HTTP/1.1")
+    assert parser.headers == {"host": "example.com"}
+
+
+def test_response_body_split_across_reads():
+    response = b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello"
+    body = []
+    framer = httpparse.ResponseFramer(on_body=body.append)
+    assert feed_bytewise(framer, response) == len(response)
+    assert framer.done and framer.keep_alive
+    assert b"".join(body) == b"hello"
+
+
+def test_chunk_extensions_and_trailers():
+    response = (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"5;name=value\r\nhello\r\n"
+                b"6 ; other\r\n world\r\n"
+                b"0\r\nExpires: never\r\nX-Checksum: abc\r\n\r\n")
+    body = []
+    framer = httpparse.ResponseFramer(on_body=body.append)
+    assert framer.feed(response) == len(response)
+    assert framer.done
+    assert b"".join(body) == b"hello world"
+
+
+def test_chunked_split_across_reads():
+    response = (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"a;ext\r\n0123456789\r\n0\r\nTrailer: yes\r\n\r\n")
+    body = []
+    framer = httpparse.ResponseFramer(on_body=body.append)
+    assert feed_bytewise(framer, response) == len(response)
+    assert b"".join(body) == b"0123456789"
+
+
+def test_interim_responses_are_skipped():
+    response = (b"HTTP/1.1 100 Continue\r\n\r\n"
+                b"HTTP/1.1 103 Early Hints\r\nLink: </style.css>; rel=preload\r\n\r\n"
+                b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+    body = []
+    framer = httpparse.ResponseFramer(on_body=body.append)
+    assert framer.feed(response) == len(response)
+    assert framer.done
+    assert framer.status == 200
+    assert "link" not in framer.headers
+    assert framer.head.startswith(b"HTTP/1.1 200 OK")
+    assert b"".join(body) == b"ok"
+
+
+def test_pipelined_requests_leave_the_next_one_to_the_caller():
+    first = b"POST http://example.com/a HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc"
+    second = b"GET http://example.com/b HTTP/1.1\r\n\r\n"
+    parser = httpparse.RequestParser()
+    used = parser.feed(first + second)
+    assert used == len(first)
+    assert parser.done and parser.has_body
+
+    parser = httpparse.RequestParser()
+    assert parser.feed((first + second)[used:]) == len(second)
+    assert parser.target == "http://example.com/b"
+
+
+def test_response_leftover_bytes_belong_to_the_next_response():
+    first = b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n0\r\n\r\n"
+    second = b"HTTP/1.1 304 Not Modified\r\n\r\n"
+    framer = httpparse.ResponseFramer()
+    assert framer.feed(first + second) == len(first)
+    assert framer.done
+
+
+def test_identical_content_lengths_are_accepted():
+    response = (b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\nContent-Length: 5\r\n\r\n"
+                b"helloHTTP/1.1")
+    framer = httpparse.ResponseFramer()
+    assert framer.feed(response) == len(response) - len(b"HTTP/1.1")
+    assert framer.done
+
+    parser = httpparse.RequestParser()
+    parser.feed(b"POST / HTTP/1.1\r\nContent-Length: 3, 3\r\n\r\nabc")
+    assert parser.done and parser.has_body
+
+
+def test_conflicting_content_lengths_are_rejected():
+    with pytest.raises(httpparse.FramingError):
+        httpparse.ResponseFramer().feed(b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\nContent-Length: 6\r\n\r\n")
+    with pytest.raises(httpparse.FramingError):
+        httpparse.RequestParser().feed(b"POST / HTTP/1.1\r\nContent-Length: 3, 4\r\n\r\nabc")
+
+
+@pytest.mark.parametrize("size", [b"-9", b"+3", b"1_0", b"", b"0x3", b"3 3"])
+def test_bad_chunk_sizes_are_rejected(size):
+    body = b"3\r\nabc\r\n" + size + b"\r\nxx\r\n0\r\n\r\n"
+    parser = httpparse.RequestParser()
+    with pytest.raises(httpparse.FramingError):
+        parser.feed(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n" + body)
+
+
+@pytest.mark.parametrize("length", [b"+5", b"-5", b"1_0", b"5 5", b"\x0c5", b"5\x0b", b"0x5", b"\xb2", b""])
+def test_bad_content_lengths_are_rejected(length):
+    with pytest.raises(httpparse.FramingError):
+        httpparse.ResponseFramer().feed(b"HTTP/1.1 200 OK\r\nContent-Length: " + length + b"\r\n\r\nhello")
+    with pytest.raises(httpparse.FramingError):
+        httpparse.RequestParser().feed(b"POST / HTTP/1.1\r\nContent-Length: " + length + b"\r\n\r\nhello")
+
+
+def test_content_length_is_not_read_by_int():
+    # parse_headers has already taken off the spaces around the value, int() would take more
+    for length in (" 5 ", "\x0c5", "1 0", "+5", "1_0"):
+        with pytest.raises(httpparse.FramingError):
+            httpparse.ResponseFramer()._frame_body(None, length)
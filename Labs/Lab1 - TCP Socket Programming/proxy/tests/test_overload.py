@@ -0,0 +1,66 @@
+import socket
+import threading
+
+import overload
+
+
+def make_pool(max_workers, queue_size):
+    release = threading.Event()
+    started = threading.Semaphore(0)
+
+    def handler(sock, accepted, served):
+        started.release()
+        release.wait(10)
+        sock.close()
+
+    return overload.ClientPool(handler, max_workers, queue_size), started, release
+
+
+def submit(pool):
+    ours, theirs = socket.socketpair()
+    theirs.settimeout(5)
+    return pool.submit(ours), theirs
+
+
+def test_accept_queue_0_rejects_when_no_worker_is_free():
+    pool, started, release = make_pool(1, 0)
+    try:
+        accepted, first = submit(pool)
+        assert accepted
+        assert started.acquire(timeout=5)
+        accepted, second = submit(pool)
+        assert not accepted
+        assert second.recv(4096).startswith(b"HTTP/1.1 503 ")
+        assert pool.rejected == 1
+    finally:
+        release.set()
+
+
+def test_accept_queue_bounds_the_waiting_connections():
+    pool, started, release = make_pool(1, 2)
+    try:
+        results = [submit(pool) for _ in range(3)]
+        assert [accepted for accepted, _ in results] == [True, True, True]
+        assert started.acquire(timeout=5)
+        accepted, rejected = submit(pool)
+        assert not accepted
+        assert rejected.recv(4096).startswith(b"HTTP/1.1 503 ")
+        release.set()
+        for _ in range(2):
+            assert started.acquire(timeout=5), "the queued connections are served once the worker is free"
+    finally:
+        release.set()
+
+
+def test_accept_queue_0_still_uses_every_worker():
+    pool, started, release = make_pool(2, 0)
+    try:
+        for _ in range(2):
+            accepted, _ = submit(pool)
+            assert accepted
+        for _ in range(2):
+            assert started.acquire(timeout=5)
+        accepted, _ = submit(pool)
+        assert not accepted
+    finally:
+        release.set()
@@ -0,0 +1,31 @@
+import asyncio
+import time
+
+import upstream
+
+
+class FakeWriter:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_async_pool_sweeps_idle_connections_of_other_origins():
+    async def run():
+        pool = upstream.AsyncConnectionPool(idle_timeout=0.2)
+        stale = (None, FakeWriter())
+        pool.idle[("gone.example", 80)] = [(stale, time.monotonic() - 1)]
+        pool.last_sweep = time.monotonic() - 1
+        # another origin's connection goes back to the pool
+        await pool._slot(("other.example", 80)).acquire()
+        fresh = (None, FakeWriter())
+        pool.release("other.example", 80, fresh, True)
+        return stale, fresh, pool
+
+    stale, fresh, pool = asyncio.run(run())
+    assert stale[1].closed
+    assert not fresh[1].closed
+    assert pool.idle[("gone.example", 80)] == []
+    assert len(pool.idle[("other.example", 80)]) == 1
@@ -0,0 +1,36 @@
+import os
+import select
+import socket
+
+import pytest
+
+resource = pytest.importorskip("resource")
+
+import zerocopy
+
+
+@pytest.fixture
+def high_socketpair():
+    # the origin side of the pair on a descriptor select() cannot watch
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if (hard != resource.RLIM_INFINITY and hard <= 1100) or not hasattr(select, "poll"):
+        pytest.skip("needs poll() and more than 1100 descriptors")
+    if soft != resource.RLIM_INFINITY and soft <= 1100:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (1100 if hard == resource.RLIM_INFINITY else hard, hard))
+    origin, peer = socket.socketpair()
+    fd = os.dup2(origin.fileno(), 1050)
+    origin.close()
+    origin = socket.socket(fileno=fd)
+    yield origin, peer
+    origin.close()
+    peer.close()
+    resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+def test_wait_readable_past_1024_descriptors(high_socketpair):
+    origin, peer = high_socketpair
+    origin.settimeout(0.05)
+    with pytest.raises(TimeoutError):
+        zerocopy._wait_readable(origin)
+    peer.sendall(b"x")
+    zerocopy._wait_readable(origin)
@@ -10,6 +10,8 @@ import zmq
 from random import sample
 from typing import Callable, List, Generator, Optional
 
+from testutils import make_proxy_client
+
 
 @pytest.fixture(scope="session")
 def proxy_host():
@@ -109,10 +111,7 @@ def make_httpx_client(proxy_address) -> Generator[Callable[..., httpx.Client], N
     clients: List[httpx.Client] = []
 
     def httpx_client_closure() -> httpx.Client:
-        proxies = {
-            "all://": f"http://{proxy_address}",
-        }
-        client = httpx.Client(proxies=proxies, timeout=5)
+        client = make_proxy_client(proxy_address, httpx.Client)
         clients.append(client)
         return client
 
@@ -126,10 +125,7 @@ def make_async_httpx_client(proxy_address) -> Generator[Callable[..., httpx.Asyn
     clients: List[httpx.AsyncClient] = []
 
     def httpx_client_closure() -> httpx.AsyncClient:
-        proxies = {
-            "all://": f"http://{proxy_address}",
-        }
-        client = httpx.AsyncClient(proxies=proxies, timeout=5)
+        client = make_proxy_client(proxy_address, httpx.AsyncClient)
         clients.append(client)
         return client
 
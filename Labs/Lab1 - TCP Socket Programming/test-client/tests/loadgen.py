@@ -0,0 +1,240 @@
+"""
+Load generator for the proxy: replays a mix of nginx static files and fastapi endpoints through it
+for a fixed duration and writes throughput and latency percentiles, split by cache hit and miss, to JSON.
+
+Not a pytest suite (pytest does not collect this file). Run it inside the test-client container,
+where the origins and /var/html are reachable, while the proxy is up:
+
+    docker compose run --rm test-client python loadgen.py --concurrency 64 --duration 30 \\
+        --hit-ratio 0.9 --label my-build --output /var/log/pytest/loadgen.json
+
+Every virtual user is one keep-alive httpx.AsyncClient, made like the ones the tests use
+(testutils.make_proxy_client), that sends its requests back to back (a closed loop).
+
+Hits and misses are requested, not observed: a miss asks for a URL with a query string nobody
+used before (?loadgen=<run>-<n>, both origins ignore it), a hit asks for one of the plain URLs,
+which a warm-up pass requests once before measuring starts. Compare reports of runs with the
+same options across proxy builds.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from testutils import make_proxy_client
+
+FASTAPI_PATHS = [
+    "/",
+    "/empty_body",
+    "/test_query_parameters?deez=a&nuts=b",
+    "/really_big_header",
+    "/你好",
+]
+HTML_DIRS = [
+    "/var/html",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "nginx-server", "html"),
+]
+
+
+class Target:
+    def __init__(self, source: str, url: str):
+        self.source = source
+        self.url = url
+
+
+def list_targets(html_dir: str, nginx_host: str, fastapi_host: str, n_files: Optional[int],
+                 rng: random.Random) -> Dict[str, List[Target]]:
+    files = sorted(f for f in os.listdir(html_dir) if os.path.isfile(os.path.join(html_dir, f)))
+    if n_files:
+        files = rng.sample(files, min(n_files, len(files)))
+    return {
+        "nginx": [Target("nginx", f"http://{nginx_host}/{name}") for name in files],
+        "fastapi": [Target("fastapi", f"http://{fastapi_host}{path}") for path in FASTAPI_PATHS],
+    }
+
+
+def miss_url(url: str, run_id: str, n: int) -> str:
+    return f"{url}{'&' if '?' in url else '?'}loadgen={run_id}-{n}"
+
+
+def percentiles(latencies: List[float]) -> Dict[str, Any]:
+    """
+    Nearest-rank p50/p95/p99 plus mean and max, in milliseconds.
+    """
+    if not latencies:
+        return {"count": 0}
+    ordered = sorted(latencies)
+
+    def rank(p: float) -> float:
+        return round(ordered[max(0, min(len(ordered) - 1, int(p / 100 * len(ordered) + 0.5) - 1))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {"hit": [], "miss": []}
+        self.by_source: Dict[str, List[float]] = {}
+        self.statuses: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.bytes = 0
+
+    def record(self, kind: str, source: str, seconds: float, status: int, size: int):
+        self.latencies[kind].append(seconds)
+        self.by_source.setdefault(source, []).append(seconds)
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+        self.bytes += size
+
+    def error(self, error: BaseException):
+        name = type(error).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+
+async def fetch(client: httpx.AsyncClient, url: str) -> Tuple[int, int]:
+    response = await client.get(url)
+    return response.status_code, len(response.content)
+
+
+async def warm_up(clients: List[httpx.AsyncClient], targets: List[Target]):
+    """
+    Every plain URL once, so that the measured hits really are hits.
+    """
+    queue = list(targets)
+
+    async def worker(client: httpx.AsyncClient):
+        while queue:
+            target = queue.pop()
+            try:
+                await fetch(client, target.url)
+            except httpx.HTTPError:
+                pass
+
+    await asyncio.gather(*(worker(c) for c in clients))
+
+
+async def virtual_user(client: httpx.AsyncClient, targets: Dict[str, List[Target]], args: argparse.Namespace,
+                       rng: random.Random, run_id: str, counter: List[int], deadline: float, recorder: Recorder):
+    while time.monotonic() < deadline:
+        use_fastapi = targets["fastapi"] and (not targets["nginx"] or rng.random() < args.fastapi_share)
+        source = "fastapi" if use_fastapi else "nginx"
+        target = rng.choice(targets[source])
+        kind = "hit" if rng.random() < args.hit_ratio else "miss"
+        url = target.url
+        if kind == "miss":
+            counter[0] += 1
+            url = miss_url(url, run_id, counter[0])
+        started = time.monotonic()
+        try:
+            status, size = await fetch(client, url)
+        except httpx.HTTPError as e:
+            recorder.error(e)
+            continue
+        recorder.record(kind, source, time.monotonic() - started, status, size)
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    html_dir = args.html_dir or next((d for d in HTML_DIRS if os.path.isdir(d)), None)
+    if html_dir is None:
+        sys.exit("no nginx html directory found, pass --html-dir")
+    targets = list_targets(html_dir, args.nginx_host, args.fastapi_host, args.files, rng)
+    if args.fastapi_share <= 0:
+        targets["fastapi"] = []
+    if args.fastapi_share >= 1:
+        targets["nginx"] = []
+    run_id = uuid.uuid4().hex[:8]
+
+    clients = [make_proxy_client(args.proxy, httpx.AsyncClient, args.timeout) for _ in range(args.concurrency)]
+    recorder = Recorder()
+    try:
+        if args.hit_ratio > 0:
+            await warm_up(clients, targets["nginx"] + targets["fastapi"])
+        counter = [0]
+        started = time.monotonic()
+        deadline = started + args.duration
+        await asyncio.gather(*(virtual_user(c, targets, args, random.Random(rng.random()), run_id, counter, deadline,
+                                            recorder) for c in clients))
+        elapsed = time.monotonic() - started
+    finally:
+        await asyncio.gather(*(c.aclose() for c in clients))
+
+    completed = len(recorder.latencies["hit"]) + len(recorder.latencies["miss"])
+    return {
+        "label": args.label,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {
+            "proxy": args.proxy,
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "hit_ratio": args.hit_ratio,
+            "fastapi_share": args.fastapi_share,
+            "nginx_files": len(targets["nginx"]),
+            "seed": args.seed,
+        },
+        "elapsed_s": round(elapsed, 3),
+        "requests": completed,
+        "errors": recorder.errors,
+        "statuses": recorder.statuses,
+        "throughput_rps": round(completed / elapsed, 2),
+        "throughput_mbps": round(recorder.bytes / elapsed / 1e6, 3),
+        "latency_ms": {
+            "all": percentiles(recorder.latencies["hit"] + recorder.latencies["miss"]),
+            "hit": percentiles(recorder.latencies["hit"]),
+            "miss": percentiles(recorder.latencies["miss"]),
+        },
+        "latency_ms_by_source": {source: percentiles(values) for source, values in sorted(recorder.by_source.items())},
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    default_proxy = f"{os.environ.get('PROXY_HOST', '127.0.0.1')}:{os.environ.get('PROXY_PORT', '8080')}"
+    parser = argparse.ArgumentParser(description="load generator for the lab 1 proxy")
+    parser.add_argument("--proxy", default=default_proxy, help=f"host:port of the proxy (default {default_proxy})")
+    parser.add_argument("--concurrency", type=int, default=32, help="virtual users, one connection each (default 32)")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to measure for (default 30)")
+    parser.add_argument("--hit-ratio", type=float, default=0.9,
+                        help="fraction of requests for already cached URLs, the rest are misses (default 0.9)")
+    parser.add_argument("--fastapi-share", type=float, default=0.1,
+                        help="fraction of requests for fastapi endpoints, the rest are nginx files (default 0.1)")
+    parser.add_argument("--files", type=int, default=None, help="sample this many nginx files (default all)")
+    parser.add_argument("--html-dir", default=None, help="nginx html directory to list the files of (default /var/html)")
+    parser.add_argument("--nginx-host", default="nginx-server")
+    parser.add_argument("--fastapi-host", default="fastapi-server")
+    parser.add_argument("--timeout", type=float, default=10.0, help="seconds per request (default 10)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the request mix (default 0)")
+    parser.add_argument("--label", default=None, help="name of the proxy build, copied into the report")
+    parser.add_argument("--output", default=None, help="write the JSON report here (default stdout only)")
+    args = parser.parse_args(argv)
+    if args.concurrency < 1 or args.duration <= 0:
+        parser.error("--concurrency and --duration must be positive")
+    if not 0 <= args.hit_ratio <= 1 or not 0 <= args.fastapi_share <= 1:
+        parser.error("--hit-ratio and --fastapi-share must be in [0, 1]")
+    return args
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import time
 
 import asyncio
 import hashlib
+import socket
 import httpx
 from math import floor
 from typing import Callable, List, Coroutine
@@ -101,3 +102,91 @@ def test_post_should_not_be_cached(make_httpx_client: Callable[..., httpx.Client
     relevant_log_entries = [l for l in get_fastapi_log_entries_after_time(start_time) if
                             l["request_line"] == "POST http://fastapi-server/test_post HTTP/1.1"]
     assert len(relevant_log_entries) == 2, "There must be exactly two requests made after the start_time"
+
+
+def test_pipelined_requests_on_one_connection(proxy_host, proxy_port):
+    """
+    A browser that keeps its connection open may send the next request before the first answer is back. Responses must come back in order, on the same socket.
+    """
+    files = ["home_igloo.gif", "clinton.gif", "home_igloo.gif"]
+    request = b"".join(f"GET http://nginx-server/{name} HTTP/1.1\r\nHost: nginx-server\r\n\r\n".encode() for name in files)
+    with socket.create_connection((proxy_host, proxy_port), timeout=10) as s:
+        s.sendall(request)
+        buffered = b""
+        for name in files:
+            while b"\r\n\r\n" not in buffered:
+                data = s.recv(4096)
+                assert data, "The proxy closed the connection before answering every pipelined request"
+                buffered += data
+            head, _, buffered = buffered.partition(b"\r\n\r\n")
+            assert head.split(b" ")[1] == b"200"
+            length = [int(line.split(b":")[1]) for line in head.split(b"\r\n") if line.lower().startswith(b"content-length:")][0]
+            while len(buffered) < length:
+                data = s.recv(4096)
+                assert data, "The proxy closed the connection in the middle of a response"
+                buffered += data
+            body, buffered = buffered[:length], buffered[length:]
+            with open(f"/var/html/{name}", "rb") as f:
+                assert hashlib.md5(body).digest() == hashlib.md5(f.read()).digest()
+
+
+def test_range_requests_are_cut_from_the_cached_object(make_httpx_client: Callable[..., httpx.Client]):
+    """
+    Download managers and video players ask for pieces of a file with Range. Every piece must be the right bytes with a 206, but the origin should only be asked for the whole file once.
+    """
+    with open("/var/html/home_igloo.gif", "rb") as f:
+        original = f.read()
+    client = make_httpx_client()
+    start_time = floor(time.time())
+    for first, last in [(0, 99), (1000, 1999), (len(original) - 10, len(original) - 1)]:
+        response = client.request(method="GET", url="http://nginx-server/home_igloo.gif",
+                                  headers={"Range": f"bytes={first}-{last}"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == f"bytes {first}-{last}/{len(original)}"
+        assert response.read() == original[first:last + 1]
+        time.sleep(1)
+
+    response = client.request(method="GET", url="http://nginx-server/home_igloo.gif",
+                              headers={"Range": f"bytes={len(original)}-"})
+    assert response.status_code == 416
+
+    relevant_log_entries = [l for l in get_nginx_log_entries_after_time(start_time) if
+                            l["request_line"] == "GET http://nginx-server/home_igloo.gif HTTP/1.1"]
+    assert len(relevant_log_entries) == 1, "There must be exactly one request made after the start_time"
+
+
+def test_stale_object_is_revalidated_with_the_origin(make_httpx_client: Callable[..., httpx.Client]):
+    """
+    A cached object past its max-age must not be served blindly, but it need not be downloaded again either. The proxy asks the origin with If-None-Match, and after a 304 the client still gets a 200 with the cached body.
+    """
+    client = make_httpx_client()
+    start_time = floor(time.time())
+    first = client.request(method="GET", url="http://fastapi-server/short_lived")
+    assert first.status_code == 200
+    time.sleep(2)
+    second = client.request(method="GET", url="http://fastapi-server/short_lived")
+    assert second.status_code == 200
+    assert second.read() == first.read() == b"Fresh for one second only"
+
+    statuses = [l["status"] for l in get_fastapi_log_entries_after_time(start_time) if
+                l["request_line"] == "GET http://fastapi-server/short_lived HTTP/1.1"]
+    assert statuses == [200, 304], "The stale copy must be revalidated with a conditional request"
+
+
+def test_reload_with_no_cache_revalidates_a_fresh_object(make_httpx_client: Callable[..., httpx.Client]):
+    """
+    A browser reload sends Cache-Control: no-cache. Even a fresh copy has to be checked with the origin then, and the 304 it gets still has to turn into a 200 with the cached body for the client.
+    """
+    client = make_httpx_client()
+    start_time = floor(time.time())
+    first = client.request(method="GET", url="http://fastapi-server/short_lived")
+    assert first.status_code == 200
+    for cache_control in ["no-cache", "max-age=0"]:
+        response = client.request(method="GET", url="http://fastapi-server/short_lived",
+                                  headers={"Cache-Control": cache_control})
+        assert response.status_code == 200
+        assert response.read() == first.read()
+
+    statuses = [l["status"] for l in get_fastapi_log_entries_after_time(start_time) if
+                l["request_line"] == "GET http://fastapi-server/short_lived HTTP/1.1"]
+    assert statuses == [200, 304, 304], "Every reload must be revalidated with a conditional request"
@@ -1,6 +1,22 @@
 import json
 from math import floor
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Type, TypeVar
+
+import httpx
+
+ClientType = TypeVar("ClientType", httpx.Client, httpx.AsyncClient)
+
+
+def make_proxy_client(proxy_address: str, client_class: Type[ClientType], timeout: float = 5) -> ClientType:
+    """
+    An httpx client that sends every request through the proxy at proxy_address ("host:port").
+    """
+    proxy_url = f"http://{proxy_address}"
+    try:
+        # httpx >= 0.26
+        return client_class(proxy=proxy_url, timeout=timeout)
+    except TypeError:
+        return client_class(proxies={"all://": proxy_url}, timeout=timeout)
 
 
 def get_nginx_log_entries_after_time(time: float | int) -> List[Dict[str, Any]]: